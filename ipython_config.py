@@ -28,7 +28,10 @@ c = get_config()
 # c.InteractiveShellApp.exec_PYTHONSTARTUP = True
 
 # lines of code to run at IPython startup.
-# c.InteractiveShellApp.exec_lines = []
+# connect_all_devices() (startup/02-connections.py) connects every device of
+# the startup files in one concurrent batch, after all of them are created;
+# position_snapshot (startup/05-snapshot.py) then monitors all positioners.
+c.InteractiveShellApp.exec_lines = ['connect_all_devices()', 'position_snapshot.start()']
 
 # Enable GUI event loop integration with any of ('glut', 'gtk', 'gtk3', 'none',
 # 'osx', 'pyglet', 'qt', 'qt4', 'tk', 'wx').
@@ -0,0 +1,205 @@
+import builtins
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+import types
+from pathlib import Path
+
+# Opt-in startup instrumentation. Start IPython with
+#
+#   IXS_STARTUP_PROFILE=1 ipython --profile=collection
+#
+# to write a JSON report into the profile directory, or set the variable to the
+# path of the report. Each startup file is timed (wall, import and PV connection
+# time, memory delta) together with the top-level objects it creates.
+# compare_startup_profiles(old, new) compares two reports.
+
+
+def _rss_bytes():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _profile_version(path):
+    try:
+        return subprocess.run(['git', '-C', str(path), 'describe', '--always', '--dirty'],
+                              capture_output=True, text=True, timeout=5).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        return ''
+
+
+class StartupProfiler:
+    """
+    Times every startup file executed through IPython's safe_execfile.
+
+    Import time is the time spent in top-level ``import`` statements, PV
+    connection time is the time spent waiting in ophyd connection calls, and
+    construction time is the time spent creating top-level ophyd objects.
+    """
+
+    def __init__(self, shell, report_path):
+        self.shell = shell
+        self.report_path = Path(report_path)
+        self.startup_dir = Path(shell.profile_dir.startup_dir)
+        # IPython runs the .ipy files through safe_execfile_ipy, which is not profiled
+        startup_files = sorted(self.startup_dir.glob('*.py'))
+        self.last_file = startup_files[-1].name if startup_files else None
+        self.files = []
+        self._current = None
+        self._local = threading.local()
+        self._objects = {}
+        self._patched = []
+        self._t_start = time.perf_counter()
+
+    def install(self):
+        self._safe_execfile = self.shell.safe_execfile
+        self._builtin_import = builtins.__import__
+        self.shell.safe_execfile = self._execfile
+        builtins.__import__ = self._import
+
+    def uninstall(self):
+        self.shell.safe_execfile = self._safe_execfile
+        builtins.__import__ = self._builtin_import
+        for cls, attr, orig in self._patched:
+            setattr(cls, attr, orig)
+        self._patched = []
+
+    def _depth(self, kind, step):
+        depth = getattr(self._local, kind, 0) + step
+        setattr(self._local, kind, depth)
+        return depth
+
+    def _import(self, *args, **kwargs):
+        self._depth('imports', 1)
+        t0 = time.perf_counter()
+        try:
+            return self._builtin_import(*args, **kwargs)
+        finally:
+            if not self._depth('imports', -1) and self._current is not None:
+                self._current['import_s'] += time.perf_counter() - t0
+
+    def _timed(self, kind, func):
+        # wraps an ophyd method, accounting only the outermost call per thread
+        profiler = self
+
+        def wrapper(obj, *args, **kwargs):
+            outer = profiler._depth(kind, 1) == 1
+            t0 = time.perf_counter()
+            try:
+                return func(obj, *args, **kwargs)
+            finally:
+                profiler._depth(kind, -1)
+                if outer and profiler._current is not None:
+                    elapsed = time.perf_counter() - t0
+                    profiler._current[f'{kind}_s'] += elapsed
+                    root = obj
+                    while getattr(root, 'parent', None) is not None:
+                        root = root.parent
+                    stats = profiler._objects.setdefault(id(root), {'construct_s': 0., 'connect_s': 0.})
+                    stats[f'{kind}_s'] += elapsed
+
+        wrapper.__wrapped__ = func
+        return wrapper
+
+    def _patch_ophyd(self):
+        if self._patched or 'ophyd' not in sys.modules:
+            return
+        from ophyd import Device
+        from ophyd.signal import EpicsSignalBase
+
+        for cls, attr, kind in [(Device, '__init__', 'construct'),
+                                (EpicsSignalBase, '__init__', 'construct'),
+                                (Device, 'wait_for_connection', 'connect'),
+                                (EpicsSignalBase, 'wait_for_connection', 'connect'),
+                                (EpicsSignalBase, '_ensure_connected', 'connect')]:
+            if attr in vars(cls):
+                orig = vars(cls)[attr]
+                self._patched.append((cls, attr, orig))
+                setattr(cls, attr, self._timed(kind, orig))
+
+    def _execfile(self, fname, *args, **kwargs):
+        self._patch_ophyd()
+        user_ns = self.shell.user_ns
+        names_before = set(user_ns)
+        modules_before = len(sys.modules)
+        rss_before = _rss_bytes()
+        self._objects = {}
+        self._current = record = {'file': os.path.basename(fname), 'wall_s': 0., 'import_s': 0.,
+                                  'connect_s': 0., 'construct_s': 0.}
+        t0 = time.perf_counter()
+        failed = True
+        try:
+            result = self._safe_execfile(fname, *args, **kwargs)
+            failed = False
+            return result
+        finally:
+            record['wall_s'] = time.perf_counter() - t0
+            record['rss_delta_bytes'] = _rss_bytes() - rss_before
+            record['new_modules'] = len(sys.modules) - modules_before
+            record['objects'] = [
+                dict({'name': name, 'type': type(user_ns[name]).__name__},
+                     **self._objects.get(id(user_ns[name]), {}))
+                for name in sorted(set(user_ns) - names_before)
+                if not name.startswith('_')
+                and not callable(user_ns[name]) and not isinstance(user_ns[name], types.ModuleType)
+            ]
+            record['failed'] = failed
+            self._current = None
+            self.files.append(record)
+            # IPython skips the remaining startup files after an error, so the
+            # profiler must not stay installed for the session
+            if failed or record['file'] == self.last_file:
+                self.finish()
+
+    def finish(self):
+        self.uninstall()
+        report = {
+            'profile_version': _profile_version(self.startup_dir),
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': sys.version.split()[0],
+            'total_s': time.perf_counter() - self._t_start,
+            'files': self.files,
+        }
+        self.report_path.write_text(json.dumps(report, indent=1))
+        print_startup_profile(report)
+        print(f"Startup profile written to {self.report_path}")
+
+
+#*******************************************************************************************************
+def print_startup_profile(report, top=None):
+# prints the startup files sorted by wall time; report is a dict or a path to the JSON report
+    if not isinstance(report, dict):
+        report = json.loads(Path(report).read_text())
+    print(f"{'file':28s} {'wall (s)':>9s} {'import (s)':>10s} {'connect (s)':>11s} {'mem (MB)':>9s}")
+    for rec in sorted(report['files'], key=lambda r: -r['wall_s'])[:top]:
+        print(f"{rec['file']:28s} {rec['wall_s']:9.3f} {rec['import_s']:10.3f} "
+              f"{rec['connect_s']:11.3f} {rec['rss_delta_bytes']/2**20:9.1f}")
+    print(f"total {report['total_s']:.2f} s, profile version {report['profile_version'] or 'unknown'}")
+
+
+#*******************************************************************************************************
+def compare_startup_profiles(old, new):
+# prints the wall time change of every startup file between two JSON reports
+    old, new = (json.loads(Path(p).read_text()) for p in (old, new))
+    old_files = {rec['file']: rec for rec in old['files']}
+    print(f"{'file':28s} {'old (s)':>9s} {'new (s)':>9s} {'change (s)':>10s}")
+    for rec in sorted(new['files'], key=lambda r: -r['wall_s']):
+        before = old_files.get(rec['file'], {}).get('wall_s', 0.)
+        print(f"{rec['file']:28s} {before:9.3f} {rec['wall_s']:9.3f} {rec['wall_s'] - before:+10.3f}")
+    print(f"total {old['total_s']:.2f} s ({old['profile_version']}) -> "
+          f"{new['total_s']:.2f} s ({new['profile_version']})")
+
+
+_report = os.environ.get('IXS_STARTUP_PROFILE')
+if _report:
+    if _report == '1':
+        _report = Path(get_ipython().profile_dir.location) / time.strftime('startup_profile_%Y%m%d-%H%M%S.json')
+    startup_profiler = StartupProfiler(get_ipython(), _report)
+    startup_profiler.install()
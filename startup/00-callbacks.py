@@ -0,0 +1,137 @@
+import queue
+import threading
+import time
+import traceback
+
+# Document callbacks of the scans (PeakStats, MultiPeakStats, LivePlot, run_cache)
+# run on worker threads instead of inside RunEngine message processing. Each
+# wrapped callback gets its documents in order from its own queue; at the stop
+# document the RunEngine waits until the callback has processed the whole run,
+# so e.g. the peak statistics are complete when a plan reads them right after a
+# scan. Qt-aware callbacks (bec, and LivePlot with a Qt backend) only hand their
+# documents to the Qt main thread, so for them the wait does not cover drawing;
+# bec is therefore subscribed directly. print_callback_stats() shows the
+# per-callback latencies.
+
+# {callback name: statistics}, accumulated over all runs
+callback_stats = {}
+
+_EVENT_DOCS = ('event', 'event_page', 'bulk_events')
+
+
+def _callback_name(callback):
+    # LivePlot sets y only at the start document; ThrottledLivePlot keeps it as field
+    name = getattr(callback, '__name__', None) or type(callback).__name__
+    y = getattr(callback, 'field', None) or getattr(callback, 'y', None)
+    return f'{name}({y})' if isinstance(y, str) else name
+
+
+class ThreadedCallback:
+    """
+    Delivers documents to a callback on a worker thread, keeping their order.
+
+    Parameters
+    ----------
+    callback : callable
+        the document callback, called as callback(name, doc).
+    name : str, optional
+        key in callback_stats. The default is derived from the callback.
+    maxsize : int, optional
+        queue length. The default is 1000.
+    policy : {'block', 'drop'}, optional
+        what to do with event documents when the queue is full: 'block' makes
+        the RunEngine wait, 'drop' skips them (for plots). Other documents are
+        never dropped.
+    join_at_stop : bool, optional
+        wait at the stop document until the run is processed. The default is True.
+    """
+
+    def __init__(self, callback, name=None, maxsize=1000, policy='block', join_at_stop=True):
+        if policy not in ('block', 'drop'):
+            raise ValueError(f"policy must be 'block' or 'drop', not {policy!r}")
+        self.callback = callback
+        self.name = name or _callback_name(callback)
+        self.policy = policy
+        self.join_at_stop = join_at_stop
+        self.queue = queue.Queue(maxsize)
+        self.stats = callback_stats.setdefault(self.name, {
+            'documents': 0, 'dropped': 0, 'errors': 0, 'max_depth': 0,
+            'latency_sum_s': 0., 'latency_max_s': 0., 'busy_s': 0., 'stop_wait_max_s': 0.})
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._thread = None
+        self._error = None
+
+    def __call__(self, name, doc):
+        self._raise_error()
+        with self._lock:
+            self._pending += 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=f'ixs-cb-{self.name}', daemon=True)
+                self._thread.start()
+        item = (name, doc, time.monotonic())
+        if self.policy == 'drop' and name in _EVENT_DOCS:
+            try:
+                self.queue.put_nowait(item)
+            except queue.Full:
+                with self._lock:
+                    self._pending -= 1
+                self.stats['dropped'] += 1
+                return
+        else:
+            self.queue.put(item)
+        self.stats['max_depth'] = max(self.stats['max_depth'], self.queue.qsize())
+        if name == 'stop' and self.join_at_stop:
+            self.queue.join()
+            self.stats['stop_wait_max_s'] = max(self.stats['stop_wait_max_s'], time.monotonic() - item[2])
+            self._raise_error()
+
+    def _raise_error(self):
+        # exceptions of the callback are raised on the RunEngine thread, as without the worker
+        error, self._error = self._error, None
+        if error is not None:
+            raise error
+
+    def _run(self):
+        while True:
+            name, doc, t0 = self.queue.get()
+            t1 = time.monotonic()
+            try:
+                self.callback(name, doc)
+            except Exception as ex:
+                self.stats['errors'] += 1
+                self._error = ex
+                traceback.print_exc()
+            finally:
+                t2 = time.monotonic()
+                self.stats['documents'] += 1
+                self.stats['busy_s'] += t2 - t1
+                self.stats['latency_sum_s'] += t2 - t0
+                self.stats['latency_max_s'] = max(self.stats['latency_max_s'], t2 - t0)
+                self.queue.task_done()
+            with self._lock:
+                self._pending -= 1
+                # the worker ends with the run and is restarted by the next document
+                if name == 'stop' and self._pending == 0:
+                    self._thread = None
+                    return
+
+
+#*******************************************************************************************************
+def threaded(callbacks, policy='block'):
+# wraps a list of callbacks for bpp.subs_wrapper
+    return [cb if isinstance(cb, ThreadedCallback) else ThreadedCallback(cb, policy=policy) for cb in callbacks]
+
+
+#*******************************************************************************************************
+def print_callback_stats(reset=False):
+# prints documents, busy time and delivery latency of every threaded callback
+    print(f"{'callback':40s} {'docs':>6s} {'dropped':>7s} {'busy (s)':>9s} {'mean lat (ms)':>13s} "
+          f"{'max lat (ms)':>12s} {'max depth':>9s}")
+    for name, st in sorted(callback_stats.items()):
+        mean = st['latency_sum_s']/st['documents'] if st['documents'] else 0.
+        print(f"{name[:40]:40s} {st['documents']:6d} {st['dropped']:7d} {st['busy_s']:9.3f} "
+              f"{1e3*mean:13.1f} {1e3*st['latency_max_s']:12.1f} {st['max_depth']:9d}")
+    if reset:
+        for st in callback_stats.values():
+            st.update({k: type(v)() for k, v in st.items()})
@@ -0,0 +1,528 @@
+import copy
+import functools
+import os
+import threading
+import time
+
+import numpy as np
+from ophyd import Device, Component as Cpt, EpicsMotor, PVPositioner
+from ophyd.areadetector.base import EpicsSignalWithRBV
+from ophyd.areadetector.trigger_mixins import TriggerBase
+from ophyd.device import DynamicDeviceComponent
+from ophyd.signal import Signal, EpicsSignalBase, EpicsSignalRO
+from ophyd.sim import FakeEpicsSignal, FakeEpicsSignalRO, FakeEpicsSignalWithRBV
+
+# Offline simulation of the beamline. Start IPython with
+#
+#   IXS_SIM=1 ipython --profile=collection
+#
+# to load the same startup files with every EPICS device replaced by a local
+# stand-in: motors and PV positioners move at the velocities below, detectors
+# return peak-shaped responses computed from the current motor positions, and
+# a temporary databroker is used. Signals with the same PV share their value, so
+# e.g. dcm.th, dcmE.theta and blE.theta stay consistent.
+IXS_SIMULATION = os.environ.get('IXS_SIM', '0') not in ('', '0')
+
+# readback update period of simulated motions (s)
+SIM_UPDATE_PERIOD = 0.05
+# relative noise of the simulated detector responses
+SIM_NOISE = 0.01
+# counts per pixel and second of the simulated raw frames (image plugins, when enabled)
+SIM_FRAME_RATE = 1.
+
+# velocities (egu/s) by device or component name; the longest matching prefix wins
+SIM_VELOCITIES = {
+    '': 1.,
+    'dcm': 0.2, 'dcmE': 0.2, 'blE': 0.2,
+    'hrm2': 0.5, 'hrm2_uth': 0.02, 'hrm2_dth': 0.01, 'hrm2_uif': 100., 'hrm2_dif': 100.,
+    'hrm2_ux': 5., 'hrm2_dx': 5., 'hrmE': 20.,
+    'analyzer_cfth': 200., 'analyzer_cchi': 0.05, 'analyzer_wfth': 20.,
+    'anc_xtal': 50., 'spec': 2., 'ixs4c': 2., 's': 0.5, 'sp': 0.5,
+    'analyzer_slits': 0.5, 'mcmslits': 0.5, 's1': 0.5, 's2': 0.5, 's3': 0.5, 'ssa': 0.5,
+    'mcm': 0.05, 'whl': 5., 'anpd': 50., 'anapd': 20., 'ivu22': 20.,
+}
+
+# start values by signal name
+SIM_INITIAL = {
+    'sr_curr': 400.,
+    'srofb_uofb_pv': 2, 'srofb_id_bump_pv': 1, 'srofb_nudge_pv': 1,
+    'crl_y': 5.,
+    'ivu22_readback': 7262., 'ivu22_setpoint': 7262.,
+    'dcm_th': 12.47, 'hrm2_ux': -20., 'hrm2_dx': -20.,
+    'anc_xtal_uy': 1000., 'anc_xtal_dy': 1000.,
+    'analyzer_slits_top': 1., 'analyzer_slits_bottom': -1.,
+    'analyzer_slits_outboard': 1.5, 'analyzer_slits_inboard': -1.5,
+    'whl': 0., 'anpd': -90.,
+    'lambda_det_cam_acquire_time': 1., 'lambda_det_cam_acquire_period': 1., 'lambda_det_cam_num_images': 1,
+    'lambda_det_cam_array_size_array_size_x': 1556, 'lambda_det_cam_array_size_array_size_y': 516,
+    'lambda_det_image_array_size_width': 1556, 'lambda_det_image_array_size_height': 516,
+    'lambda_det_hdf5_file_path_exists': 1,
+    'cam1_cam_num_images': 1, 'cam2_cam_num_images': 1,
+    'cam1_stats1_max_value': 3500., 'cam1_stats1_centroid_x': 904., 'cam1_stats1_centroid_y': 387.,
+    'sclr_preset_time': 1.,
+}
+SIM_INITIAL.update({f'uratemperature_d{n}temp': 300. for n in range(1, 7)})
+for det in ('det1', 'det2', 'det3', 'det4', 'det5', 'tm1', 'tm2'):
+    SIM_INITIAL.update({f'{det}_averaging_time': 0.1, f'{det}_acquire_mode': 2, f'{det}_num_acquire': 1,
+                        f'{det}_ts_num_points': 2048, f'{det}_ts_averaging_time': 0.01})
+SIM_INITIAL['mcm_in_pos'] = [1]*6
+
+
+def _cfth_center(beam):
+    # the C crystal reflection moves by the change of its angle (urad)
+    return 40. + 1e6*np.deg2rad(beam.position('anc_xtal.the') - beam.start('anc_xtal.the'))
+
+
+def _dxtal_terms(n):
+    return [(2e3, [('hrmE.energy', 'peak', 1.2*(n - 3.5), 1.5),
+                   ('anc_xtal.y', 'peak', lambda beam: beam.start('anc_xtal.y') + 0.1*(n - 3.5) - 0.125, 0.25)])]
+
+
+# Detector responses by signal name: (background, [(amplitude, factors), ...]).
+# Every factor is (axis, shape, center, width) with shape 'peak' (gaussian,
+# width is the FWHM) or 'edge' (logistic step, negative width for a falling
+# edge); axis is a dotted name in the user namespace, center may be callable.
+# Area detector responses are rates and scale with the exposure time.
+SIM_RESPONSES = {
+    # dcm_setup, ugap_setup
+    'tm1_sum_all_mean_value': (1e-6, [(2e-4, [('dcm.p1', 'peak', 5., 40.), ('ivu22', 'peak', 7270., 80.)])]),
+    # hrm_setup
+    'det4_current2_mean_value': (2e3, [(5e5, [('hrm2.uth', 'peak', 0.004, 0.012)])]),
+    'det4_current3_mean_value': (2e3, [(4e5, [('hrm2.uif', 'peak', 12., 30.)])]),
+    'det4_current4_mean_value': (2e3, [(3e5, [('hrm2.dth', 'peak', 0.0015, 0.004)])]),
+    'det5_current1_mean_value': (2e3, [(2e5, [('hrm2.dif', 'peak', -8., 30.)])]),
+    # mcm_setup (direct beam, analyzer lowered), ccr_setup and san_setup (C crystal reflection)
+    'det2_current1_mean_value': (1e3, [
+        (5e5, [('anc_xtal.y', 'edge', 2., -0.2), ('mcm.x', 'peak', -0.03, 0.15)]),
+        (1e6, [('anc_xtal.y', 'peak', lambda beam: beam.start('anc_xtal.y') + 0.02, 0.15),
+               ('analyzer.cfth', 'peak', _cfth_center, 120.),
+               ('analyzer_slits.top', 'edge', 0.05, 0.02),
+               ('analyzer_slits.bottom', 'edge', -0.05, -0.02),
+               ('analyzer_slits.outboard', 'edge', 0.1, 0.03),
+               ('analyzer_slits.inboard', 'edge', -0.1, -0.03)])]),
+    'det2_current2_mean_value': (1e3, [(5e5, [('analyzer.cchi', 'peak', 0.03, 0.08)])]),
+    # check_zero, wcr_setup, Lipid_Qscan
+    'lambda_det_stats7_total': (5., [(1e4, [('hrmE.energy', 'peak', 1.3, 1.5),
+                                            ('analyzer.wfth', 'peak', 3., 12.),
+                                            ('sample_stage.sy', 'peak', lambda beam: beam.start('sample_stage.sy') + 0.02, 0.1),
+                                            ('sample_stage.sz', 'peak', lambda beam: beam.start('sample_stage.sz') + 0.5, 2.)])]),
+    'I0': (0., [(1e5, [])]),
+}
+# DxtalMesh, DxtalTempCalc
+SIM_RESPONSES.update({f'lambda_det_stats{n}_total': (2., _dxtal_terms(n)) for n in range(1, 7)})
+
+
+class SimBeamline:
+    """
+    Computes the simulated detector responses from the motor positions.
+    """
+
+    def __init__(self, seed=None):
+        self.devices = []
+        self.rng = np.random.default_rng(seed)
+        self._start = {}
+
+    def position(self, axis):
+        obj = get_ipython().user_ns.get(axis.split('.')[0])
+        try:
+            obj = functools.reduce(getattr, axis.split('.')[1:], obj)
+            return float(obj.position)
+        except (AttributeError, TypeError, ValueError):
+            return None
+
+    def start(self, axis):
+        # position of the axis the first time it was used by the model
+        if self._start.get(axis) is None:
+            self._start[axis] = self.position(axis)
+        return self._start[axis] or 0.
+
+    def response(self, field, scale=None):
+        background, terms = SIM_RESPONSES[field]
+        value = background
+        for amplitude, factors in terms:
+            for axis, shape, center, width in factors:
+                pos = self.position(axis)
+                if pos is None:
+                    continue
+                center = center(self) if callable(center) else center
+                if shape == 'peak':
+                    amplitude *= np.exp(-4*np.log(2)*((pos - center)/width)**2)
+                else:
+                    amplitude /= 1 + np.exp(np.clip(-(pos - center)/width, -50, 50))
+            value += amplitude
+        if scale is not None:
+            return float(self.rng.poisson(value*scale))
+        return value*(1 + SIM_NOISE*self.rng.standard_normal())
+
+    def register(self, device):
+        self.devices.append(device)
+        device._sim_refresh()
+
+    def refresh(self):
+        for device in self.devices:
+            device._sim_refresh()
+
+
+sim_beam = SimBeamline(os.environ.get('IXS_SIM_SEED') and int(os.environ['IXS_SIM_SEED']))
+
+
+#*******************************************************************************************************
+# Simulated signals: fake EPICS signals which share their value with every
+# other simulated signal of the same PV.
+_sim_pvs = {}
+
+
+def _sim_set(sig, value):
+    if hasattr(sig, 'sim_put'):
+        sig.sim_put(value)
+    else:
+        sig.put(value, force=True)
+
+
+class _SimPVMixin:
+    def __init__(self, read_pv, *args, **kwargs):
+        super().__init__(read_pv, *args, **kwargs)
+        self._sim_pv = read_pv
+        peers = _sim_pvs.setdefault(read_pv, [])
+        if peers:
+            self._readback = peers[0]._readback
+        peers.append(self)
+
+    @property
+    def pvname(self):
+        return self._sim_pv
+
+    def put(self, *args, **kwargs):
+        ret = super().put(*args, **kwargs)
+        self._sim_share()
+        return ret
+
+    def sim_put(self, *args, **kwargs):
+        ret = super().sim_put(*args, **kwargs)
+        self._sim_share()
+        return ret
+
+    def _sim_share(self):
+        for peer in _sim_pvs[self._sim_pv]:
+            if peer is not self:
+                Signal.put(peer, self._readback, force=True)
+
+
+class SimEpicsSignal(_SimPVMixin, FakeEpicsSignal):
+    ...
+
+
+class SimEpicsSignalRO(_SimPVMixin, FakeEpicsSignalRO):
+    ...
+
+
+class SimEpicsSignalWithRBV(_SimPVMixin, FakeEpicsSignalWithRBV):
+    ...
+
+
+#*******************************************************************************************************
+# Simulated devices
+
+def _sim_velocity(name):
+    key = max((k for k in SIM_VELOCITIES if not k or name == k or name.startswith(k + '_')), key=len)
+    return SIM_VELOCITIES[key]
+
+
+class SimDeviceMixin:
+    # start values, detector responses and registration with the beam model
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._sim_signals = [walk.item for walk in self.walk_signals(include_lazy=True)]
+        for sig in self._sim_signals:
+            if sig.name in SIM_INITIAL:
+                _sim_set(sig, SIM_INITIAL[sig.name])
+        if self.parent is None:
+            sim_beam.register(self)
+
+    def _sim_refresh(self, scale=None):
+        # signals are matched by their current name, some are renamed after creation
+        for sig in self._sim_signals:
+            if sig.name in SIM_RESPONSES:
+                _sim_set(sig, sim_beam.response(sig.name, scale))
+
+    def trigger(self):
+        self._sim_refresh()
+        return super().trigger()
+
+
+class SimMotorMixin:
+    # EpicsMotor moving at its velocity once user_setpoint changes
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._sim_generation = 0
+        _sim_set(self.velocity, _sim_velocity(self.name))
+        _sim_set(self.acceleration, 0.2)
+        _sim_set(self.user_setpoint, self.user_readback.get())
+        _sim_set(self.motor_is_moving, 0)
+        _sim_set(self.motor_done_move, 1)
+        self.user_setpoint.subscribe(self._sim_setpoint_changed, run=False)
+        self.motor_stop.subscribe(self._sim_stop, run=False)
+
+    def _sim_setpoint_changed(self, value, **kwargs):
+        if self.set_use_switch.get() == 1:
+            _sim_set(self.user_readback, value)
+            return
+        self._sim_generation += 1
+        threading.Thread(target=self._sim_move, args=(value, self._sim_generation), daemon=True).start()
+
+    def _sim_stop(self, value, **kwargs):
+        if value:
+            self._sim_generation += 1
+            _sim_set(self.motor_is_moving, 0)
+            _sim_set(self.motor_done_move, 1)
+
+    def _sim_move(self, target, generation):
+        start = self.user_readback.get()
+        duration = (self.acceleration.get() or 0.) + abs(target - start)/(abs(self.velocity.get()) or 1.)
+        _sim_set(self.motor_is_moving, 1)
+        _sim_set(self.motor_done_move, 0)
+        t0 = time.monotonic()
+        while generation == self._sim_generation:
+            frac = min(1., (time.monotonic() - t0)/duration) if duration else 1.
+            _sim_set(self.user_readback, start + frac*(target - start))
+            if frac >= 1.:
+                _sim_set(self.motor_is_moving, 0)
+                _sim_set(self.motor_done_move, 1)
+                sim_beam.refresh()
+                return
+            time.sleep(SIM_UPDATE_PERIOD)
+
+
+class SimPVPositionerMixin:
+    # PVPositioner whose readback follows the setpoint after actuation
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._sim_generation = 0
+        if self.done is not None and not isinstance(self.done.get(), (list, tuple, np.ndarray)):
+            _sim_set(self.done, self.done_value)
+        if self.readback is not None and self.setpoint is not None:
+            _sim_set(self.setpoint, self.readback.get())
+
+    def _sim_done(self, value):
+        # coupled axes (MCM) report through the InPos array of their parent
+        in_pos = getattr(self.parent, 'in_pos', None)
+        if in_pos is not None:
+            _sim_set(in_pos, [int(value)]*len(in_pos.get()))
+            return
+        if isinstance(self.done.get(), (list, tuple, np.ndarray)):
+            value = [value]*len(self.done.get())
+        _sim_set(self.done, value)
+
+    def _setup_move(self, position):
+        super()._setup_move(position)
+        self._sim_generation += 1
+        threading.Thread(target=self._sim_move, args=(position, self._sim_generation), daemon=True).start()
+
+    def _sim_move(self, target, generation):
+        start = self.readback.get() if self.readback is not None else target
+        duration = abs(target - start)/_sim_velocity(self.name)
+        if self.done is not None:
+            self._sim_done(not self.done_value if isinstance(self.done_value, bool) else int(not self.done_value))
+        t0 = time.monotonic()
+        while generation == self._sim_generation:
+            frac = min(1., (time.monotonic() - t0)/duration) if duration else 1.
+            if self.readback is not None:
+                _sim_set(self.readback, start + frac*(target - start))
+            if frac >= 1.:
+                if self.done is not None:
+                    self._sim_done(self.done_value)
+                sim_beam.refresh()
+                return
+            time.sleep(SIM_UPDATE_PERIOD)
+
+
+class SimMCMMixin:
+    # grouped moves of the MCM hexapod (10-optics.py): InPos leaves and returns to 'all in position'
+
+    def set(self, positions):
+        status = super().set(positions)
+        if not status.done:
+            threading.Thread(target=self._sim_group_move, daemon=True).start()
+        return status
+
+    def _sim_group_move(self):
+        n = len(self.in_pos.get())
+        _sim_set(self.in_pos, [0]*n)
+        time.sleep(SIM_UPDATE_PERIOD)
+        _sim_set(self.in_pos, [1]*n)
+        sim_beam.refresh()
+
+
+class SimTriggerMixin:
+    # area detectors and electrometers: acquisition ends after the exposure time
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._acquisition_signal.subscribe(self._sim_acquire_changed, run=False)
+
+    def _sim_refresh(self, scale=None):
+        super()._sim_refresh(scale)
+        image = getattr(self, 'image', None)
+        if image is not None and image.enable.get():
+            npix = image.array_size.height.get()*image.array_size.width.get()
+            _sim_set(image.array_data, sim_beam.rng.poisson(SIM_FRAME_RATE*(scale or 1.), npix))
+
+    def _sim_exposure(self):
+        # (exposure, counting): area detectors count, electrometers average
+        for attr, counting in (('cam.acquire_time', True), ('averaging_time', False)):
+            try:
+                return float(functools.reduce(getattr, attr.split('.'), self).get() or 0.), counting
+            except AttributeError:
+                pass
+        return 0., False
+
+    def _sim_frames(self):
+        # frames of one acquisition: single, multiple (num_images) or continuous image mode;
+        # the quadEM acquire modes are continuous (0), multiple (num_acquire) and single (2)
+        try:
+            mode, num = self.cam.image_mode.get(), self.cam.num_images.get()
+        except AttributeError:
+            try:
+                mode, num = self.acquire_mode.get(), self.num_acquire.get()
+            except AttributeError:
+                return 1
+            return float('inf') if mode == 0 else max(1, num) if mode == 1 else 1
+        return 1 if mode == 0 else max(1, num) if mode == 1 else float('inf')
+
+    def _sim_acquire_changed(self, value=None, old_value=None, **kwargs):
+        if value == 1 and old_value != 1:
+            exposure, counting = self._sim_exposure()
+            threading.Thread(target=self._sim_acquire, args=(exposure, counting, self._sim_frames()),
+                             daemon=True).start()
+
+    def _sim_acquire(self, exposure, counting, frames):
+        n = 0
+        while n < frames:
+            time.sleep(exposure)
+            if self._acquisition_signal.get() != 1:
+                return
+            self._sim_refresh(exposure if counting else None)
+            # the cam and its plugins count every frame
+            for sig in self._sim_signals:
+                if sig.attr_name == 'array_counter':
+                    _sim_set(sig, (sig.get() or 0) + 1)
+            n += 1
+        _sim_set(self._acquisition_signal, 0)
+
+    def trigger(self):
+        return super(SimDeviceMixin, self).trigger()
+
+
+class SimTimeSeriesMixin:
+    # quadEM time-series plugin (95-detectors.py) sampling the responses of the parent's
+    # mean values (e.g. tm1_current1_mean_value) every averaging_time
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._sim_buffers = {ch: [] for ch in self.channels}
+        self.acquire.subscribe(self._sim_acquire_changed, run=False)
+        self.read_buffers.subscribe(self._sim_read, run=False)
+
+    def _sim_acquire_changed(self, value=None, old_value=None, **kwargs):
+        if value == 1 and old_value != 1:
+            threading.Thread(target=self._sim_acquire, daemon=True).start()
+
+    def _sim_acquire(self):
+        period = self.averaging_time.get() or SIM_UPDATE_PERIOD
+        num = int(self.num_points.get())
+        _sim_set(self.time_per_point, period)
+        self._sim_buffers = {ch: [] for ch in self.channels}
+        _sim_set(self.acquiring, 1)
+        n = 0
+        while n < num and self.acquire.get() == 1:
+            time.sleep(period)
+            values = {}
+            for ch in self.channels:
+                field = f'{self.parent.name}_{ch}_mean_value'
+                values[ch] = sim_beam.response(field) if field in SIM_RESPONSES else 0.
+            if f'{self.parent.name}_sum_all_mean_value' not in SIM_RESPONSES:
+                values['sum_all'] = sum(values[ch] for ch in self.channels[:4])
+            for ch, val in values.items():
+                self._sim_buffers[ch].append(val)
+            n += 1
+            _sim_set(self.current_point, n)
+        _sim_set(self.acquiring, 0)
+        _sim_set(self.acquire, 0)
+
+    def _sim_read(self, value=None, **kwargs):
+        if value:
+            num = int(self.num_points.get())
+            for ch, buf in self._sim_buffers.items():
+                _sim_set(getattr(self, ch), np.pad(np.asarray(buf, dtype=float), (0, max(0, num - len(buf)))))
+
+
+# (base class, mixin); classes of later startup files are given by name
+_SIM_MIXINS = [(EpicsMotor, SimMotorMixin), (PVPositioner, SimPVPositionerMixin), (TriggerBase, SimTriggerMixin),
+               ('MCM', SimMCMMixin), ('QuadEMTimeSeries', SimTimeSeriesMixin)]
+_sim_classes = {}
+
+
+def _sim_is_subclass(cls, base):
+    if isinstance(base, str):
+        return any(c.__name__ == base for c in cls.__mro__)
+    return issubclass(cls, base)
+
+
+def _sim_signal_class(cls):
+    if not issubclass(cls, EpicsSignalBase):
+        return cls
+    if issubclass(cls, EpicsSignalWithRBV):
+        return SimEpicsSignalWithRBV
+    if issubclass(cls, EpicsSignalRO):
+        return SimEpicsSignalRO
+    return SimEpicsSignal
+
+
+#*******************************************************************************************************
+def make_sim_device(cls):
+    """
+    Returns the simulated counterpart of an ophyd device or signal class.
+
+    Like ophyd.sim.make_fake_device, all EPICS signals of the class and its
+    components are replaced by simulated signals; motors, PV positioners and
+    triggered detectors also get their simulated behaviour.
+    """
+
+    if cls in _sim_classes:
+        return _sim_classes[cls]
+    if not issubclass(cls, Device):
+        return _sim_classes.setdefault(cls, _sim_signal_class(cls))
+
+    body = {'_ixs_sim': True}
+    for cpt_name in cls.component_names:
+        cpt = getattr(cls, cpt_name)
+        if isinstance(cpt, DynamicDeviceComponent):
+            sim_cpt = Cpt(cpt.cls, suffix=cpt.suffix, lazy=cpt.lazy, trigger_value=cpt.trigger_value,
+                          kind=cpt.kind, add_prefix=cpt.add_prefix, doc=cpt.doc, **cpt.kwargs)
+        else:
+            sim_cpt = copy.copy(cpt)
+        sim_cpt.cls = make_sim_device(cpt.cls)
+        body[cpt_name] = sim_cpt
+    mixins = tuple(mixin for base, mixin in _SIM_MIXINS if _sim_is_subclass(cls, base))
+    _sim_classes[cls] = type(f'Sim{cls.__name__}', mixins + (SimDeviceMixin, cls), body)
+    return _sim_classes[cls]
+
+
+def _sim_device_new(cls, *args, **kwargs):
+    if not cls.__dict__.get('_ixs_sim', False):
+        cls = make_sim_device(cls)
+    return object.__new__(cls)
+
+
+def _sim_signal_new(cls, *args, **kwargs):
+    # the simulated signal is not an EpicsSignalBase, so __init__ is called here
+    return _sim_signal_class(cls)(*args, **kwargs)
+
+
+if IXS_SIMULATION:
+    Device.__new__ = staticmethod(_sim_device_new)
+    EpicsSignalBase.__new__ = staticmethod(_sim_signal_new)
+    print('*** IXS simulation mode: no EPICS devices are used ***')
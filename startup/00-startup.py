@@ -4,13 +4,29 @@ EpicsSignalBase.set_defaults(timeout=10, connection_timeout=10)  # new style
 
 import nslsii
 
+if IXS_SIMULATION:
+    # offline: runs go to a temporary broker instead of the beamline database
+    from databroker import temp as _temp_broker
+    _broker = _temp_broker()
+else:
+    _broker = 'ixs'
+
 nslsii.configure_base(
     get_ipython().user_ns,
-    'ixs',
+    _broker,
+    bec=False,
     publish_documents_with_kafka=False,
     call_returns_result=True
 )
 
+# the BestEffortCallback already hands its documents to the Qt main thread,
+# so it is not wrapped in a ThreadedCallback (00-callbacks.py)
+from bluesky.callbacks.best_effort import BestEffortCallback
+
+bec = BestEffortCallback()
+peaks = bec.peaks
+RE.subscribe(bec)
+
 # After the above call, you will now have the following in your namespace:
 #
 # 	RE : RunEngine
@@ -75,22 +91,138 @@ def relabel_motors():
         attr.name = mtr.name
 
 # ## Live specfile exporting
+import queue
+import threading
 import time
+import traceback
 from event_model import RunRouter
 from suitcase.specfile import Serializer
+from suitcase.utils import MultiFileManager
+
+
+class SpecFileManager(MultiFileManager):
+    # suitcase file manager of one run which can flush its open files
+    def __init__(self, directory):
+        super().__init__(directory, allowed_modes=('a',))
+        self._handles = []
+
+    def open(self, *args, **kwargs):
+        f = super().open(*args, **kwargs)
+        self._handles.append(f)
+        return f
+
+    def flush(self):
+        for f in self._handles:
+            if not f.closed:
+                f.flush()
+
+
+class SpecWriter:
+    """
+    Writes the live SPEC files on a background thread.
+
+    Documents are queued (the queue is bounded, a full queue makes the
+    RunEngine wait) and written in order; the files are flushed every
+    flush_interval seconds or flush_events documents. The stop document
+    is only returned once the run is written, flushed and closed, so the file
+    is complete when the run ends.
+    """
+
+    def __init__(self, maxsize=1000, flush_interval=1., flush_events=50):
+        self.queue = queue.Queue(maxsize)
+        self.flush_interval = flush_interval
+        self.flush_events = flush_events
+        self._thread = None
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.stats = {'documents': 0, 'flushes': 0, 'errors': 0, 'max_depth': 0,
+                      'latency_sum_s': 0., 'latency_max_s': 0., 'stop_wait_max_s': 0.}
+
+    def callback(self, serializer, manager):
+        # returns the callback which writes through serializer; manager (SpecFileManager) flushes its files
+        def write(name, doc):
+            self.submit(serializer, manager, name, doc)
+        return write
+
+    def submit(self, serializer, manager, name, doc):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='ixs-spec-writer', daemon=True)
+            self._thread.start()
+        written = threading.Event() if name == 'stop' else None
+        t0 = time.monotonic()
+        self.queue.put((serializer, manager, name, doc, t0, written))
+        self.stats['max_depth'] = max(self.stats['max_depth'], self.queue.qsize())
+        if written is not None:
+            written.wait()
+            self.stats['stop_wait_max_s'] = max(self.stats['stop_wait_max_s'], time.monotonic() - t0)
+
+    def _flush(self, manager):
+        manager.flush()
+        self.stats['flushes'] += 1
+
+    def _run(self):
+        pending = {}
+        last_flush = time.monotonic()
+        while True:
+            try:
+                serializer, manager, name, doc, t0, written = self.queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                serializer = None
+            if serializer is not None:
+                try:
+                    serializer(name, doc)
+                    if name == 'stop':
+                        pending.pop(manager, None)
+                        self._flush(manager)
+                        serializer.close()
+                    else:
+                        pending[manager] = pending.get(manager, 0) + 1
+                except Exception:
+                    self.stats['errors'] += 1
+                    print(f"SPEC export failed on the {name} document:")
+                    traceback.print_exc()
+                finally:
+                    latency = time.monotonic() - t0
+                    self.stats['documents'] += 1
+                    self.stats['latency_sum_s'] += latency
+                    self.stats['latency_max_s'] = max(self.stats['latency_max_s'], latency)
+                    if written is not None:
+                        written.set()
+            now = time.monotonic()
+            if pending and (now - last_flush >= self.flush_interval or max(pending.values()) >= self.flush_events):
+                for manager in pending:
+                    self._flush(manager)
+                pending.clear()
+                last_flush = now
+
+    def print_stats(self):
+        st = self.stats
+        mean = st['latency_sum_s']/st['documents'] if st['documents'] else 0.
+        print(f"SPEC writer: {st['documents']} documents, {st['flushes']} flushes, {st['errors']} errors")
+        print(f"queue depth now {self.queue.qsize()}, max {st['max_depth']} of {self.queue.maxsize}")
+        print(f"write latency mean {1e3*mean:.1f} ms, max {1e3*st['latency_max_s']:.1f} ms; "
+              f"max wait at stop {1e3*st['stop_wait_max_s']:.1f} ms")
+
+
+spec_writer = SpecWriter()
 
 
 def spec_factory(name, doc):
     if not spec_factory.enabled:
         return [], []
-    directory = "/nsls2/data/ixs/legacy/specfiles/"
-
-    spec_cb = Serializer(directory, file_prefix=spec_factory.prefix, flush=True)
-    return [spec_cb], []
+    manager = SpecFileManager(spec_factory.directory)
+    spec_cb = Serializer(manager, file_prefix=spec_factory.prefix, flush=False)
+    return [spec_writer.callback(spec_cb, manager)], []
 
 
 spec_factory.enabled = True
+spec_factory.directory = "/nsls2/data/ixs/legacy/specfiles/"
+if IXS_SIMULATION:
+    import tempfile
+    spec_factory.directory = tempfile.mkdtemp(prefix='ixs_sim_spec_')
 spec_factory.prefix = "spec_test"
 
+# spec_writer already writes on its own thread, so the router is not a ThreadedCallback
 spec_router = RunRouter([spec_factory])
 RE.subscribe(spec_router)
@@ -0,0 +1,147 @@
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from ophyd import Device
+from ophyd.signal import EpicsSignalBase
+
+
+# Devices which did not connect during connect_all_devices(), keyed by their
+# name in the user namespace. They keep reconnecting in a background thread.
+degraded_devices = OrderedDict()
+
+# Actions that need a live connection (e.g. configuration puts) are deferred
+# with on_connect() until the device is connected.
+_connect_hooks = {}
+_connected_ids = set()
+
+
+#*******************************************************************************************************
+def on_connect(obj, func, *args, **kwargs):
+# runs func(*args, **kwargs) once obj is connected, or right away if it already is
+    if id(obj) in _connected_ids:
+        func(*args, **kwargs)
+    else:
+        _connect_hooks.setdefault(id(obj), []).append(partial(func, *args, **kwargs))
+
+
+def _run_connect_hooks(obj):
+    _connected_ids.add(id(obj))
+    for hook in _connect_hooks.pop(id(obj), []):
+        try:
+            hook()
+        except Exception as ex:
+            print(f"Deferred setup of {obj.name} failed: {ex}")
+
+
+#*******************************************************************************************************
+def _ioc_key(obj):
+# groups PVs by IOC, i.e. 'XF:10IDA-OP{Mono:DCM-Ax:P}Mtr' -> 'XF:10IDA-OP{Mono:DCM'
+    pvname = getattr(obj, 'pvname', None)
+    if isinstance(obj, Device):
+        pvname = next((w.item.pvname for w in obj.walk_signals()
+                       if getattr(w.item, 'pvname', None)), obj.prefix)
+    if not pvname:
+        return '(soft)'
+    if '{' in pvname:
+        return pvname.split('}')[0].split('-Ax:')[0]
+    # 'XF:10ID-BI:TM176:...' and 'XF10ID-BI:AH171:...'
+    parts = pvname.rstrip(':').split(':')
+    return ':'.join(parts[:3 if parts[0].isalpha() else 2])
+
+
+def _startup_devices(user_ns):
+# top-level ophyd devices and EPICS signals created by the startup files
+    devices = OrderedDict()
+    seen = set()
+    for name, obj in list(user_ns.items()):
+        if name.startswith('_') or not isinstance(obj, (Device, EpicsSignalBase)):
+            continue
+        if obj.parent is not None or id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        devices[name] = obj
+    return devices
+
+
+def _wait_connected(obj, timeout):
+    t0 = time.monotonic()
+    try:
+        obj.wait_for_connection(timeout=timeout)
+    except Exception as ex:
+        return False, time.monotonic() - t0, ex
+    return True, time.monotonic() - t0, None
+
+
+def _reconnect_degraded(interval):
+    while degraded_devices:
+        for name, obj in list(degraded_devices.items()):
+            ok, _, _ = _wait_connected(obj, interval)
+            if ok:
+                degraded_devices.pop(name, None)
+                print(f"\n{name} is connected again")
+                _run_connect_hooks(obj)
+        time.sleep(interval)
+
+
+#*******************************************************************************************************
+def connect_all_devices(timeout=None, verbose=True):
+    """
+    Connects every ophyd device of the profile in one concurrent batch.
+
+    All devices share the same deadline, so the stage takes as long as the
+    slowest IOC instead of the sum of all connection timeouts. Devices that
+    fail are listed in ``degraded_devices`` and reconnect in the background.
+
+    Parameters
+    ----------
+    timeout : float, optional
+        connection deadline in seconds, default connect_all_devices.timeout
+    verbose : bool, optional
+        print the per-IOC connection table
+
+    Returns
+    -------
+    dict
+        per-IOC report {ioc: {'connected': [...], 'missing': [...], 'time': s}}
+    """
+
+    timeout = connect_all_devices.timeout if timeout is None else timeout
+    devices = _startup_devices(get_ipython().user_ns)
+
+    t0 = time.monotonic()
+    with ThreadPoolExecutor(max_workers=min(32, max(1, len(devices)))) as pool:
+        results = dict(zip(devices, pool.map(lambda obj: _wait_connected(obj, timeout), devices.values())))
+    total = time.monotonic() - t0
+
+    report = OrderedDict()
+    for name, (ok, elapsed, _) in results.items():
+        obj = devices[name]
+        entry = report.setdefault(_ioc_key(obj), {'connected': [], 'missing': [], 'time': 0.})
+        entry['time'] = max(entry['time'], elapsed)
+        if ok:
+            entry['connected'].append(name)
+            degraded_devices.pop(name, None)
+            _run_connect_hooks(obj)
+        else:
+            entry['missing'].append(name)
+            degraded_devices[name] = obj
+
+    if verbose:
+        print(f"{'IOC':40s} {'connected':>9s} {'missing':>7s} {'time (s)':>8s}")
+        for ioc, entry in sorted(report.items(), key=lambda item: -item[1]['time']):
+            print(f"{ioc:40s} {len(entry['connected']):9d} {len(entry['missing']):7d} {entry['time']:8.2f}")
+        print(f"{len(devices)} devices in {total:.2f} s")
+        if degraded_devices:
+            print('Degraded (reconnecting in background): ' + ', '.join(degraded_devices))
+
+    if degraded_devices and not any(t.name == 'ixs-reconnect' for t in threading.enumerate()):
+        threading.Thread(target=_reconnect_degraded, args=(connect_all_devices.retry_interval,),
+                         name='ixs-reconnect', daemon=True).start()
+    return report
+
+
+connect_all_devices.timeout = 10
+connect_all_devices.retry_interval = 30
@@ -0,0 +1,153 @@
+import importlib
+import os
+import statistics
+import subprocess
+import sys
+import time
+import types
+
+# Heavy analysis libraries (lmfit, pandas, scipy.interpolate, tabulate, hkl,
+# pyRestTable) are only needed by a few plans and helpers, so they are imported
+# the first time they are used. Set IXS_LAZY_IMPORTS=0 to import everything at
+# startup as before, e.g. to compare startup times with bench_startup().
+_LAZY_IMPORTS = os.environ.get('IXS_LAZY_IMPORTS', '1') != '0'
+_lazy_modules = {}
+
+
+class LazyModule(types.ModuleType):
+    """
+    Stand-in for a module which is imported on first attribute access.
+    """
+
+    def __init__(self, name):
+        super().__init__(name)
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        if self.__dict__['_module'] is None:
+            self.__dict__['_module'] = importlib.import_module(self.__name__)
+        return self.__dict__['_module']
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        state = 'loaded' if self.__dict__['_module'] is not None else 'not loaded yet'
+        return f"<lazy module '{self.__name__}' ({state})>"
+
+
+class LazyObject:
+    """
+    Proxy for an object which is only built, by calling factory(), when used.
+    """
+
+    def __init__(self, factory):
+        object.__setattr__(self, '_factory', factory)
+        object.__setattr__(self, '_target', None)
+        if not _LAZY_IMPORTS:
+            self._resolve()
+
+    def _resolve(self):
+        if self._target is None:
+            object.__setattr__(self, '_target', self._factory())
+        return self._target
+
+    def __getattr__(self, attr):
+        return getattr(self._resolve(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._resolve(), attr, value)
+
+    def __call__(self, *args, **kwargs):
+        return self._resolve()(*args, **kwargs)
+
+    def __dir__(self):
+        return dir(self._resolve())
+
+    def __repr__(self):
+        if self._target is None:
+            return f"<not built yet: {getattr(self._factory, '__name__', 'object')}>"
+        return repr(self._target)
+
+
+#*******************************************************************************************************
+def lazy_import(name):
+# returns module `name`, imported on first use (or right away if it is already loaded)
+    if name in sys.modules or not _LAZY_IMPORTS:
+        return importlib.import_module(name)
+    return _lazy_modules.setdefault(name, LazyModule(name))
+
+
+#*******************************************************************************************************
+def lazy_function(module, name):
+# returns a stand-in for module.name which imports the module on the first call
+    def stand_in(*args, **kwargs):
+        args = [a._resolve() if isinstance(a, LazyObject) else a for a in args]
+        return getattr(importlib.import_module(module), name)(*args, **kwargs)
+
+    if not _LAZY_IMPORTS:
+        return getattr(importlib.import_module(module), name)
+    stand_in.__name__ = stand_in.__qualname__ = name
+    stand_in.__doc__ = f"{module}.{name}, imported on the first call."
+    return stand_in
+
+
+#*******************************************************************************************************
+def bench_lazy_imports(modules=('lmfit', 'pandas', 'scipy.interpolate', 'tabulate', 'hkl', 'pyRestTable'),
+                       repeat=3):
+    """
+    Measures the cold import time of the lazily loaded modules.
+
+    Every import runs in a fresh interpreter, so the numbers are what an eager
+    import would add to the profile startup.
+
+    Returns
+    -------
+    dict
+        {module: best import time in seconds}
+    """
+
+    code = "import time, importlib; t = time.perf_counter(); importlib.import_module('{}'); print(time.perf_counter() - t)"
+    results = {}
+    for module in modules:
+        times = []
+        for _ in range(repeat):
+            proc = subprocess.run([sys.executable, '-c', code.format(module)], capture_output=True, text=True)
+            if proc.returncode == 0:
+                times.append(float(proc.stdout.split()[-1]))
+        results[module] = min(times) if times else None
+        print(f"{module:20s} {'not importable' if not times else f'{min(times):8.3f} s'}")
+    print(f"deferred at startup: {sum(t for t in results.values() if t):.2f} s")
+    return results
+
+
+#*******************************************************************************************************
+def bench_startup(repeat=3):
+    """
+    Compares the time to the first IPython prompt with eager and lazy imports.
+
+    Starts this profile ``repeat`` times in each mode with IXS_LAZY_IMPORTS
+    set to 0 and 1 and runs ``exit()`` as soon as the prompt would appear.
+
+    Returns
+    -------
+    dict
+        {'eager': [s, ...], 'lazy': [s, ...]}
+    """
+
+    profile_dir = get_ipython().profile_dir.location
+    results = {}
+    for mode, flag in (('eager', '0'), ('lazy', '1')):
+        env = dict(os.environ, IXS_LAZY_IMPORTS=flag)
+        results[mode] = []
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            subprocess.run([sys.executable, '-m', 'IPython', f'--profile-dir={profile_dir}', '--no-banner',
+                            '-c', 'exit()'], env=env, capture_output=True)
+            results[mode].append(time.perf_counter() - t0)
+        print(f"{mode:6s} min {min(results[mode]):7.2f} s   mean {statistics.mean(results[mode]):7.2f} s")
+    print(f"lazy imports save {min(results['eager']) - min(results['lazy']):.2f} s to the first prompt")
+    return results
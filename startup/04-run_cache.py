@@ -0,0 +1,146 @@
+import collections
+import threading
+
+import numpy as np
+
+pd = lazy_import('pandas')
+
+# In-memory cache of the primary stream of the last runs. The analysis helpers
+# (calculate_max_value, calc_lmfit, calc_stepup_fit, ...) read their tables
+# through run_cache.table(uid), which only asks databroker on a miss.
+
+
+class RunCache:
+    """
+    Keeps the primary stream of recent runs as NumPy columns.
+
+    Runs are collected from the RunEngine documents and also filled from
+    databroker on a miss; the least recently used runs are dropped once
+    there are more than max_runs or they take more than max_bytes. Only
+    scalar fields are kept (no images or waveforms).
+
+    Runs are looked up like ``db[...]``: a negative number counts back from
+    the last run of this session, a positive number is a scan_id and a
+    string is a uid or the beginning of one.
+    """
+
+    def __init__(self, max_runs=50, max_bytes=256*2**20):
+        self.max_runs = max_runs
+        self.max_bytes = max_bytes
+        self.hits = self.misses = 0
+        self._runs = collections.OrderedDict()
+        self._recent = collections.deque(maxlen=1000)
+        self._active = {}
+        self._descriptors = {}
+        self._lock = threading.Lock()
+
+    # --- RunEngine callback
+    def __call__(self, name, doc):
+        if name == 'start':
+            self._active[doc['uid']] = {'start': doc, 'rows': collections.defaultdict(list)}
+            self._recent.append(doc['uid'])
+        elif name == 'descriptor':
+            if doc.get('name') == 'primary' and doc['run_start'] in self._active:
+                self._descriptors[doc['uid']] = doc['run_start']
+        elif name == 'event':
+            self._add_rows(doc['descriptor'], [doc['seq_num']], [doc['time']],
+                           {k: [v] for k, v in doc['data'].items()})
+        elif name == 'event_page':
+            self._add_rows(doc['descriptor'], doc['seq_num'], doc['time'], doc['data'])
+        elif name == 'stop':
+            run = self._active.pop(doc['run_start'], None)
+            self._descriptors = {k: v for k, v in self._descriptors.items() if v != doc['run_start']}
+            if run is not None:
+                self._store(run['start'], self._to_columns(run['rows']))
+
+    def _add_rows(self, descriptor, seq_num, times, data):
+        run_uid = self._descriptors.get(descriptor)
+        if run_uid is None:
+            return
+        rows = self._active[run_uid]['rows']
+        rows['seq_num'].extend(seq_num)
+        rows['time'].extend(times)
+        for key, values in data.items():
+            rows[key].extend(values)
+
+    @staticmethod
+    def _to_columns(rows):
+        columns = {}
+        n = len(rows.get('seq_num', ()))
+        for key, values in rows.items():
+            if len(values) != n:
+                continue
+            arr = np.asarray(values)
+            if arr.ndim == 1:
+                columns[key] = arr
+        return columns
+
+    def _store(self, start, columns):
+        with self._lock:
+            self._runs[start['uid']] = {'start': start, 'columns': columns,
+                                        'nbytes': sum(a.nbytes for a in columns.values())}
+            self._runs.move_to_end(start['uid'])
+            while len(self._runs) > 1 and (len(self._runs) > self.max_runs or self.nbytes > self.max_bytes):
+                self._runs.popitem(last=False)
+
+    # --- lookup
+    @property
+    def nbytes(self):
+        return sum(run['nbytes'] for run in self._runs.values())
+
+    def _find(self, uid):
+        with self._lock:
+            if isinstance(uid, (int, np.integer)) and uid < 0:
+                key = self._recent[uid] if -uid <= len(self._recent) else None
+            elif isinstance(uid, (int, np.integer)):
+                key = next((k for k, run in reversed(self._runs.items())
+                            if run['start'].get('scan_id') == uid), None)
+            else:
+                key = next((k for k in reversed(self._runs) if k.startswith(uid)), None)
+            if key not in self._runs:
+                return key, None
+            self._runs.move_to_end(key)
+            return key, self._runs[key]
+
+    def columns(self, uid=-1):
+        """
+        Returns the start document and {field: array} of the primary stream.
+        """
+
+        key, run = self._find(uid)
+        if run is not None:
+            self.hits += 1
+            return run['start'], run['columns']
+        self.misses += 1
+        hdr = db[key if key is not None else uid]
+        # UTC times, so the epoch values match the ones of the event documents
+        table = hdr.table(localize_times=False)
+        columns = {key: table[key].to_numpy() for key in table.columns if key != 'time'}
+        columns['seq_num'] = table.index.to_numpy()
+        columns['time'] = table['time'].to_numpy(dtype='datetime64[ns]').astype('int64')/1e9
+        columns = {key: arr for key, arr in columns.items() if arr.ndim == 1 and arr.dtype != object}
+        self._store(hdr.start, columns)
+        return hdr.start, columns
+
+    def table(self, uid=-1):
+        """
+        Returns the primary stream as a DataFrame indexed by seq_num, like
+        ``db[uid].table(localize_times=False)`` (time in UTC).
+        """
+
+        start, columns = self.columns(uid)
+        data = {'time': pd.to_datetime(columns['time'], unit='s')}
+        data.update((key, arr) for key, arr in columns.items() if key not in ('seq_num', 'time'))
+        return pd.DataFrame(data, index=pd.Index(columns['seq_num'], name='seq_num'))
+
+    def clear(self):
+        with self._lock:
+            self._runs.clear()
+
+    def __repr__(self):
+        return (f"<RunCache {len(self._runs)} runs, {self.nbytes/2**20:.1f} MB, "
+                f"{self.hits} hits, {self.misses} misses>")
+
+
+run_cache = RunCache()
+RE.subscribe(ThreadedCallback(run_cache, 'run_cache'))
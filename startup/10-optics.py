@@ -1,19 +1,76 @@
+import threading
+
 from ophyd import (Device, Component as Cpt, EpicsMotor, PVPositioner,
-                   FormattedComponent as FCpt)
+                   FormattedComponent as FCpt, Signal, EpicsSignal, EpicsSignalRO,
+                   DeviceStatus, PseudoPositioner, PseudoSingle)
+from ophyd.pseudopos import (pseudo_position_argument, real_position_argument)
 
 
 # List of available EpicsMotor labels in this script
 # [dcm. hrm2, vfm, hfm, xymotor, ssa, table, pinhole, bpm1, bpm1_diag, bpm2, bpm2_diag]
 
 
+#*******************************************************************************************************
+# Slits: the blade positions are signed (top/outboard > 0 > bottom/inboard when
+# centered), gap = high - low and center = (high + low)/2. Both functions work
+# on numbers and on NumPy arrays, e.g. for the blade positions of a gap scan.
+def slit_forward(gap, cen):
+# blade positions (high, low) of gaps and centers
+    return cen + gap/2, cen - gap/2
+
+
+def slit_inverse(high, low):
+# gaps and centers of blade positions
+    return high - low, (high + low)/2
+
+
+class SlitGapCenter(PseudoPositioner):
+    # gap/center pseudo axes of blade pairs; presets are named gap/center positions,
+    # moved with slit_preset (all blades at once)
+    # (gap, center, high blade, low blade) of every blade pair
+    _blade_pairs = ()
+    presets = {}
+
+    @pseudo_position_argument
+    def forward(self, pseudo_pos):
+        real = {}
+        for gap, cen, high, low in self._blade_pairs:
+            real[high], real[low] = slit_forward(getattr(pseudo_pos, gap), getattr(pseudo_pos, cen))
+        return self.RealPosition(**real)
+
+    @real_position_argument
+    def inverse(self, real_pos):
+        pseudo = {}
+        for gap, cen, high, low in self._blade_pairs:
+            pseudo[gap], pseudo[cen] = slit_inverse(getattr(real_pos, high), getattr(real_pos, low))
+        return self.PseudoPosition(**pseudo)
+
+    def preset(self, name):
+        # pseudo position of a preset; axes which it does not name stay where they are
+        if name not in self.presets:
+            raise KeyError(f"{self.name} has no preset {name!r}, use one of {sorted(self.presets)}")
+        return self.position._replace(**self.presets[name])
+
+
+def slit_preset(slits, name, *args):
+# plan stub: moves slits to the preset name, together with further mv arguments (motor, position, ...)
+    return (yield from bps.mv(slits, slits.preset(name), *args))
+
+
 # defined here, also used in 10-optics.py
-# why do none of the 'slits' constructs feature gap, center motions?
-class Blades(Device):
+class Blades(SlitGapCenter):
     top = Cpt(EpicsMotor, '-Ax:T}Mtr')
     bottom = Cpt(EpicsMotor, '-Ax:B}Mtr')
     outboard = Cpt(EpicsMotor, '-Ax:O}Mtr')
     inboard = Cpt(EpicsMotor, '-Ax:I}Mtr')
 
+    vgap = Cpt(PseudoSingle, egu='mm')
+    vcen = Cpt(PseudoSingle, egu='mm')
+    hgap = Cpt(PseudoSingle, egu='mm')
+    hcen = Cpt(PseudoSingle, egu='mm')
+
+    _blade_pairs = (('vgap', 'vcen', 'top', 'bottom'), ('hgap', 'hcen', 'outboard', 'inboard'))
+
 
 class DCM(Device):
     y =  Cpt(EpicsMotor, '-Ax:Y}Mtr', labels=('dcm',))
@@ -69,10 +126,15 @@ class XYMotor(Device):
     y = Cpt(EpicsMotor, '-Ax:Y}Mtr', labels=('xymotor',))
 
 
-class SSA(Device):
+class SSA(SlitGapCenter):
     top = Cpt(EpicsMotor, '-Ax:T}Mtr', labels=('ssa',))
     bottom = Cpt(EpicsMotor, '-Ax:B}Mtr', labels=('ssa',))
 
+    vgap = Cpt(PseudoSingle, egu='mm')
+    vcen = Cpt(PseudoSingle, egu='mm')
+
+    _blade_pairs = (('vgap', 'vcen', 'top', 'bottom'),)
+
 
 class Table(Device):
     x = Cpt(EpicsMotor, '-Ax:X4}Mtr', labels=('table',))
@@ -94,18 +156,15 @@ class MCMBase(PVPositioner):
     actuate_value = 1
     stop_signal = Cpt(EpicsSignal, '}Kill')
     stop_value = 1
-    # all six axes are coupled, so 'InPos' is an array of six values
-    done = Cpt(EpicsSignal, '}InPos')
-    done_value = True
+    # all six axes are coupled, so 'InPos' is an array of six values; it is
+    # monitored once by MCM, which puts its 'all in position' into done
+    done = Cpt(Signal, value=1, kind='omitted')
+    done_value = 1
 
     def __init__(self, prefix, ch_name=None, **kwargs):
         self._ch_name = ch_name
         super().__init__(prefix, **kwargs)
 
-    @property
-    def moving(self):
-        return (self.done_value != all(self.done.get(use_monitor=False)))
-
 
 class MCM(Device):
     x = Cpt(MCMBase, '', ch_name='-Ax:X}Mtr', labels=('mcm',))
@@ -115,6 +174,91 @@ class MCM(Device):
     phi = Cpt(MCMBase, '', ch_name='-Ax:Ry}Mtr', labels=('mcm',))
     chi = Cpt(MCMBase, '', ch_name='-Ax:Rz}Mtr', labels=('mcm',))
 
+    in_pos = Cpt(EpicsSignalRO, '}InPos', kind='omitted', auto_monitor=True)
+    actuate = Cpt(EpicsSignal, '}Mov', kind='omitted')
+    stop_signal = Cpt(EpicsSignal, '}Kill', kind='omitted')
+
+    axes = ('x', 'y', 'z', 'theta', 'phi', 'chi')
+    # setpoint changes below this do not start the hexapod
+    tolerance = 1e-6
+    # fallback (s) for a grouped move which never leaves InPos: it is then
+    # reported done, with a warning; a move which left InPos waits for its return
+    settle_timeout = 30.
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.in_pos.subscribe(self._in_pos_changed, run=False)
+
+    @staticmethod
+    def _all_in_pos(value):
+        return int(all(value) if hasattr(value, '__iter__') else bool(value))
+
+    def _in_pos_changed(self, value=None, **kwargs):
+        # one InPos update resolves the motion status of all six axes
+        done = self._all_in_pos(value)
+        for axis in self.axes:
+            getattr(self, axis).done.put(done)
+
+    def set(self, positions):
+        """
+        Moves several axes with one actuate, e.g. mcm.set({'x': 0.1, 'theta': 0.02}).
+
+        The setpoints are written first and the hexapod is started once; the
+        status finishes when InPos has left and returned to 'all in position'.
+        The setpoints and readbacks are the same PVs, so they cannot tell
+        whether the motion is over. If no setpoint changes, nothing moves. If
+        InPos does not leave within settle_timeout, the move is reported
+        done, with a warning.
+        """
+
+        unknown = set(positions) - set(self.axes)
+        if unknown:
+            raise ValueError(f"unknown MCM axes {sorted(unknown)}, use {self.axes}")
+        for axis, pos in positions.items():
+            getattr(self, axis).check_value(pos)
+
+        status = DeviceStatus(self)
+        moves = {axis: pos for axis, pos in positions.items()
+                 if abs(getattr(self, axis).setpoint.get() - pos) > self.tolerance}
+        if not moves:
+            status._finished()
+            return status
+        state = {'left': False}
+
+        def watch(value=None, **kwargs):
+            if not self._all_in_pos(value):
+                state['left'] = True
+            elif state['left']:
+                finish()
+
+        def finish():
+            if not status.done:
+                self.in_pos.clear_sub(watch)
+                timer.cancel()
+                status._finished()
+
+        def settled():
+            if not state['left'] and self._all_in_pos(self.in_pos.get()):
+                print(f"Warning: {self.name} InPos did not change within {self.settle_timeout} s "
+                      f"of the move to {moves}; assuming the move is done")
+                finish()
+
+        for axis, pos in moves.items():
+            getattr(self, axis).setpoint.put(pos, wait=True)
+        timer = threading.Timer(self.settle_timeout, settled)
+        self.in_pos.subscribe(watch, run=False)
+        self.actuate.put(MCMBase.actuate_value, wait=True)
+        timer.start()
+        return status
+
+    def stop(self, *, success=False):
+        self.stop_signal.put(MCMBase.stop_value)
+
+
+def mcm_mv(**positions):
+# plan stub: moves the given MCM axes together, e.g. mcm_mv(x=0.1, theta=0.02)
+    return (yield from bps.mv(mcm, positions))
+
 
 dcm = DCM('XF:10IDA-OP{Mono:DCM', name='dcm')
 vfm = VFM('XF:10IDD-OP{VFM:1', name='vfm')
@@ -124,6 +268,8 @@ hrm2 = HRM2('XF:10IDB-OP{Mono:HRM2', name='hrm2')
 s1 = Blades('XF:10IDA-OP{Slt:1', name='s1')
 s2 = Blades('XF:10IDC-OP{Slt:4', name='s2')
 s3 = Blades('XF:10IDD-OP{Slt:5', name='s3')
+# hrm_setup
+s1.presets = {'align': {'vgap': 1., 'vcen': 0., 'hgap': 2., 'hcen': 0.}}
 
 bpm1 = XYMotor('XF:10IDA-OP{BPM:1', name='bpm1', labels=('bpm1',))
 bpm1_diag = EpicsMotor('XF:10IDA-BI{BPM:1-Ax:YFoil}Mtr', name='bpm1_diag', labels=('bpm1_diag',))
@@ -1,8 +1,13 @@
 from ophyd import (EpicsMotor, PseudoSingle, PseudoPositioner,
                    Component as Cpt)
 from ophyd.pseudopos import (pseudo_position_argument, real_position_argument)
+import json
+import re
+import time
+from pathlib import Path
 import numpy as np
-from scipy import interpolate
+
+interpolate = lazy_import('scipy.interpolate')
 
 # List of available EpicsMotor labels in this script
 # [blenergy, dcmenergy, hrmenergy, analyzercxtal]
@@ -19,12 +24,145 @@ _Bragg = [16.401781, 15.821071, 15.280587, 14.776273, 14.304428,
           10.595196, 10.351707, 10.119222, 9.896987, 9.684357, 9.480717,
           9.28554, 9.098203, 8.918375, 8.7455, 8.579178, 8.41915, 8.11645]
 
-gcalc = interpolate.interp1d(_Bragg, _ivu_gap)
+gcalc = LazyObject(lambda: interpolate.interp1d(_Bragg, _ivu_gap))
+
+# Calibrated gap tables (ugap_calibration) are saved as ugap_table_v<N>.json;
+# the latest one replaces the table above at startup.
+UGAP_TABLE_DIR = Path('/nsls2/data/ixs/legacy/ugap_tables')
+
+
+def _ugap_table_versions(directory=None):
+# {version: path} of the gap tables in directory
+    directory = Path(directory or UGAP_TABLE_DIR)
+    versions = {}
+    for path in directory.glob('ugap_table_v*.json'):
+        match = re.fullmatch(r'ugap_table_v(\d+)\.json', path.name)
+        if match:
+            versions[int(match.group(1))] = path
+    return versions
+
+
+def load_ugap_table(path=None):
+    """
+    Reads a gap table; the default is the latest version in UGAP_TABLE_DIR.
+
+    Returns
+    -------
+    dict or None
+        the table ('version', 'bragg', 'gap', ...) or None if there is none
+        or it cannot be read
+    """
+
+    try:
+        if path is None:
+            versions = _ugap_table_versions()
+            if not versions:
+                return None
+            path = versions[max(versions)]
+        table = json.loads(Path(path).read_text())
+        if len(table['bragg']) != len(table['gap']) or len(table['bragg']) < 2:
+            raise ValueError("bragg and gap must have the same length >= 2")
+    except (OSError, ValueError, KeyError) as ex:
+        print(f"Warning: cannot read the gap table {path}: {ex}")
+        return None
+    table['path'] = str(path)
+    return table
+
+
+def save_ugap_table(table, directory=None):
+# writes table as the next version in directory (default UGAP_TABLE_DIR); returns the path
+    directory = Path(directory or UGAP_TABLE_DIR)
+    directory.mkdir(parents=True, exist_ok=True)
+    version = max(_ugap_table_versions(directory), default=0) + 1
+    path = directory / f'ugap_table_v{version:03d}.json'
+    table = dict(table, version=version, created=time.strftime('%Y-%m-%dT%H:%M:%S'))
+    path.write_text(json.dumps(table, indent=1))
+    return path
+
+
+def use_ugap_table(table):
+# replaces the gap table of blE (gcalc) by table, a dict with 'bragg' and 'gap' lists
+    global _Bragg, _ivu_gap, gcalc
+    _Bragg, _ivu_gap = list(table['bragg']), list(table['gap'])
+    gcalc = LazyObject(lambda: interpolate.interp1d(_Bragg, _ivu_gap))
+
+
+_ugap_table = load_ugap_table()
+if _ugap_table is not None:
+    use_ugap_table(_ugap_table)
+    print(f"blE: gap table version {_ugap_table.get('version')} from {_ugap_table['path']}")
+else:
+    print("blE: no calibrated gap table found, using the built-in table")
 
 _hc = 12398.4193
 _si_111 = 3.1363
 
 
+def bragg_angle(energy):
+# DCM Si(111) Bragg angle (deg) of energies (eV)
+    return np.rad2deg(np.arcsin(_hc/(2.*_si_111*np.asarray(energy))))
+
+
+def dcm_z2(theta):
+# DCM second crystal z2 (mm) for a fixed beam offset at Bragg angles theta (deg)
+    return 15./np.cos(np.deg2rad(theta)) - 15.
+
+
+def energy_trajectory(energies, ugap=True, check=True):
+    """
+    Real positions of blE (or dcmE with ugap=False) for a list of energies.
+
+    Computes the whole trajectory in one pass, instead of one forward call
+    per point, and checks it against the limits of the motors and the range
+    of the gap table before anything moves.
+
+    Parameters
+    ----------
+    energies : list or array
+        energies (eV)
+    ugap : bool, optional
+        include the undulator gap from the gap table (gcalc). The default is True.
+    check : bool, optional
+        raise ValueError if a position is outside its limits. The default is True.
+
+    Returns
+    -------
+    dict
+        {'energy', 'theta', 'z2' and 'ugap'}: arrays of the positions
+    """
+
+    energies = np.atleast_1d(np.asarray(energies, dtype=float))
+    traj = {'energy': energies}
+    with np.errstate(invalid='ignore'):
+        traj['theta'] = bragg_angle(energies)
+    traj['z2'] = dcm_z2(traj['theta'])
+    errors = []
+    if not np.isfinite(traj['theta']).all():
+        errors.append(f"no Bragg reflection at {energies[~np.isfinite(traj['theta'])][0]:g} eV")
+    if ugap:
+        lo, hi = min(_Bragg), max(_Bragg)
+        outside = ~((traj['theta'] >= lo) & (traj['theta'] <= hi))
+        if outside.any():
+            errors.append(f"{energies[outside][0]:g} eV is outside the gap table ({lo:g} to {hi:g} deg)")
+            traj['ugap'] = np.full(energies.shape, np.nan)
+        else:
+            traj['ugap'] = np.asarray(gcalc(traj['theta']))
+    if check:
+        for name in ('theta', 'z2', 'ugap'):
+            if name not in traj:
+                continue
+            low, high = getattr(getattr(blE, name), 'limits', (0, 0))
+            if low == high:  # no limits set
+                continue
+            bad = (traj[name] < low) | (traj[name] > high)
+            if bad.any():
+                errors.append(f"blE.{name} {traj[name][bad][0]:g} at {energies[bad][0]:g} eV "
+                              f"is outside its limits ({low:g}, {high:g})")
+        if errors:
+            raise ValueError("energy_trajectory: " + "; ".join(errors))
+    return traj
+
+
 class BLEnergy(PseudoPositioner):
     # limits and constants from Spec file, "site.mac"
     energy = Cpt(PseudoSingle, limits=(7.835, 17.7))
@@ -34,8 +172,8 @@ class BLEnergy(PseudoPositioner):
     ugap = Cpt(Undulator, 'SR:C10-ID:G1{IVU22:1')
 
     def forward(self, pseudo_pos):
-        _th = np.rad2deg(np.arcsin(_hc/(2.*_si_111*pseudo_pos)))
-        _z2 = 15./np.cos(np.deg2rad(_th)) - 15.
+        _th = bragg_angle(pseudo_pos)
+        _z2 = dcm_z2(_th)
         _ugap = gcalc(_th)
 
         return self.RealPosition(theta=_th, z2=_z2, ugap=_ugap)
@@ -57,8 +195,8 @@ class DCMEnergy(PseudoPositioner):
     z2 = Cpt(EpicsMotor, 'XF:10IDA-OP{Mono:DCM-Ax:Z2}Mtr', labels=('dcmenergy',))
 
     def forward(self, pseudo_pos):
-        _th = np.rad2deg(np.arcsin(_hc/(2.*_si_111*pseudo_pos)))
-        _z2 = 15./np.cos(np.deg2rad(_th)) - 15.
+        _th = bragg_angle(pseudo_pos)
+        _z2 = dcm_z2(_th)
 
         return self.RealPosition(theta=_th, z2=_z2)
 
@@ -119,6 +257,88 @@ h2_par = C0y*C0y + C0z*C0z
 hn_par = np.sqrt(h2_par)
 
 
+def analyzer_cxtal_forward(the, y):
+    """
+    Motor positions of the analyzer C crystal for crystal angles and heights.
+
+    Parameters
+    ----------
+    the : float or array
+        crystal angle relative to th0 (deg)
+    y : float or array
+        crystal height (mm)
+
+    Returns
+    -------
+    uy, dy : float or array
+        positions of the upstream and downstream jacks (mm)
+    """
+
+    cth = np.asarray(the) + th0
+    cy = c1_par*np.sin(np.deg2rad(cth))
+    cz = np.sqrt(c2_par - cy*cy)
+    a1 = (c2_par + h2_par - d2_par)/2.
+    d1 = cz*np.sqrt(c2_par*h2_par - a1*a1)
+    hy = (a1*cy + d1)/c2_par
+    #
+    # first motor position (mm)
+    y1 = 0.01*np.asarray(y) - hy - C0y
+    #
+    a2 = anz*anz + c2_par - b2_par - 2*anz*cz
+    d3 = np.sqrt(cy*cy - a2)
+    #
+    # second motor position (mm)
+    y2 = C0y + y1 + cy - d3 - A0y
+
+    return 100.*y1, 100.*y2
+
+
+def analyzer_cxtal_inverse(uy, dy):
+    """
+    Crystal angle (relative to th0, deg) and height (mm) of the analyzer C
+    crystal for jack positions uy, dy (mm); the inverse of analyzer_cxtal_forward.
+    """
+
+    # d1y == uy, d2y == dy
+    d1y, d2y = np.asarray(uy), np.asarray(dy)
+
+    _any = 0.84992 + 0.01*(d2y - d1y)
+    a2 = _any*_any + anz*anz
+    a1 = (c2_par + a2 - b2_par)/2.
+    d1 = anz*np.sqrt(a2*c2_par - a1*a1)
+    cy = (a1*_any + d1)/a2
+    cz = np.sqrt(c2_par - cy*cy)
+    #
+    # crystal angle (deg)
+    cth = np.rad2deg(np.arcsin(cy/c1_par))
+    a2 = (c2_par + h2_par - d2_par)/2.
+    _d2 = cz*np.sqrt(c2_par*h2_par - a2*a2)
+    hy = (a2*cy + _d2)/c2_par
+    #
+    # crystal y-position
+    ccy = 100.*(C0y + 0.01*d1y + hy)
+
+    return cth - th0, ccy
+
+
+def sample_prime_forward(xp, zp, th, phi):
+# sample stage positions sx, sz of the positions xp, zp along and across the beam
+# in the sample frame rotated by th + phi (deg)
+    _th = np.deg2rad(np.asarray(th) + phi)
+    return xp*np.cos(_th) - zp*np.sin(_th), xp*np.sin(_th) + zp*np.cos(_th)
+
+
+def sample_prime_inverse(sx, sz, th, phi):
+# sample frame positions xp, zp of the sample stage positions sx, sz; the inverse of sample_prime_forward
+    _th = np.deg2rad(np.asarray(th) + phi)
+    return sz*np.sin(_th) + sx*np.cos(_th), sz*np.cos(_th) - sx*np.sin(_th)
+
+
+def _scalar(value):
+# plain floats for the pseudo positioners, arrays stay arrays
+    return float(value) if np.ndim(value) == 0 else value
+
+
 class AnalyzerCXtal(PseudoPositioner):
     the = Cpt(PseudoSingle, egu='deg')
     y = Cpt(PseudoSingle, egu='mm')
@@ -128,55 +348,14 @@ class AnalyzerCXtal(PseudoPositioner):
 
     @pseudo_position_argument
     def forward(self, pseudopos):
-        ddy = np.zeros((2,), dtype=float)
-        cth = pseudopos.the + th0
-        ccy = pseudopos.y
-
-        cy = c1_par*np.sin(np.deg2rad(cth))
-        cz = np.sqrt(c2_par - cy*cy)
-        a1 = (c2_par + h2_par - d2_par)/2.
-        d1 = cz*np.sqrt(c2_par*h2_par - a1*a1)
-        hy = (a1*cy + d1)/c2_par
-        #
-        # first motor position (mm)
-        y1 = 0.01*ccy - hy - C0y
-        ddy[0] = 100.*y1
-        #
-        a2 = anz*anz + c2_par - b2_par - 2*anz*cz
-        d3 = np.sqrt(cy*cy - a2)
-        #
-        # second motor position (mm)
-        y2 = C0y + y1 + cy - d3 - A0y
-        ddy[1] = 100.*y2
-
-        return self.RealPosition(uy=ddy[0], dy=ddy[1])
+        uy, dy = analyzer_cxtal_forward(pseudopos.the, pseudopos.y)
+        return self.RealPosition(uy=_scalar(uy), dy=_scalar(dy))
 
     @real_position_argument
     def inverse(self, realpos):
-        ccp = np.zeros((2,), dtype=float)
-        # d2y == a2uy, d1y == a2dy
-        #TODO use realpos input!
-        d1y = self.uy.position
-        d2y = self.dy.position
-
-        _any = 0.84992 + 0.01*(d2y - d1y)
-        a2 = _any*_any + anz*anz
-        a1 = (c2_par + a2 - b2_par)/2.
-        d1 = anz*np.sqrt(a2*c2_par - a1*a1)
-        cy = (a1*_any + d1)/a2
-        cz = np.sqrt(c2_par - cy*cy)
-        #
-        # crystal angle (rad)
-        ccp[0] = np.rad2deg(np.arcsin(cy/c1_par))
-        a2 = (c2_par + h2_par - d2_par)/2.
-        _d2 = cz*np.sqrt(c2_par*h2_par - a2*a2)
-        hy = (a2*cy + _d2)/c2_par
-        #
-        # crystal y-position
-        ccp[1] = 100.*(C0y + 0.01*d1y + hy)
-
-        return self.PseudoPosition(the=ccp[0]-th0, y=ccp[1])
-    
+        the, y = analyzer_cxtal_inverse(realpos.uy, realpos.dy)
+        return self.PseudoPosition(the=_scalar(the), y=_scalar(y))
+
 
 class SamplePrime(PseudoPositioner):
     xp = Cpt(PseudoSingle, egu='mm')
@@ -189,20 +368,47 @@ class SamplePrime(PseudoPositioner):
 
     @pseudo_position_argument
     def forward(self, pseudopos):
-        _th = np.deg2rad(self.th.position + self.phi.position)
-        _sx = pseudopos.xp*np.cos(_th) - pseudopos.zp*np.sin(_th)
-        _sz = pseudopos.xp*np.sin(_th) + pseudopos.zp*np.cos(_th)
+        # th and phi stay where they are; their positions come from the monitored
+        # readbacks of the pseudo positioner, not from new reads
+        cur = self.real_position
+        _sx, _sz = sample_prime_forward(pseudopos.xp, pseudopos.zp, cur.th, cur.phi)
+
+        return self.RealPosition(th=cur.th, phi=cur.phi, sx=_scalar(_sx), sz=_scalar(_sz))
 
-        return self.RealPosition(sx = _sx, sz = _sz)
-    
     @real_position_argument
     def inverse(self, realpos):
-        _th = np.deg2rad(realpos.th + realpos.phi)
-        _xp = realpos.sz*np.sin(_th) + realpos.sx*np.cos(_th)
-        _zp = realpos.sz*np.cos(_th) - realpos.sx*np.sin(_th)
+        _xp, _zp = sample_prime_inverse(realpos.sx, realpos.sz, realpos.th, realpos.phi)
+
+        return self.PseudoPosition(xp=_scalar(_xp), zp=_scalar(_zp))
+
+
+def check_kinematics(n=1001, tol=1e-9):
+    """
+    Round trip of the analyzer C crystal and sample prime kinematics.
+
+    Maps n points of the working range forward and back and compares with the
+    start values.
+
+    Returns
+    -------
+    dict
+        maximum deviation of every pseudo axis; AssertionError if one exceeds tol
+    """
+
+    the = np.linspace(-2., 2., n)
+    y = np.linspace(-5., 5., n)
+    the2, y2 = analyzer_cxtal_inverse(*analyzer_cxtal_forward(the, y))
+    xp = np.linspace(-10., 10., n)
+    zp = xp[::-1]
+    th = np.linspace(-180., 180., n)
+    xp2, zp2 = sample_prime_inverse(*sample_prime_forward(xp, zp, th, 5.), th, 5.)
+
+    errors = {'anc_xtal.the': np.max(np.abs(the2 - the)), 'anc_xtal.y': np.max(np.abs(y2 - y)),
+              'sp.xp': np.max(np.abs(xp2 - xp)), 'sp.zp': np.max(np.abs(zp2 - zp))}
+    for name, err in errors.items():
+        assert err <= tol, f"{name}: round trip error {err:.3g} > {tol}"
+    return errors
 
-        return self.PseudoPosition(xp = _xp, zp = _zp)
-    
 
 anc_xtal = AnalyzerCXtal('', name='anc_xtal', egu=('deg', 'mm'))
 sam_prime = SamplePrime('', name='sp', egu=('mm', 'deg'))
\ No newline at end of file
@@ -1,4 +1,4 @@
-from ophyd import (Component as Cpt, Device, EpicsMotor, EpicsSignal)
+from ophyd import (Component as Cpt, Device, EpicsMotor, EpicsSignal, PseudoSingle)
 
 # List of available EpicsMotor labels in this script
 # [analyzer, spectrometer, analyzerdxtals, analyzerslits, mcmslits, samplestage, whl, anapd, anpd]
@@ -38,19 +38,40 @@ class AnalyzerDXtals(Device):
     anpd = Cpt(EpicsMotor,  '5-Ax:1}Mtr', labels=('analyzerdxtals',))
 
 
-class AnalyzerSlits(Device):
+class AnalyzerSlits(SlitGapCenter):
     top = Cpt(EpicsMotor,  '5-Ax:2}Mtr', labels=('analyzerslits',))
     bottom = Cpt(EpicsMotor,  '5-Ax:3}Mtr', labels=('analyzerslits',))
     outboard = Cpt(EpicsMotor,  '7-Ax:3}Mtr', labels=('analyzerslits',))
     inboard = Cpt(EpicsMotor,  '7-Ax:4}Mtr', labels=('analyzerslits',))
 
+    vgap = Cpt(PseudoSingle, egu='mm')
+    vcen = Cpt(PseudoSingle, egu='mm')
+    hgap = Cpt(PseudoSingle, egu='mm')
+    hcen = Cpt(PseudoSingle, egu='mm')
 
-class MCMSlits(Device):
+    _blade_pairs = (('vgap', 'vcen', 'top', 'bottom'), ('hgap', 'hcen', 'outboard', 'inboard'))
+    presets = {
+        'measure': {'vgap': 2., 'vcen': 0., 'hgap': 3., 'hcen': 0.},    # energy scans
+        'open': {'vgap': 4., 'vcen': 0., 'hgap': 4., 'hcen': 0.},       # mcm_setup
+        'align': {'vgap': 0.2, 'vcen': 0., 'hgap': 2., 'hcen': 0.},     # ccr_setup, wcr_setup
+        'mesh': {'vgap': 0.02, 'vcen': 0., 'hgap': 3., 'hcen': 0.},     # DxtalMesh
+    }
+
+
+class MCMSlits(SlitGapCenter):
  #   top = Cpt(EpicsMotor, '6-Ax:3}Mtr', labels=('mcmslits',))
  #   bottom = Cpt(EpicsMotor, '6-Ax:4}Mtr', labels=('mcmslits',))
     inboard = Cpt(EpicsMotor,  '-Ax:Xi}Mtr', labels=('mcmslits',))
     outboard = Cpt(EpicsMotor,  '-Ax:Xo}Mtr', labels=('mcmslits',))
 
+    hgap = Cpt(PseudoSingle, egu='mm')
+    hcen = Cpt(PseudoSingle, egu='mm')
+
+    _blade_pairs = (('hgap', 'hcen', 'outboard', 'inboard'),)
+    presets = {
+        'measure': {'hgap': 2., 'hcen': 0.},
+    }
+
 
 class SampleStage(Device):
     ty = Cpt(EpicsMotor, '{Spec:1-Ax:Y}Mtr', labels=('samplestage',))
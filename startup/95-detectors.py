@@ -8,11 +8,38 @@ from ophyd.areadetector import (EpicsSignalWithRBV, ImagePlugin, StatsPlugin,
 
 from ophyd.quadem import NSLS_EM, TetrAMM, QuadEMPort
 
-det1 = NSLS_EM('XF10ID-BI:AH171:', name='det1')
-det2 = NSLS_EM('XF10ID-BI:AH172:', name='det2')
-det3 = NSLS_EM('XF10ID-BI:AH173:', name='det3')
-det4 = NSLS_EM('XF10ID-BI:AH174:', name='det4')
-det5 = NSLS_EM('XF10ID-BI:AH175:', name='det5')
+
+class QuadEMTimeSeries(Device):
+    # time-series plugin (NDPluginTimeSeries) of the quadEM IOC: buffers of
+    # num_points samples, one every averaging_time, for every channel
+    acquire = Cpt(EpicsSignal, 'TSAcquire', kind='omitted')
+    read_buffers = Cpt(EpicsSignal, 'TSRead', kind='omitted')
+    acquire_mode = Cpt(EpicsSignal, 'TSAcquireMode', kind='config')
+    num_points = Cpt(EpicsSignal, 'TSNumPoints', kind='config')
+    averaging_time = Cpt(EpicsSignal, 'TSAveragingTime', kind='config')
+    time_per_point = Cpt(EpicsSignalRO, 'TSTimePerPoint', kind='config')
+    current_point = Cpt(EpicsSignalRO, 'TSCurrentPoint', kind='omitted')
+    acquiring = Cpt(EpicsSignalRO, 'TSAcquiring', kind='omitted')
+
+    current1 = Cpt(EpicsSignalRO, 'Current1:TimeSeries')
+    current2 = Cpt(EpicsSignalRO, 'Current2:TimeSeries')
+    current3 = Cpt(EpicsSignalRO, 'Current3:TimeSeries')
+    current4 = Cpt(EpicsSignalRO, 'Current4:TimeSeries')
+    sum_all = Cpt(EpicsSignalRO, 'SumAll:TimeSeries')
+
+    channels = ('current1', 'current2', 'current3', 'current4', 'sum_all')
+
+
+class IXSQuadEM(NSLS_EM):
+    # NSLS_EM with the time-series buffers, streamed by EMStream (98-flyscans.py)
+    # lazy: electrometer IOCs without the TS plugin still connect
+    ts = Cpt(QuadEMTimeSeries, 'TS:', kind='omitted', lazy=True)
+
+det1 = IXSQuadEM('XF10ID-BI:AH171:', name='det1')
+det2 = IXSQuadEM('XF10ID-BI:AH172:', name='det2')
+det3 = IXSQuadEM('XF10ID-BI:AH173:', name='det3')
+det4 = IXSQuadEM('XF10ID-BI:AH174:', name='det4')
+det5 = IXSQuadEM('XF10ID-BI:AH175:', name='det5')
 
 for j, det in enumerate([det1, det2, det3, det4, det5]):
     det.configuration_attrs = ['integration_time', 'averaging_time']
@@ -20,8 +47,8 @@ for j, det in enumerate([det1, det2, det3, det4, det5]):
                         'current3.mean_value','current4.mean_value']
     det.conf.port_name.put(f'AH17{j+1}')
 
-tm1 = NSLS_EM('XF:10ID-BI:TM176:', name='tm1')
-tm2 = NSLS_EM('XF:10ID-BI:TM178:', name='tm2')
+tm1 = IXSQuadEM('XF:10ID-BI:TM176:', name='tm1')
+tm2 = IXSQuadEM('XF:10ID-BI:TM178:', name='tm2')
 
 for j, det in enumerate([tm1, tm2]):
     det.configuration_attrs = ['integration_time', 'averaging_time']
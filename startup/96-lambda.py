@@ -5,24 +5,53 @@ from ophyd.areadetector.base import EpicsSignalWithRBV as SignalWithRBV
 from ophyd.areadetector.cam import CamBase
 from ophyd.areadetector import ADComponent as ADCpt, DetectorBase
 from nslsii.ad33 import StatsPluginV33, SingleTriggerV33
-from ophyd.areadetector.plugins import PluginBase
+from ophyd.areadetector.plugins import PluginBase, ImagePlugin, HDF5Plugin_V25
+from ophyd.areadetector.filestore_mixins import FileStoreHDF5IterativeWrite
+import os
+import time
+import numpy as np
+
+h5py = lazy_import('h5py')
 
 
 class PluginCV(PluginBase):
     ...
 
+class LambdaHDF5Plugin(HDF5Plugin_V25, FileStoreHDF5IterativeWrite):
+    # HDF5 frames with resource/datum documents: one chunk per frame, zlib compressed,
+    # flushed after every frame in SWMR mode so that SWMRFrameReader sees the frames
+    # while they are written. Runs write frames only after set_lambda_hdf5(True).
+    write_frames = False
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # the file settings go before capture, which opens the file
+        self.stage_sigs.update([('compression', 'zlib'), ('zlevel', 1),
+                                ('num_frames_chunks', 1), ('num_row_chunks', 516), ('num_col_chunks', 1556),
+                                ('swmr_mode', 1), ('num_frames_flush', 1)])
+        self.stage_sigs.move_to_end('capture')
+
+    def stage(self):
+        return super().stage() if self.write_frames else []
+
+    def unstage(self):
+        return super().unstage() if self.write_frames else []
+
+    def generate_datum(self, key, timestamp, datum_kwargs):
+        if self.write_frames:
+            return super().generate_datum(key, timestamp, datum_kwargs)
+
+
 class LambdaDetector(DetectorBase):
     _html_docs = ['lambda.html']
     cam = Cpt(Lambda750kCam, 'cam1:')
 
 class Lambda(SingleTriggerV33, LambdaDetector):
-    # MR20200122: created all dirs recursively in /nsls2/jpls/data/lambda/
-    # from 2020 to 2030 with 777 permissions, owned by xf12id1 user.
-    # tiff = Cpt(TIFFPluginWithFileStore,
-    #            suffix="TIFF1:",
-    #            write_path_template="/nsls2/xf12id1g/data/lambda/%Y/%m/%d/",
-    #            read_path_template="/nsls2/xf12id1g/data/lambda/%Y/%m/%d/",
-    #            root='/nsls2/xf12id1g/data') 
+    hdf5 = Cpt(LambdaHDF5Plugin,
+               suffix='HDF1:',
+               write_path_template='/nsls2/data/ixs/legacy/lambda/%Y/%m/%d/',
+               root='/nsls2/data/ixs/legacy',
+               kind='omitted')
     cv1 = Cpt(PluginCV, 'CV1:')
     
     roi1 = Cpt(ROIPlugin, 'ROI1:')
@@ -44,17 +73,261 @@ class Lambda(SingleTriggerV33, LambdaDetector):
 
 
     trans1 = Cpt(TransformPlugin, 'Trans1:')
+    image = Cpt(ImagePlugin, 'image1:')
 
     low_thr = Cpt(EpicsSignal, 'cam1:LowEnergyThreshold')
     hig_thr = Cpt(EpicsSignal, 'cam1:HighEnergyThreshold')
     oper_mode = Cpt(EpicsSignal, 'cam1:OperatingMode')
 
+    # SoftROIEngine whose regions are read with the stats totals, see set_soft_rois
+    soft_roi = None
+
+    def frame(self):
+        # the last raw frame from the image plugin, shape (height, width)
+        height, width = self.image.array_size.height.get(), self.image.array_size.width.get()
+        return np.asarray(self.image.array_data.get())[:height*width].reshape(height, width)
+
+    def describe(self):
+        res = super().describe()
+        if self.soft_roi is not None:
+            res.update(self.soft_roi.describe(self.name, self.image.array_data.pvname))
+        return res
+
+    def read(self):
+        res = super().read()
+        if self.soft_roi is not None:
+            res.update(self.soft_roi.read(self.frame(), self.name))
+        return res
+
 lambda_det = Lambda('XF:10IDC-BI{Lambda-Cam:1}', name='lambda_det')
 for j in range(1, 8):
     getattr(lambda_det, f'stats{j}').kind = 'normal'
 lambda_det.stats7.total.kind = 'hinted'
 
 
+#*******************************************************************************************************
+def set_lambda_hdf5(enable=True, det=None):
+    # writes the lambda_det frames of the next runs to HDF5 (field lambda_det_image) or stops writing them
+    det = det or lambda_det
+    det.hdf5.write_frames = enable
+    det.hdf5.kind = 'normal' if enable else 'omitted'
+
+
+class SWMRFrameReader:
+    """
+    Reads the frames of an HDF5 file while the area detector writes it.
+
+    The file is opened in SWMR mode; every call of new_frames returns the
+    frames written since the previous call as an array (n, height, width).
+    With filename None the file of the current lambda_det run is opened.
+
+    Example, software ROIs of the frames of a running scan::
+
+        with SWMRFrameReader() as reader:
+            for frames in reader.follow(timeout=10):
+                print(engine.compute(frames)['masked_sum'])
+    """
+
+    def __init__(self, filename=None, dataset='/entry/data/data'):
+        if filename is None:
+            filename = lambda_det.hdf5._fn
+            if not lambda_det.hdf5.write_frames or not filename:
+                raise RuntimeError("lambda_det does not write HDF5 frames, see set_lambda_hdf5")
+        self.filename = filename
+        self.file = h5py.File(filename, 'r', libver='latest', swmr=True)
+        self.dataset = self.file[dataset]
+        self.position = 0
+
+    def new_frames(self):
+        self.dataset.refresh()
+        n = self.dataset.shape[0]
+        frames = self.dataset[self.position:n]
+        self.position = n
+        return frames
+
+    def follow(self, timeout=5., poll=0.2):
+        # yields the new frames until none arrived for timeout seconds
+        last = time.monotonic()
+        while time.monotonic() - last < timeout:
+            frames = self.new_frames()
+            if len(frames):
+                last = time.monotonic()
+                yield frames
+            else:
+                time.sleep(poll)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class LiveFrames:
+    """
+    Document callback passing the HDF5 frames of a run to func(frames) as they arrive.
+
+    The file is opened at the first resource document of the run; at every
+    event func gets the frames written since the previous event.
+    """
+
+    def __init__(self, func, dataset='/entry/data/data'):
+        self.func = func
+        self.dataset = dataset
+        self.reader = None
+
+    def __call__(self, name, doc):
+        if name == 'resource' and doc.get('spec') == 'AD_HDF5' and self.reader is None:
+            self.reader = SWMRFrameReader(os.path.join(doc['root'], doc['resource_path']), self.dataset)
+        elif name in ('event', 'event_page', 'stop') and self.reader is not None:
+            frames = self.reader.new_frames()
+            if len(frames):
+                self.func(frames)
+            if name == 'stop':
+                self.reader.close()
+                self.reader = None
+
+
+
+#*******************************************************************************************************
+class SoftROIEngine:
+    """
+    ROI sums, masked sums and centroids of raw Lambda frames, computed in software.
+
+    Every region is a set of pixels: a rectangle (add_roi, like the ROI
+    plugins), a boolean mask (add_mask) or flat pixel indices (add_pixels);
+    regions may overlap. The regions are compiled into one pixel-index map,
+    so a frame (or a stack of frames) is gathered once and all regions are
+    summed by one np.add.reduceat. Bad pixels are left out of the masked sums
+    and of the centroids.
+
+    Parameters
+    ----------
+    shape : tuple of int
+        frame shape (height, width).
+    bad_pixels : array or str, optional
+        boolean mask of bad pixels, or the .npy file holding it.
+    """
+
+    quantities = ('sum', 'masked_sum', 'cen_x', 'cen_y')
+
+    def __init__(self, shape=(516, 1556), bad_pixels=None):
+        self.shape = tuple(shape)
+        self.rois = {}
+        self.set_bad_pixels(bad_pixels)
+
+    @classmethod
+    def from_plugins(cls, det=None, bad_pixels=None):
+        # engine with the regions roi1..roi7 of the ROI plugins, to compare with stats1..7
+        det = det or lambda_det
+        engine = cls((det.cam.array_size.array_size_y.get(), det.cam.array_size.array_size_x.get()), bad_pixels)
+        for n in range(1, 8):
+            roi = getattr(det, f'roi{n}')
+            engine.add_roi(f'roi{n}', roi.min_xyz.min_x.get(), roi.min_xyz.min_y.get(),
+                           roi.size.x.get(), roi.size.y.get())
+        return engine
+
+    def set_bad_pixels(self, bad_pixels=None):
+        if isinstance(bad_pixels, str):
+            bad_pixels = np.load(bad_pixels)
+        bad_pixels = np.zeros(self.shape, bool) if bad_pixels is None else np.asarray(bad_pixels, bool)
+        if bad_pixels.shape != self.shape:
+            raise ValueError(f"bad pixel mask of shape {bad_pixels.shape}, frames are {self.shape}")
+        self.bad_pixels = bad_pixels
+        self._maps = None
+
+    def add_roi(self, name, x, y, width, height):
+        # rectangle of width x height pixels from column x and row y, clipped to the frame as the ROI plugin does
+        y = min(max(int(y), 0), self.shape[0] - 1)
+        x = min(max(int(x), 0), self.shape[1] - 1)
+        height = min(max(int(height), 1), self.shape[0] - y)
+        width = min(max(int(width), 1), self.shape[1] - x)
+        yy, xx = np.mgrid[y:y + height, x:x + width]
+        self.add_pixels(name, np.ravel_multi_index((yy.ravel(), xx.ravel()), self.shape))
+
+    def add_mask(self, name, mask):
+        mask = np.asarray(mask, bool)
+        if mask.shape != self.shape:
+            raise ValueError(f"mask of shape {mask.shape}, frames are {self.shape}")
+        self.add_pixels(name, np.flatnonzero(mask))
+
+    def add_pixels(self, name, indices):
+        indices = np.unique(np.asarray(indices, dtype=np.intp))
+        if len(indices) == 0:
+            raise ValueError(f"region {name!r} has no pixels")
+        if indices[0] < 0 or indices[-1] >= self.bad_pixels.size:
+            raise ValueError(f"region {name!r} is outside of the {self.shape} frame")
+        self.rois[name] = indices
+        self._maps = None
+
+    def remove(self, name):
+        del self.rois[name]
+        self._maps = None
+
+    def _compile(self):
+        if self._maps is None:
+            index = np.concatenate(list(self.rois.values()))
+            offsets = np.cumsum([0] + [len(v) for v in self.rois.values()][:-1])
+            good = (~self.bad_pixels.ravel()[index]).astype(float)
+            y, x = np.divmod(index, self.shape[1])
+            self._maps = index, offsets, good, x.astype(float), y.astype(float)
+        return self._maps
+
+    def compute(self, frames):
+        """
+        Computes all regions of a frame (height, width) or of a stack of frames (n, height, width).
+
+        Returns
+        -------
+        dict
+            {quantity: array (..., number of regions)} for the quantities
+            'sum', 'masked_sum', 'cen_x' and 'cen_y', regions in the order of rois.
+        """
+
+        if not self.rois:
+            raise ValueError("no regions defined")
+        index, offsets, good, x, y = self._compile()
+        frames = np.asarray(frames, dtype=float)
+        if frames.shape[-2:] != self.shape:
+            raise ValueError(f"frames of shape {frames.shape[-2:]}, the regions are for {self.shape}")
+        values = frames.reshape(frames.shape[:-2] + (-1,))[..., index]
+        masked = values*good
+        sums = np.add.reduceat(np.stack([values, masked, masked*x, masked*y]), offsets, axis=-1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return {'sum': sums[0], 'masked_sum': sums[1], 'cen_x': sums[2]/sums[1], 'cen_y': sums[3]/sums[1]}
+
+    def fields(self, prefix):
+        return [f'{prefix}_{name}_{q}' for name in self.rois for q in self.quantities]
+
+    def describe(self, prefix, source):
+        return {field: {'source': f'soft_roi:{source}', 'dtype': 'number', 'shape': []}
+                for field in self.fields(prefix)}
+
+    def read(self, frame, prefix, timestamp=None):
+        timestamp = time.time() if timestamp is None else timestamp
+        res = self.compute(frame)
+        values = np.stack([res[q] for q in self.quantities], axis=-1).ravel()
+        return {field: {'value': float(v), 'timestamp': timestamp} for field, v in zip(self.fields(prefix), values)}
+
+    def __repr__(self):
+        return f"<SoftROIEngine {len(self.rois)} regions, {int(self.bad_pixels.sum())} bad pixels>"
+
+
+def set_soft_rois(engine=None, det=None):
+    # reads the regions of engine with every lambda_det reading; None switches the software ROIs off
+    det = det or lambda_det
+    det.soft_roi = engine
+    if engine is not None:
+        det.image.enable_on_stage()
+        det.image.ensure_blocking()
+    else:
+        for key in ('enable', 'blocking_callbacks'):
+            det.image.stage_sigs.pop(key, None)
+
+
 # Impose Stats4 to be ROI4 if in the future we need to exclude bad pixels
 def set_defaut_stat_roi():
     yield from bps.mv(lambda_det.stats1.nd_array_port, 'ROI1')
@@ -0,0 +1,178 @@
+import functools
+import operator
+import time
+from collections import OrderedDict
+
+from ophyd.sim import NullStatus
+
+# One exposure setting for several detectors: the counting group sets the
+# timing of all its members with one set (bps.mv(counting_group, 2)), triggers
+# them together and reads them as one detector, so a scan over a mixed
+# detector list costs one trigger round-trip per point.
+#
+#   RE(count_group(2, [lambda_det, sclr, det2]))
+#   RE(bp.rel_scan([counting_group], hrmE, -5, 5, 11))
+
+
+# timing signals by detector type: (attribute which identifies the type, signals set to the exposure)
+COUNTING_TIMING = [
+    ('cam', ('cam.acquire_time', 'cam.acquire_period')),   # area detectors (lambda_det)
+    ('preset_time', ('preset_time',)),                     # scaler
+    ('averaging_time', ('averaging_time',)),               # quadEM electrometers
+]
+
+
+def _timing_signals(det):
+    for attr, signals in COUNTING_TIMING:
+        if hasattr(det, attr):
+            return [functools.reduce(getattr, sig.split('.'), det) for sig in signals]
+    raise TypeError(f"no exposure setting known for {det.name}")
+
+
+class CountingGroup:
+    """
+    Several detectors counting together with one exposure time.
+
+    set(exposure) sets the timing of all members in one grouped set (only the
+    members whose exposure differs from the last one the group set; nothing is
+    read back), trigger triggers all members at once and the
+    readings of the members are read as one detector, with the exposure time
+    and the dead time of every member (time from the trigger to the end of
+    its acquisition minus the exposure) as <group>_exposure_time and
+    <det>_dead_time.
+
+    Parameters
+    ----------
+    dets : list
+        members, e.g. [lambda_det, sclr, det2].
+    name : str, optional
+        The default is 'counting_group'.
+    """
+
+    def __init__(self, dets, name='counting_group'):
+        self.name = name
+        self.parent = None
+        self.dets = []
+        self.exposure_time = None
+        self._exposures = {}
+        self.dead_times = {}
+        self._trigger_time = None
+        for det in dets:
+            self.add(det)
+
+    def add(self, det):
+        if det not in self.dets:
+            _timing_signals(det)
+            self.dets.append(det)
+
+    def remove(self, det):
+        self.dets.remove(det)
+        self._exposures.pop(det.name, None)
+
+    # --- exposure
+    def set(self, exposure):
+        statuses = []
+        for det in self.dets:
+            if self._exposures.get(det.name) != exposure:
+                statuses.extend(sig.set(exposure) for sig in _timing_signals(det))
+                self._exposures[det.name] = exposure
+        self.exposure_time = exposure
+        return functools.reduce(operator.and_, statuses) if statuses else NullStatus()
+
+    @property
+    def position(self):
+        return self.exposure_time
+
+    def stop(self, *, success=False):
+        pass
+
+    # --- counting
+    def stage(self):
+        return [staged for det in self.dets for staged in det.stage()]
+
+    def unstage(self):
+        return [unstaged for det in reversed(self.dets) for unstaged in det.unstage()]
+
+    def trigger(self):
+        self._trigger_time = time.monotonic()
+        self.dead_times = {}
+        statuses = []
+        for det in self.dets:
+            st = det.trigger()
+            st.add_callback(functools.partial(self._triggered, det))
+            statuses.append(st)
+        return functools.reduce(operator.and_, statuses)
+
+    def _triggered(self, det, status):
+        elapsed = time.monotonic() - self._trigger_time
+        self.dead_times[det.name] = elapsed - (self.exposure_time or 0.)
+
+    def read(self):
+        res = OrderedDict()
+        for det in self.dets:
+            res.update(det.read())
+        now = time.time()
+        res[f'{self.name}_exposure_time'] = {'value': self.exposure_time or 0., 'timestamp': now}
+        for det in self.dets:
+            res[f'{det.name}_dead_time'] = {'value': self.dead_times.get(det.name, 0.), 'timestamp': now}
+        return res
+
+    def describe(self):
+        res = OrderedDict()
+        for det in self.dets:
+            res.update(det.describe())
+        res[f'{self.name}_exposure_time'] = {'source': f'{self.name}', 'dtype': 'number', 'shape': []}
+        for det in self.dets:
+            res[f'{det.name}_dead_time'] = {'source': f'{self.name}', 'dtype': 'number', 'shape': []}
+        return res
+
+    def read_configuration(self):
+        res = OrderedDict()
+        for det in self.dets:
+            res.update(det.read_configuration())
+        return res
+
+    def describe_configuration(self):
+        res = OrderedDict()
+        for det in self.dets:
+            res.update(det.describe_configuration())
+        return res
+
+    def collect_asset_docs(self):
+        for det in self.dets:
+            if hasattr(det, 'collect_asset_docs'):
+                yield from det.collect_asset_docs()
+
+    @property
+    def hints(self):
+        return {'fields': [field for det in self.dets for field in getattr(det, 'hints', {}).get('fields', [])]}
+
+    def __repr__(self):
+        return f"<CountingGroup {self.name}: {', '.join(det.name for det in self.dets)}, exposure {self.exposure_time}>"
+
+
+counting_group = CountingGroup([lambda_det, sclr])
+
+
+#*******************************************************************************************************
+def count_group(exp_time, dets=None, num=1, delay=None, md=None):
+    """
+    Count dets (default counting_group's members) together for exp_time seconds
+
+    Paramameters
+    ------------
+    exp_time : float
+        The exposure time of all detectors in seconds
+
+    dets : list, optional
+        The detectors; the default are the members of counting_group
+
+    num : int
+        The number of readings
+    """
+
+    group = counting_group if dets is None else CountingGroup(dets)
+    md = md or {}
+    md['count_time'] = exp_time
+    yield from bps.mv(group, exp_time)
+    return (yield from bp.count([group], num=num, delay=delay, md=md))
@@ -2,14 +2,17 @@ import bluesky.plans as bp
 import bluesky.plan_stubs as bps
 import bluesky.preprocessors as bpp
 import bluesky.callbacks.fitting
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import numpy as np
-import pandas as pd
-import lmfit
-from bluesky.callbacks import LiveFit
-from bluesky.callbacks.mpl_plotting import LiveGrid
+from bluesky.callbacks.mpl_plotting import LiveGrid, LivePlot
 from bluesky.suspenders import SuspendFloor
 from ophyd import EpicsSignal
-from tabulate import tabulate
+
+pd = lazy_import('pandas')
+lmfit = lazy_import('lmfit')
+tabulate = lazy_function('tabulate', 'tabulate')
 
 
 #*******************************************************************************************************
@@ -59,23 +62,188 @@ def peaks_stats_print(dets_name, peak_stats):
 #    print('*******************************************************\n')
 
 
+#*******************************************************************************************************
+class ChannelPeakStats:
+    """
+    Peak statistics of one channel of a MultiPeakStats, with the attributes of
+    PeakStats (x, y, com, cen, fwhm, max, min, crossings). ``stats['stats']``
+    returns the object itself, as peaks_stats_print expects.
+    """
+
+    def __init__(self, x, y):
+        self.x = x
+        self.y = y
+        self.x_data = self.y_data = None
+        self.com = self.cen = self.fwhm = self.max = self.min = None
+        self.crossings = np.array([])
+
+    def __getitem__(self, key):
+        return self if key == 'stats' else getattr(self, key)
+
+    def __repr__(self):
+        return (f"<ChannelPeakStats {self.y}: com={self.com}, cen={self.cen}, fwhm={self.fwhm}, "
+                f"max={self.max}, min={self.min}>")
+
+
+class MultiPeakStats:
+    """
+    Peak statistics of several detector fields against one motor in one pass.
+
+    All fields of the primary stream are collected into one array; at the
+    stop document com, cen, fwhm, max, min and crossings are computed for all
+    channels together, with the same definitions as bluesky's PeakStats.
+    The per-channel results are in ``views`` (or ``stats[y]``).
+    """
+
+    def __init__(self, x, ys):
+        self.x = x
+        self.ys = list(ys)
+        self.views = [ChannelPeakStats(x, y) for y in self.ys]
+        self._index = {y: n for n, y in enumerate(self.ys)}
+        self._data = np.empty((len(self.ys) + 1, 0))
+        self._npts = 0
+        self._descriptors = set()
+
+    def __getitem__(self, y):
+        return self.views[self._index[y]]
+
+    def __call__(self, name, doc):
+        if name == 'start':
+            self._data = np.empty((len(self.ys) + 1, 64))
+            self._npts = 0
+            self._descriptors = set()
+        elif name == 'descriptor' and doc.get('name') == 'primary':
+            self._descriptors.add(doc['uid'])
+        elif name == 'event' and doc['descriptor'] in self._descriptors:
+            self._append([[doc['data'][k]] for k in [self.x] + self.ys])
+        elif name == 'event_page' and doc['descriptor'] in self._descriptors:
+            self._append([doc['data'][k] for k in [self.x] + self.ys])
+        elif name == 'stop':
+            self.compute()
+
+    def _append(self, columns):
+        columns = np.asarray(columns, dtype=float)
+        n = columns.shape[1]
+        if self._npts + n > self._data.shape[1]:
+            grown = np.empty((self._data.shape[0], 2*(self._npts + n)))
+            grown[:, :self._npts] = self._data[:, :self._npts]
+            self._data = grown
+        self._data[:, self._npts:self._npts + n] = columns
+        self._npts += n
+
+    def compute(self):
+        data = self._data[:, :self._npts]
+        if data.shape[1] < 2:
+            return
+        data = data[:, np.argsort(data[0], kind='stable')]
+        x, Y = data[0], data[1:]
+        npts = len(x)
+        i_max, i_min = Y.argmax(axis=1), Y.argmin(axis=1)
+        y_max, y_min = Y.max(axis=1), Y.min(axis=1)
+
+        # center of mass in index space, mapped to x
+        total = Y.sum(axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            com = np.interp(Y @ np.arange(npts)/total, np.arange(npts), x)
+
+        # half-maximum crossings, interpolated linearly between the points
+        mid = (y_max + y_min)[:, None]/2
+        cross = np.diff((Y > mid).astype(np.int8), axis=1) != 0
+        dy = np.diff(Y, axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            pos = x[:-1] - (Y[:, :-1] - mid)*np.diff(x)/dy
+        ncross = cross.sum(axis=1)
+        with np.errstate(invalid='ignore'):
+            cen = np.where(cross, pos, 0.).sum(axis=1)/ncross
+        first = pos[np.arange(len(Y)), cross.argmax(axis=1)]
+        last = pos[np.arange(len(Y)), npts - 2 - cross[:, ::-1].argmax(axis=1)]
+        fwhm = np.abs(last - first)
+
+        for n, view in enumerate(self.views):
+            view.x_data, view.y_data = x, Y[n]
+            view.max = (x[i_max[n]], y_max[n])
+            view.min = (x[i_min[n]], y_min[n])
+            view.com = com[n] if np.isfinite(com[n]) else None
+            view.crossings = pos[n][cross[n]]
+            view.cen = cen[n] if ncross[n] else None
+            view.fwhm = fwhm[n] if ncross[n] >= 2 else None
+
+
+#*******************************************************************************************************
+# {y field: redraw statistics} of the throttled plots, accumulated over all scans
+live_plot_stats = {}
+
+
+class ThrottledLivePlot(LivePlot):
+    """
+    LivePlot which redraws at most max_fps times per second.
+
+    Events arriving in between only extend the data; the plot is redrawn with
+    all of them at the next allowed frame and always at the stop document.
+    The time spent redrawing is kept in ``stats`` and ``live_plot_stats``.
+    """
+
+    def __init__(self, y, *args, max_fps=5, **kwargs):
+        super().__init__(y, *args, **kwargs)
+        # LivePlot sets self.y only in start(), so the statistics are keyed on the argument
+        self.field = y if isinstance(y, str) else y.name
+        self.max_fps = max_fps
+        self._last_draw = 0.
+        self._stale = False
+        self.stats = live_plot_stats.setdefault(self.field, {'events': 0, 'redraws': 0, 'redraw_s': 0.})
+
+    def update_plot(self, force=False):
+        self.stats['events'] += 1
+        now = time.monotonic()
+        if not force and self.max_fps and now - self._last_draw < 1/self.max_fps:
+            self._stale = True
+            return
+        t0 = time.perf_counter()
+        super().update_plot()
+        self.stats['redraw_s'] += time.perf_counter() - t0
+        self.stats['redraws'] += 1
+        self._last_draw = now
+        self._stale = False
+
+    def stop(self, doc):
+        if self._stale:
+            self.stats['events'] -= 1
+            self.update_plot(force=True)
+        super().stop(doc)
+
+
+def print_plot_stats(reset=False):
+# prints the redraw cost per scan step of the throttled plots
+    print(f"{'plot':40s} {'events':>7s} {'redraws':>7s} {'redraw (s)':>10s} {'per step (ms)':>13s}")
+    for y, st in sorted(live_plot_stats.items()):
+        per_step = st['redraw_s']/st['events'] if st['events'] else 0.
+        print(f"{y[:40]:40s} {st['events']:7d} {st['redraws']:7d} {st['redraw_s']:10.3f} {1e3*per_step:13.2f}")
+    if reset:
+        for st in live_plot_stats.values():
+            st.update(events=0, redraws=0, redraw_s=0.)
+
+
 #*******************************************************************************************************
 def plotselect(det_name, mot_name):
-# creates a LivePlot object with given paramaters
-    myplt = LivePlot(det_name, x=mot_name, marker='o', markersize=6, ax=myaxs)
+# creates a LivePlot object with given paramaters, redrawn at most plotselect.max_fps times per second
+    myplt = ThrottledLivePlot(det_name, x=mot_name, marker='o', markersize=6, ax=myaxs, max_fps=plotselect.max_fps)
     return myplt
 
 
+plotselect.max_fps = 5
+
+
 #*******************************************************************************************************
-def dscan(mot, start, stop, steps, det, det_channel_picks=[0]):
-# performs relative scan of a detector DET channel 
+def dscan(mot, start, stop, steps, det, det_channel_picks=[0], per_step=None, md=None):
+# performs relative scan of a detector DET channel; per_step and md are passed to the scan
     myaxs.clear()
     
     subs_list = [plotselect(det.hints['fields'][det_channel], mot.name) for det_channel in  det_channel_picks]
-    stats_list = [PeakStats(mot.name, det.hints['fields'][det_channel]) for det_channel in det_channel_picks]
+    multi_stats = MultiPeakStats(mot.name, [det.hints['fields'][det_channel] for det_channel in det_channel_picks])
+    stats_list = multi_stats.views
 
-    subs_list.extend(stats_list)
-    plan = bpp.subs_wrapper(bp.rel_scan([det], mot, start, stop, steps), subs_list)
+    subs_list = threaded(subs_list, policy='drop') + threaded([multi_stats])
+    plan = bpp.subs_wrapper(bp.rel_scan([det], mot, start, stop, steps, per_step=per_step, md=md), subs_list)
         
     yield from plan
 
@@ -93,9 +261,10 @@ def ascan(mot, start, stop, steps, det, det_channel_picks=[0]):
     myaxs.clear()
     
     subs_list = [plotselect(det.hints['fields'][det_channel], mot.name) for det_channel in  det_channel_picks]
-    stats_list = [PeakStats(mot.name, det.hints['fields'][det_channel]) for det_channel in det_channel_picks]
+    multi_stats = MultiPeakStats(mot.name, [det.hints['fields'][det_channel] for det_channel in det_channel_picks])
+    stats_list = multi_stats.views
 
-    subs_list.extend(stats_list)
+    subs_list = threaded(subs_list, policy='drop') + threaded([multi_stats])
     plan = bpp.subs_wrapper(bp.scan([det], mot, start, stop, steps), subs_list)
         
     yield from plan
@@ -107,6 +276,115 @@ def ascan(mot, start, stop, steps, det, det_channel_picks=[0]):
     return stats_list
 
 
+#*******************************************************************************************************
+def _refine_positions(x, y, precision):
+# midpoints of the intervals wider than precision which hold a half-maximum crossing,
+# touch the maximum or where the signal changes steeply
+    order = np.argsort(x)
+    x, y = x[order], y[order]
+    width = np.diff(x)
+    span = y.max() - y.min()
+    above = y > (y.max() + y.min())/2
+    i_max = y.argmax()
+    near_max = np.zeros(len(width), bool)
+    near_max[max(i_max - 1, 0):i_max + 1] = True
+    steep = np.abs(np.diff(y)) > 0.25*span
+    split = (width > precision) & ((above[:-1] != above[1:]) | near_max | steep)
+    return list((x[:-1] + width/2)[split])
+
+
+def adaptive_scan(dets, mot, start, stop, num, field, precision=None, coarse=11, md=None):
+    """
+    Scans mot from start to stop on a coarse grid, then adds points only where
+    the signal of field changes, until the peak is located within precision.
+
+    Parameters
+    ----------
+    dets : list
+        detectors.
+    mot : positioner
+        motor to scan.
+    start, stop : float
+        absolute scan limits.
+    num : int
+        points of the equivalent fixed grid; the scan never takes more.
+    field : str
+        detector field which drives the refinement.
+    precision : float, optional
+        required spacing around the peak and the half-maximum crossings. The default is the fixed grid step.
+    coarse : int, optional
+        points of the first pass. The default is 11.
+    md : dict, optional
+        metadata.
+
+    Returns
+    -------
+    dict
+        points measured, fixed grid points and the points and estimated seconds saved.
+    """
+
+    precision = precision or abs(stop - start)/max(num - 1, 1)
+    _md = {'plan_name': 'adaptive_scan',
+           'detectors': [det.name for det in dets],
+           'motors': [mot.name],
+           'num_points': num,
+           'plan_args': {'detectors': list(map(repr, dets)), 'motor': repr(mot), 'start': start, 'stop': stop,
+                         'num': num, 'field': field, 'precision': precision, 'coarse': coarse},
+           'hints': {'dimensions': [(mot.hints['fields'], 'primary')]}}
+    _md.update(md or {})
+    xs, ys = [], []
+
+    @bpp.stage_decorator(list(dets) + [mot])
+    @bpp.run_decorator(md=_md)
+    def inner():
+        todo = list(np.linspace(start, stop, min(coarse, num)))
+        while todo and len(xs) < num:
+            for x in todo[:num - len(xs)]:
+                yield from bps.mv(mot, x)
+                reading = yield from bps.trigger_and_read(list(dets) + [mot])
+                xs.append(x)
+                ys.append(reading[field]['value'])
+            todo = _refine_positions(np.array(xs), np.array(ys), precision)
+
+    t0 = time.monotonic()
+    yield from inner()
+    elapsed = time.monotonic() - t0
+    report = {'points': len(xs), 'fixed_points': num, 'saved_points': num - len(xs),
+              'seconds': elapsed, 'saved_seconds': elapsed/max(len(xs), 1)*(num - len(xs))}
+    print(f"Adaptive scan: {len(xs)} points instead of {num}, "
+          f"saved {report['saved_points']} points (~{report['saved_seconds']:.1f} s)")
+    return report
+
+
+#*******************************************************************************************************
+def axis_position(mot):
+# readback of the axis a scalar move drives; pseudo positioners report a namedtuple of all their axes
+    return np.atleast_1d(mot.position)[0]
+
+
+#*******************************************************************************************************
+def adaptive_dscan(mot, start, stop, steps, det, det_channel_picks=[0], precision=None, coarse=11):
+# relative scan like dscan which measures densely only around the peak of the first picked channel
+    myaxs.clear()
+    fields = [det.hints['fields'][det_channel] for det_channel in det_channel_picks]
+    subs_list = [ThrottledLivePlot(field, x=mot.name, marker='o', markersize=6, linestyle='none', ax=myaxs,
+                                   max_fps=plotselect.max_fps) for field in fields]
+    multi_stats = MultiPeakStats(mot.name, fields)
+    stats_list = multi_stats.views
+
+    x0 = axis_position(mot)
+    plan = adaptive_scan([det], mot, x0 + start, x0 + stop, steps, fields[0], precision, coarse)
+    subs_list = threaded(subs_list, policy='drop') + threaded([multi_stats])
+    adaptive_dscan.report = yield from bpp.subs_wrapper(bpp.reset_positions_wrapper(plan, [mot]), subs_list)
+
+    print('\n')
+    for field, stats in zip(fields, stats_list):
+        peaks_stats_print(field, stats)
+        print("\n")
+
+    return stats_list
+
+
 #*******************************************************************************************************
 def gaussian(x, A, sigma, x0):
     return A*np.exp(-(x - x0)**2/(2 * sigma**2))
@@ -122,66 +400,149 @@ def stepdown(x, A, sigma, x0, b):
     return A*(1-1/(1+np.exp(-(x-x0)/sigma)))+b
 
 
+#*******************************************************************************************************
+# models for batch_fit: name -> (function, parameter names)
+FIT_MODELS = {
+    'gaussian': (gaussian, ('A', 'sigma', 'x0')),
+    'stepup': (stepup, ('A', 'sigma', 'x0', 'b')),
+    'stepdown': (stepdown, ('A', 'sigma', 'x0', 'b')),
+}
+
+
+def _initial_guesses(x, Y, model):
+# initial parameters for all channels (rows of Y) at once
+    y_max, y_min = Y.max(axis=1), Y.min(axis=1)
+    if model == 'gaussian':
+        dx = np.abs(np.diff(x)).mean()
+        width = (Y > ((y_max + y_min)/2)[:, None]).sum(axis=1)*dx
+        return {'A': y_max, 'sigma': np.maximum(width/2.3548, dx), 'x0': x[Y.argmax(axis=1)]}
+    mid = ((y_max + y_min)/2)[:, None]
+    return {'A': y_max - y_min, 'sigma': np.full(len(Y), 0.25), 'x0': x[np.abs(Y - mid).argmin(axis=1)], 'b': y_min}
+
+
+def _fit_curve(model, x, y, guess):
+# fits one curve of batch_fit
+    func, params = FIT_MODELS[model]
+    result = lmfit.Model(func).fit(y, x=x, **guess)
+    row = dict(result.values)
+    row.update({f'{p}_err': result.params[p].stderr for p in params})
+    row.update(redchi=result.redchi, success=result.success, message=result.message)
+    return row
+
+
+def batch_fit(uid=-1, x="hrmE", fields=None, models='gaussian', guess=None, max_workers=1, processes=False):
+    """
+    Fits several detector fields of one run.
+
+    Parameters
+    ----------
+    uid : int or str, optional
+        run, as for run_cache.table. The default is -1.
+    x : str, optional
+        independent variable. The default is "hrmE".
+    fields : list of str
+        dependent variables. The default is lambda_det_stats1_total ... stats6_total.
+    models : str or list of str, optional
+        FIT_MODELS name for all fields or one per field. The default is 'gaussian'.
+    guess : dict, optional
+        initial values for all fields, replacing the ones estimated from the data.
+    max_workers : int, optional
+        number of parallel fits; 1 fits one after the other in this process. The default is 1.
+    processes : bool, optional
+        fit in forked worker processes instead of threads. Forking the session, with
+        its channel access and callback threads, can deadlock; only for long fits.
+
+    Returns
+    -------
+    DataFrame
+        one row per field with the model, the fitted parameters, their
+        errors (``<name>_err``), redchi and success.
+    """
+
+    fields = fields or [f'lambda_det_stats{n}_total' for n in range(1, 7)]
+    models = [models]*len(fields) if isinstance(models, str) else list(models)
+    table = run_cache.table(uid)
+    xv = table[x].to_numpy(dtype=float)
+    Y = np.vstack([table[f].to_numpy(dtype=float) for f in fields])
+
+    # one vectorized guess per model over all of its channels
+    jobs = [None]*len(fields)
+    for model in set(models):
+        rows = [n for n, m in enumerate(models) if m == model]
+        start = _initial_guesses(xv, Y[rows], model)
+        for k, n in enumerate(rows):
+            jobs[n] = (model, xv, Y[n], dict({p: float(v[k]) for p, v in start.items()}, **(guess or {})))
+
+    workers = min(max_workers or 1, len(jobs))
+    if workers > 1 and processes and 'fork' in multiprocessing.get_all_start_methods():
+        # import lmfit before forking, the workers then share the models and the module
+        lmfit.Model
+        with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('fork')) as pool:
+            rows = list(pool.map(_fit_curve, *zip(*jobs)))
+    elif workers > 1:
+        with ThreadPoolExecutor(workers) as pool:
+            rows = list(pool.map(_fit_curve, *zip(*jobs)))
+    else:
+        rows = [_fit_curve(*job) for job in jobs]
+
+    result = pd.DataFrame(rows, index=pd.Index(fields, name='field'))
+    result.insert(0, 'model', models)
+    return result
+
+
 #*******************************************************************************************************
 def calc_lmfit(uid=-1, x="hrmE", channel=7):
     # Calculates fitting parameters for Gaussian function for energy scan with UID and Lambda channel
-    hdr = db[uid]
-    table = hdr.table()
+    table = run_cache.table(uid)
     model = lmfit.Model(gaussian)
     y = f'lambda_det_stats{channel}_total'
-    lf = LiveFit(model, y, {'x': x}, {'A': table[y].max(), 'sigma': 0.7, 'x0': table[x][table[y].argmax()+1]})
-    for name, doc in hdr.documents():
-        lf(name, doc)
-    gauss = gaussian(table[x], **lf.result.values)
+    result = model.fit(table[y], x=table[x], A=table[y].max(), sigma=0.7, x0=table[x][table[y].argmax()+1])
+    gauss = gaussian(table[x], **result.values)
     myaxs.plot(table[x], table[y], label=f"raw, channel={channel}", marker = 'o', linestyle = 'none')
     myaxs.plot(table[x], gauss.values, label=f"gaussian fit {channel}")
     myaxs.legend()
-    return lf.result.values
+    return result.values
 
 
 #*******************************************************************************************************
 def calc_stepup_fit(x):
     # Calculates fitting parameters for step up function for MCM slits scan
-    hdr = db[-1]
-    table = hdr.table()
-    model = lmfit.Model(stepup)
+    table = run_cache.table(-1)
     y = 'det2_current1_mean_value'
-    lf = LiveFit(model, y, {'x': x}, {'A': table[y].max(), 'sigma': 0.25, 'x0': 0, 'b':0})
-    for name, doc in hdr.documents():
-        lf(name, doc)
-    print(lf.result.values)
-    stup = stepup(table[x], **lf.result.values)
+    fit = batch_fit(-1, x, [y], 'stepup', guess={'A': table[y].max(), 'sigma': 0.25, 'x0': 0, 'b': 0}).iloc[0]
+    values = {p: fit[p] for p in FIT_MODELS['stepup'][1]}
+    print(values)
+    stup = stepup(table[x], **values)
     plt.clf()
     plt.plot(table[x], table[y], label=f"raw data", marker = 'o', linestyle = 'none')
     plt.plot(table[x], stup.values, label=f"data fit")
     plt.legend()
-    return lf.result.values['x0']
+    return values['x0']
 
 
 #*******************************************************************************************************
 def calc_stepdwn_fit(x):
     # Calculates fitting parameters for step down function for MCM slits scan
-    hdr = db[-1]
-    table = hdr.table()
-    model = lmfit.Model(stepdown)
+    table = run_cache.table(-1)
     y = 'det2_current1_mean_value'
-    lf = LiveFit(model, y, {'x': x}, {'A': table[y].max(), 'sigma': 0.25, 'x0': 0, 'b':0})
-    for name, doc in hdr.documents():
-        lf(name, doc)
-    print(lf.result.values)
-    stdw = stepdown(table[x], **lf.result.values)
+    fit = batch_fit(-1, x, [y], 'stepdown', guess={'A': table[y].max(), 'sigma': 0.25, 'x0': 0, 'b': 0}).iloc[0]
+    values = {p: fit[p] for p in FIT_MODELS['stepdown'][1]}
+    print(values)
+    stdw = stepdown(table[x], **values)
     plt.clf()
     plt.plot(table[x], table[y], label=f"raw data", marker = 'o', linestyle = 'none')
     plt.plot(table[x], stdw.values, label=f"data fit")
     plt.legend()
-    return lf.result.values['x0']
+    return values['x0']
 
 
 #*******************************************************************************************************
-def GCarbon_Qscan(exp_time=2):
+def GCarbon_Qscan(exp_time=2, rel_error=None, max_time=None):
     # Test plan for the energy resolution at Q=1.2 with the Glassy Carbon
+    # rel_error counts every point to that relative error of lambda_det_stats7_total,
+    # with exp_time as the minimum and max_time as the maximum exposure (see hrmE_dscan)
     Qq = [1.2]
-    yield from bps.mv(analyzer_slits.top, 1, analyzer_slits.bottom, -1, analyzer_slits.outboard, 1.5, analyzer_slits.inboard, -1.5)
+    yield from slit_preset(analyzer_slits, 'measure')
     yield from bps.mv(anapd, 25, whl, 0)
 #    myplt = plotselect('lambda_det_stats7_total', hrmE.name)
     myaxs.cla()
@@ -190,8 +551,14 @@ def GCarbon_Qscan(exp_time=2):
         for q in Qq:
             th = qq2th(q)
             yield from bps.mv(spec.tth, th)
-            yield from set_lambda_exposure(exp_time)
-            yield from dscan(hrmE, -10, 10, 100, lambda_det)
+            if rel_error is None:
+                yield from set_lambda_exposure(exp_time)
+                yield from dscan(hrmE, -10, 10, 100, lambda_det)
+            else:
+                # the same plots and peak statistics, with adaptive counting per point
+                counter = AdaptiveExposure(rel_error, exp_time, max_time or 10*exp_time)
+                yield from dscan(hrmE, -10, 10, 100, lambda_det, per_step=counter.per_step,
+                                 md={'count_time': exp_time, 'rel_error': rel_error, 'max_time': counter.max_time})
 
 #            yield from hrmE_dscan(-10, 10, 100, exp_time)
 #            peak_stats = bec.peaks
@@ -229,8 +596,15 @@ def DxtalTempCalc(uid=-1):
     bet = C1*(1 - np.exp(-C2*(T0-T1))) + C3*T0
     dE = []
     myaxs.cla()
+    # A and x0 from the data of each channel, sigma as in calc_lmfit
+    fits = batch_fit(uid, "hrmE", [f'lambda_det_stats{n}_total' for n in range(1,7)], 'gaussian', guess={'sigma': 0.7})
+    table = run_cache.table(uid)
     for n in range(1,7):
-        fit_par = calc_lmfit(uid, channel=n)
+        fit_par = fits.iloc[n-1]
+        y = f'lambda_det_stats{n}_total'
+        myaxs.plot(table["hrmE"], table[y], label=f"raw, channel={n}", marker = 'o', linestyle = 'none')
+        myaxs.plot(table["hrmE"], gaussian(table["hrmE"], fit_par['A'], fit_par['sigma'], fit_par['x0']).values, label=f"gaussian fit {n}")
+        myaxs.legend()
         if fit_par['A'] < 100:
             print('**********************************')
             print('         WARNING !')
@@ -285,9 +659,7 @@ def DxtalTempCalc(uid=-1):
 #*******************************************************************************************************
 def mcm_setup_prep():
 # Prepares the URA for the MCM and Analyzer Slits setup, namely opens the Slits and lowers the analyzer
-    hux = hrm2.read()['hrm2_ux']['value']
-    hdx = hrm2.read()['hrm2_dx']['value']
-    acyy = anc_xtal.y.read()['anc_xtal_y']['value']
+    hux, hdx, acyy = yield from rd_snapshot(hrm2.ux, hrm2.dx, anc_xtal.y)
     err = 0
     if hux > -5 or hdx > -5:
         print('*************************************\n')
@@ -300,7 +672,7 @@ def mcm_setup_prep():
     yield from bps.mv(spec.tth, 0)
 
     yield from bps.mv(anc_xtal.y, 0.5, whl, 2, anpd, 0)
-    yield from bps.mv(analyzer_slits.top, 2, analyzer_slits.bottom, -2, analyzer_slits.outboard, 2, analyzer_slits.inboard, -2)
+    yield from slit_preset(analyzer_slits, 'open')
     d21cnt = det2.current1.mean_value.read()['det2_current1_mean_value']['value']
     if d21cnt < 1.0e5:
         print('*************************************\n')
@@ -314,7 +686,7 @@ def mcm_setup_prep():
 def mcm_setup_post(y0):
 # Returns the motors to thier previous positions after the MCM and Analyzer Slits setup
     yield from bps.mv(anc_xtal.y, y0, whl, 0, anpd, -90)
-    yield from bps.mv(analyzer_slits.top, 1, analyzer_slits.bottom, -1, analyzer_slits.outboard, 1.5, analyzer_slits.inboard, -1.5)
+    yield from slit_preset(analyzer_slits, 'measure')
 
 
 #*******************************************************************************************************
@@ -428,53 +800,139 @@ def calculate_max_value(uid=-1, x="hrmE", y="lambda_det_stats7_total", delta=1,
 
     """
 
-    hdr = db[uid]
-    table = hdr.table()
-    #y = f'lambda_det_stats{channel}_total'
-    
-    #cp_df = df.copy()
-    
-    max_id = table[y].idxmax()
-    
+    table = run_cache.table(uid)
+    return _max_from_curve(table[x].to_numpy(), table[y].to_numpy(), delta, sampling)
+
+
+def _max_from_curve(x, y, delta=1, sampling=200):
+# maximum of the parabola through the highest point of y(x) and delta points on each side, see calculate_max_value
+    x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+    max_id = int(np.argmax(y))
+
     # low limit check
-    if max_id >= delta:
-        low_max_id = max_id - delta
-    else:
+    if max_id < delta:
         raise ValueError("Delta value is greater than the lower limit of the dataset")
-    
     # high limit check
-    if max_id < len(table[y])-delta-1:
-        high_max_id = max_id + delta + 1
-    else:
+    if max_id + delta >= len(y):
         raise ValueError("Delta value is greater than the upper limit of the dataset")
-    
-    y_values = table[y][low_max_id:high_max_id]
-    x_values = table[x][low_max_id:high_max_id]
-    
+
+    x_values = x[max_id - delta:max_id + delta + 1]
+    y_values = y[max_id - delta:max_id + delta + 1]
     model = np.poly1d(np.polyfit(x_values, y_values, 2))
-    
-    resampled_x_values = np.linspace(x_values.iloc[0],x_values.iloc[-1],sampling)
+
+    resampled_x_values = np.linspace(x_values[0], x_values[-1], sampling)
     resampled_y_values = model(resampled_x_values)
-    
-    resample_df = pd.DataFrame({x:resampled_x_values, y:resampled_y_values})
-    
-    new_max_id = resample_df[y].idxmax()
-    
-    return resample_df[x][new_max_id], resample_df[y][new_max_id]
+    new_max_id = np.argmax(resampled_y_values)
+    return resampled_x_values[new_max_id], resampled_y_values[new_max_id]
 
 
 #*******************************************************************************************************
-def ugap_setup():
-#   Scans the ID gap and sets it to max
+def ugap_setup(fly=False):
+#   Scans the ID gap and sets it to max; fly=True sweeps the gap once while tm1 samples continuously
     det = tm1
     yname = tm1.sum_all.mean_value.name
-    yield from bp.rel_scan([det], ivu22, -20, 20, 20)
-    x_pos = calculate_max_value(x="ivu22", y=yname, sampling=5)
-    yield from bps.mv(ivu22, x_pos)
+    if fly:
+        gaps, flux = yield from ugap_flyscan(-20, 20)
+        x_pos = _max_from_curve(gaps, flux, delta=max(1, len(gaps)//20), sampling=100)
+    else:
+        yield from bp.rel_scan([det], ivu22, -20, 20, 20)
+        x_pos = calculate_max_value(x="ivu22", y=yname, sampling=5)
+    yield from bps.mv(ivu22, x_pos[0])
     print('\n')
     print('ID gap alignment finished\n')
 
 
+#*******************************************************************************************************
+def ugap_calibration(energies=None, window=60, fly=True, degree=3, save=True):
+    """
+    Calibrates the undulator gap against the DCM Bragg angle.
+
+    At every energy the DCM moves to the Bragg angle (theta and z2), the gap
+    is scanned around the value of the current table and the gap of maximum
+    tm1 flux is found as in ugap_setup. A polynomial of the Bragg angle is
+    fitted to the maxima; the fit, sampled across the measured range, is the
+    new table. It is saved as the next version in UGAP_TABLE_DIR, which blE
+    loads at startup, and used right away. The table covers at least the
+    Bragg range of the table it replaces, where needed extrapolated by the
+    fit. The DCM and the gap return to their start positions at the end.
+
+    Parameters
+    ----------
+    energies : list or array, optional
+        energies (eV). The default is 15 energies from 7835 to 17700 eV.
+    window : float, optional
+        gap scan range around the table gap, +-window. The default is 60.
+    fly : bool, optional
+        sweep the gap with ugap_flyscan instead of a step scan. The default is True.
+    degree : int, optional
+        degree of the fitted polynomial. The default is 3.
+    save : bool, optional
+        save and use the new table. The default is True.
+
+    Returns
+    -------
+    dict
+        the table: measured 'points' (energy, bragg, gap), 'fit' and the sampled 'bragg' and 'gap'
+    """
+
+    energies = np.linspace(7835., 17700., 15) if energies is None else np.asarray(energies, dtype=float)
+    traj = energy_trajectory(energies, ugap=False)
+    # the current table, extrapolated by a polynomial beyond its range, is the start gap of every scan
+    guess = np.poly1d(np.polyfit(_Bragg, _ivu_gap, degree))
+    start = guess(traj['theta'])
+    in_table = (traj['theta'] >= min(_Bragg)) & (traj['theta'] <= max(_Bragg))
+    start[in_table] = gcalc(traj['theta'][in_table])
+
+    points = []
+    old_range = min(_Bragg), max(_Bragg)
+    theta0, z20, gap0 = yield from rd_snapshot(blE.theta, blE.z2, ivu22)
+
+    def scans():
+        for energy, theta, z2, g0 in zip(energies, traj['theta'], traj['z2'], start):
+            yield from bps.mv(blE.theta, theta, blE.z2, z2, ivu22, g0)
+            try:
+                if fly:
+                    gaps, flux = yield from ugap_flyscan(-window, window, md={'energy': energy})
+                    gap = _max_from_curve(gaps, flux, delta=max(1, len(gaps)//20), sampling=100)[0]
+                else:
+                    yield from bp.rel_scan([tm1], ivu22, -window, window, 40, md={'energy': energy})
+                    gap = calculate_max_value(x="ivu22", y=tm1.sum_all.mean_value.name, sampling=5)[0]
+            except (ValueError, RuntimeError) as ex:
+                # the flux maximum is at the edge of the scan, there was no flux or no tm1 samples
+                print(f"ugap_calibration: no gap maximum at {energy:g} eV ({ex}), point skipped")
+                continue
+            print(f"ugap_calibration: {energy:8.1f} eV, Bragg {theta:8.4f} deg, gap {gap:8.1f}")
+            points.append((float(energy), float(theta), float(gap)))
+
+    def restore():
+        yield from bps.mv(blE.theta, theta0, blE.z2, z20, ivu22, gap0)
+
+    yield from bpp.finalize_wrapper(scans(), restore())
+
+    if len(points) <= degree:
+        raise RuntimeError(f"ugap_calibration: {len(points)} gap maxima are too few for a fit of degree {degree}")
+    _, bragg, gap = np.array(points).T
+    coeffs = np.polyfit(bragg, gap, degree)
+    rms = float(np.sqrt(np.mean((np.polyval(coeffs, bragg) - gap)**2)))
+    # blE must reach at least the energies of the old table; the fit is extrapolated there
+    lo, hi = min(bragg.min(), old_range[0]), max(bragg.max(), old_range[1])
+    if lo < bragg.min() or hi > bragg.max():
+        print(f"Warning: the fit is extrapolated from the measured Bragg range {bragg.min():.3f} to "
+              f"{bragg.max():.3f} deg to the range of the old table, {lo:.3f} to {hi:.3f} deg")
+    grid = np.linspace(lo, hi, max(4*len(points), len(_Bragg)))
+    table = {'points': [dict(zip(('energy', 'bragg', 'gap'), p)) for p in points],
+             'fit': {'degree': degree, 'coefficients': list(coeffs), 'rms': rms,
+                     'measured_bragg': [float(bragg.min()), float(bragg.max())]},
+             'bragg': list(grid), 'gap': list(np.polyval(coeffs, grid)),
+             'profile_version': _profile_version(get_ipython().profile_dir.startup_dir)}
+    print(f"ugap_calibration: {len(points)} of {len(energies)} energies, fit rms {rms:.2f}")
+    if save:
+        path = save_ugap_table(table)
+        use_ugap_table(table)
+        print(f"Gap table written to {path} and used by blE")
+    return table
+
+
 #*******************************************************************************************************
 def LocalBumpSetup():
     """
@@ -541,7 +999,7 @@ def LocalBumpSetup():
             print('*****************************************')
             print('Correction was canceled\n')
 
-    crl_y_pos = crl.read()['crl_y']['value']
+    crl_y_pos = yield from rd_snapshot(crl.y)
     if crl_y_pos < 1:
         print('\n')
         print('Error: CRL is in the x-ray beam. Vertical beam correction is canceled.\n')
@@ -575,8 +1033,7 @@ def LocalBumpSetup():
 #*******************************************************************************************************
 def ccr_setup_prep():
 # Prepares the URA for the C crystal setup
-    hux = hrm2.read()['hrm2_ux']['value']
-    hdx = hrm2.read()['hrm2_dx']['value']
+    hux, hdx = yield from rd_snapshot(hrm2.ux, hrm2.dx)
     err = 0
     if hux > -5 or hdx > -5:
         print('*************************************')
@@ -587,19 +1044,19 @@ def ccr_setup_prep():
     airpad.set(1)
     det2.em_range.set(0)
     yield from bps.mv(spec.tth, 0)
-    acyy = anc_xtal.read()['anc_xtal_y']['value']
+    acyy = yield from rd_snapshot(anc_xtal.y)
     if acyy < 5:
         print('*************************************')
         print('Error: URA Y-position (acyy) is too low. Execution aborted\n')
         err = 1
         return err
 
-    yield from bps.mv(analyzer_slits.top, 0.1, analyzer_slits.bottom, -0.1, analyzer_slits.outboard, 1, analyzer_slits.inboard, -1)
+    yield from slit_preset(analyzer_slits, 'align')
     d21cnt = det2.current1.mean_value.read()['det2_current1_mean_value']['value']
     if d21cnt < 1.0e5:
         print('****************************************')
         print('Error: low intensity on D21. Execution aborted\n')
-        yield from bps.mv(analyzer_slits.top, 1, analyzer_slits.bottom, -1, analyzer_slits.outboard, 1.5, analyzer_slits.inboard, -1.5)
+        yield from slit_preset(analyzer_slits, 'measure')
         err = 1
         return err
     return err
@@ -607,7 +1064,7 @@ def ccr_setup_prep():
 #*******************************************************************************************************
 def ccr_setup_post():
 #   Recover positions after the C crystal alignment is finished
-    yield from bps.mv(anpd, -90, analyzer_slits.top, 1, analyzer_slits.bottom, -1, analyzer_slits.outboard, 1.5, analyzer_slits.inboard, -1.5)
+    yield from slit_preset(analyzer_slits, 'measure', anpd, -90)
     
 
 #*******************************************************************************************************
@@ -719,7 +1176,7 @@ def ccr_setup(s1=0, s2=0, s3=0):
 #*******************************************************************************************************
 def wcr_setup():
 #   Performs W crystal alignment
-    yield from bps.mv(anpd, -90, whl, 7, analyzer_slits.top, 0.1, analyzer_slits.bottom, -0.1, analyzer_slits.outboard, 1, analyzer_slits.inboard, -1)
+    yield from slit_preset(analyzer_slits, 'align', anpd, -90, whl, 7)
     yield from set_lambda_exposure(1)
     yield from bp.rel_scan([lambda_det], analyzer.wfth, -20, 20, 41)
     x_pos = calculate_max_value(x="analyzer.wfth", sampling=100)
@@ -754,7 +1211,7 @@ def hrm_setup():
 
     yield from hrm_in()
     yield from bps.mv(hrmE, 0, hrm2.d1, 0)
-    yield from bps.mv(s1.top, 0.5, s1.bottom, -0.5, s1.outboard, 1, s1.inboard, -1)
+    yield from slit_preset(s1, 'align')
     yield from bps.mv(hrm2.d2, 1, hrm2.d4, 0.7)
     yield from bps.mv(hrm2.d3, 2, hrm2.d5, 2)
     
@@ -814,7 +1271,7 @@ def gap_scan():
     
 
 #*******************************************************************************************************
-def DxtalMesh(cnum=4, whl_pos=6, ctime=1):
+def DxtalMesh(cnum=4, whl_pos=6, ctime=1, pause=600):
     """
     Performs mesh scan of the analyzer D crystals: analyzer vertical position versus energy.
     
@@ -826,16 +1283,17 @@ def DxtalMesh(cnum=4, whl_pos=6, ctime=1):
               position of the whl wheel
     ctime   : int, optional
               counting time for lambda detector
+    pause   : int, optional
+              waiting time after every cycle in seconds
     
     """
 
     spec_factory.prefix = "mesh_scan"
     yield from bps.mv(whl, whl_pos, spec.tth, 0)
-    yield from bps.mv(analyzer_slits.top, 0.01, analyzer_slits.bottom, -0.01, analyzer_slits.outboard, 1.5, analyzer_slits.inboard, -1.5)
-    yield from bps.mv(mcm_slits.outboard, 1.0, mcm_slits.inboard, -1.0)
+    yield from slit_preset(analyzer_slits, 'mesh')
+    yield from slit_preset(mcm_slits, 'measure')
     yield from set_lambda_exposure(ctime)
-    acyy = anc_xtal.y.read()['anc_xtal_y']['value']
-    hrmE_val = hrmE.read()['hrmE']['value']
+    acyy, hrmE_val = yield from rd_snapshot(anc_xtal.y, hrmE.energy)
 #    print(acyy, hrmE_val)
     bec.enable_plots()
 #    subs = [LiveGrid((150, 100), 'lambda_det_md7', xlabel='Energy', ylabel='acyy', ax=myaxs)]
@@ -843,7 +1301,7 @@ def DxtalMesh(cnum=4, whl_pos=6, ctime=1):
     for n in range(cnum):
         yield from bp.rel_grid_scan([lambda_det], anc_xtal.y, -0.875, 0.625, 150, hrmE, -10, 10, 100, False)
 #        yield from plan
-        sleep(600)
+        sleep(pause)
         
 #    LiveGrid((150, 100), 'lambda_det_md7')
     bec.disable_plots()
@@ -0,0 +1,501 @@
+import functools
+import math
+import operator
+import time
+import numpy as np
+from ophyd import Signal
+
+# Fly scans: the motors move continuously while the detector takes frames or
+# samples; the data are binned afterwards and emitted as the events a step scan
+# over the same grid would give, with the same field names, so the analysis
+# helpers (run_cache, calculate_max_value, batch_fit, ...) work unchanged.
+
+
+#*******************************************************************************************************
+def _record(signal, samples):
+# appends (timestamp, value) of every update of signal to samples; returns the subscription id
+    def cb(value=None, timestamp=None, **kwargs):
+        samples.append((timestamp if timestamp is not None else time.time(), value))
+    return signal.subscribe(cb, run=False)
+
+
+def _emit_events(values, names):
+# emits one primary event per row of values (npts, nfields) through soft signals named like the step scan
+    signals = [Signal(name=name, value=0.) for name in names]
+    for row in values:
+        for sig, val in zip(signals, row):
+            sig.put(float(val))
+        yield from bps.create('primary')
+        for sig in signals:
+            yield from bps.read(sig)
+        yield from bps.save()
+
+
+#*******************************************************************************************************
+def frame_values(counter, updates, initial, counter0=0, slack=0.):
+    """
+    Values of every frame from the monitor updates of a plugin value.
+
+    A monitor only fires when the value changes, so frames with the same value
+    as the frame before (e.g. zero counts) leave no update. The frames are
+    therefore taken from the updates of the plugin's array counter; the value
+    of a frame is the last value update at or before it (up to slack seconds
+    later, the value and the counter of one frame are posted together).
+
+    Parameters
+    ----------
+    counter : array (nupdates, 2)
+        timestamps and array counter values.
+    updates : array (nupdates, 2)
+        timestamps and values.
+    initial : float
+        value before the first update.
+    counter0 : int, optional
+        array counter before the first frame. The default is 0.
+    slack : float, optional
+        The default is 0.
+
+    Returns
+    -------
+    array (nframes, 2)
+        end-of-frame timestamps and values; a counter update which skipped
+        frames stands for all of them.
+    """
+
+    counter = np.asarray(counter, dtype=float).reshape(-1, 2)
+    updates = np.asarray(updates, dtype=float).reshape(-1, 2)
+    if len(updates):
+        i = np.searchsorted(updates[:, 0], counter[:, 0] + slack, side='right') - 1
+        values = np.where(i >= 0, updates[np.maximum(i, 0), 1], initial)
+    else:
+        values = np.full(len(counter), float(initial))
+    nframes = np.diff(counter[:, 1], prepend=counter0).astype(int).clip(min=0)
+    return np.column_stack([np.repeat(counter[:, 0], nframes), np.repeat(values, nframes)])
+
+
+def bin_frames(frames, readback, to_energy, energies, frames_per_point=1):
+    """
+    Bins fly-scan frames to the energy grid of the equivalent step scan.
+
+    The energy of every frame is the readback interpolated at the middle of
+    the frame; frames are summed into the nearest grid point and scaled to
+    frames_per_point frames per point.
+
+    Parameters
+    ----------
+    frames : array (nframes, 2)
+        end-of-frame timestamps and counts.
+    readback : array (nsamples, 2)
+        timestamps and motor readbacks.
+    to_energy : callable
+        converts readbacks to energies.
+    energies : array
+        grid of the step scan.
+    frames_per_point : int, optional
+        frames of one step-scan exposure. The default is 1.
+
+    Returns
+    -------
+    tuple of arrays
+        counts per point (NaN where no frame fell), frames per point and the
+        mean frame energy per point.
+    """
+
+    frames, readback = np.asarray(frames, dtype=float), np.asarray(readback, dtype=float)
+    npts = len(energies)
+    if len(frames) == 0 or len(readback) == 0:
+        return np.full(npts, np.nan), np.zeros(npts, int), np.full(npts, np.nan)
+    de = (energies[-1] - energies[0])/max(npts - 1, 1)
+    frame_time = np.median(np.diff(frames[:, 0])) if len(frames) > 1 else 0.
+    e_frame = to_energy(np.interp(frames[:, 0] - frame_time/2, readback[:, 0], readback[:, 1]))
+    idx = np.rint((e_frame - energies[0])/de).astype(int) if de else np.zeros(len(frames), int)
+    ok = (idx >= 0) & (idx < npts)
+    nframes = np.bincount(idx[ok], minlength=npts)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        counts = np.bincount(idx[ok], weights=frames[ok, 1], minlength=npts)/nframes*frames_per_point
+        e_mean = np.bincount(idx[ok], weights=e_frame[ok], minlength=npts)/nframes
+    return counts, nframes, e_mean
+
+
+#*******************************************************************************************************
+def hrmE_flyscan(start, stop, steps, exp_time, md=None, frames_per_point=1, relative=True):
+    """
+    Run an hrmE energy scan with continuous uof/dof motion and Lambda frames
+
+    uof and dof move together at the velocity which crosses one energy step
+    per exp_time while lambda_det acquires in multiple-image mode. The frames
+    are binned to the energies of the equivalent hrmE_dscan and emitted as
+    its events (hrmE, hrmE_uof, hrmE_dof, lambda_det_stats1..7_total). The
+    frames are counted from the array counters of the stats plugins (see
+    frame_values).
+
+    Paramameters
+    ------------
+    start, stop : float
+        The start and stop points, relative to the current energy if relative
+
+    steps : int
+        The number of points, as for hrmE_dscan
+
+    exp_time : float
+        The exposure time per point in seconds
+
+    frames_per_point : int
+        The number of Lambda frames per point
+
+    relative : bool
+        Relative (like hrmE_dscan) or absolute (like hrmE_ascan) scan
+    """
+
+    md = md or {}
+    md['count_time'] = exp_time
+    det = lambda_det
+    uof, dof = hrmE.uof, hrmE.dof
+    plugins = [getattr(det, f'stats{n}') for n in range(1, 8)]
+    stats = [plugin.total for plugin in plugins]
+
+    k = np.tan(np.deg2rad(_TB))/_EB
+    e0 = hrmE.position if relative else 0.
+    energies = e0 + np.linspace(start, stop, steps)
+    de = (stop - start)/max(steps - 1, 1)
+    frame_time = exp_time/frames_per_point
+    velocity = abs(de*k)/exp_time
+    accel = max(uof.acceleration.get(), dof.acceleration.get())
+    # the motion starts half a step plus the acceleration distance before the first point
+    direction = 1 if stop >= start else -1
+    e_margin = abs(de)/2 + velocity*accel/abs(k)
+    p_from, p_to = -k*(energies[0] - direction*e_margin), -k*(energies[-1] + direction*e_margin)
+    n_frames = math.ceil((abs(p_to - p_from)/velocity + 2*accel)/frame_time) + 10
+
+    old = {'velocity': (uof.velocity.get(), dof.velocity.get()),
+           'cam': [(sig, sig.get()) for sig in (det.cam.acquire_time, det.cam.acquire_period,
+                                                det.cam.image_mode, det.cam.num_images)]}
+    totals = {sig.name: [] for sig in stats}
+    counters = {sig.name: [] for sig in stats}
+    start_values = {}
+    readback = []
+
+    _md = {'plan_name': 'hrmE_flyscan',
+           'detectors': [det.name],
+           'motors': [hrmE.name],
+           'num_points': steps,
+           'plan_args': {'start': start, 'stop': stop, 'steps': steps, 'exp_time': exp_time,
+                         'frames_per_point': frames_per_point, 'relative': relative},
+           'hints': {'dimensions': [([hrmE.name], 'primary')]}}
+    _md.update(md)
+
+    def fly():
+        yield from bps.mv(uof, p_from, dof, p_from)
+        yield from bps.mv(det.cam.acquire_time, frame_time, det.cam.acquire_period, frame_time)
+        yield from bps.mv(det.cam.image_mode, 1, det.cam.num_images, n_frames)
+        yield from bps.mv(uof.velocity, velocity, dof.velocity, velocity)
+        for plugin, sig in zip(plugins, stats):
+            start_values[sig.name] = ((yield from bps.rd(sig)), (yield from bps.rd(plugin.array_counter)))
+        subs = [(sig, _record(sig, totals[sig.name])) for sig in stats]
+        subs += [(plugin.array_counter, _record(plugin.array_counter, counters[sig.name]))
+                 for plugin, sig in zip(plugins, stats)]
+        subs.append((uof.user_readback, _record(uof.user_readback, readback)))
+        try:
+            yield from bps.abs_set(det.cam.acquire, 1)
+            yield from bps.abs_set(uof, p_to, group='hrmE_fly')
+            yield from bps.abs_set(dof, p_to, group='hrmE_fly')
+            yield from bps.wait('hrmE_fly')
+            yield from bps.abs_set(det.cam.acquire, 0, wait=True)
+        finally:
+            for sig, sid in subs:
+                sig.unsubscribe(sid)
+
+    def emit():
+        to_energy = lambda pos: -pos/k
+        binned = []
+        for sig in stats:
+            initial, counter0 = start_values[sig.name]
+            frames = frame_values(counters[sig.name], totals[sig.name], initial, counter0, frame_time/2)
+            binned.append(bin_frames(frames, readback, to_energy, energies, frames_per_point))
+        # positions from the frames of the hinted channel, stats7
+        _, nframes, e_mean = binned[-1]
+        pos = np.where(nframes > 0, e_mean, energies)
+        if (nframes == 0).any():
+            print(f"Warning: no frames at {(nframes == 0).sum()} of {steps} points, "
+                  f"increase frames_per_point")
+        names = [hrmE.name, uof.user_readback.name, dof.user_readback.name] + [sig.name for sig in stats]
+        columns = [pos, -k*pos, -k*pos] + [counts for counts, _, _ in binned]
+        yield from _emit_events(np.column_stack(columns), names)
+
+    def restore():
+        yield from bps.mv(uof.velocity, old['velocity'][0], dof.velocity, old['velocity'][1])
+        for sig, val in old['cam']:
+            yield from bps.mv(sig, val)
+        if relative:
+            yield from bps.mv(hrmE, e0)
+
+    @bpp.finalize_decorator(restore)
+    @bpp.stage_decorator([det])
+    @bpp.run_decorator(md=_md)
+    def inner():
+        yield from fly()
+        yield from emit()
+
+    return (yield from inner())
+
+
+#*******************************************************************************************************
+def bin_samples(samples, readback, edges, sample_time=0.):
+# mean of the samples (timestamp, value) in the readback bins given by edges; the readback of every
+# sample is interpolated at its middle; returns bin positions, means and samples per bin
+    samples, readback = np.asarray(samples, dtype=float), np.asarray(readback, dtype=float)
+    nbins = len(edges) - 1
+    if len(samples) == 0 or len(readback) == 0:
+        return np.full(nbins, np.nan), np.full(nbins, np.nan), np.zeros(nbins, int)
+    # only samples taken while the readback changed
+    inside = (samples[:, 0] >= readback[0, 0]) & (samples[:, 0] <= readback[-1, 0])
+    samples = samples[inside]
+    pos = np.interp(samples[:, 0] - sample_time/2, readback[:, 0], readback[:, 1])
+    idx = np.searchsorted(edges, pos, side='right') - 1 if edges[-1] > edges[0] \
+        else nbins - np.searchsorted(edges[::-1], pos, side='left')
+    ok = (idx >= 0) & (idx < nbins)
+    counts = np.bincount(idx[ok], minlength=nbins)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = np.bincount(idx[ok], weights=samples[ok, 1], minlength=nbins)/counts
+        pos_mean = np.bincount(idx[ok], weights=pos[ok], minlength=nbins)/counts
+    return pos_mean, means, counts
+
+
+#*******************************************************************************************************
+def ugap_flyscan(start=-20, stop=20, points=200, averaging_time=0.05, md=None):
+    """
+    Sweep the undulator gap once while tm1 samples continuously
+
+    ivu22 moves from start to stop (relative to the current gap) in one move
+    while tm1 acquires in continuous mode. Every tm1.sum_all sample is matched
+    to the gap readback at its timestamp; the samples are averaged in points
+    gap bins and emitted as the events (ivu22, tm1_sum_all_mean_value) of
+    the equivalent ivu22 rel_scan. The gap is left at the end of the sweep.
+
+    Paramameters
+    ------------
+    start, stop : float
+        The sweep limits, relative to the current gap
+
+    points : int
+        The number of gap bins
+
+    averaging_time : float
+        The tm1 averaging time per sample in seconds
+
+    Returns
+    -------
+    gaps, flux : arrays
+        The mean gap and tm1 sum of the bins with samples
+    """
+
+    det, sig = tm1, tm1.sum_all.mean_value
+    g0 = ivu22.position
+    edges = g0 + np.linspace(start, stop, points + 1)
+    old = [(s, s.get()) for s in (det.acquire_mode, det.averaging_time)]
+    samples, readback = [], []
+    result = {}
+
+    _md = {'plan_name': 'ugap_flyscan',
+           'detectors': [det.name],
+           'motors': [ivu22.name],
+           'num_points': points,
+           'plan_args': {'start': start, 'stop': stop, 'points': points, 'averaging_time': averaging_time},
+           'hints': {'dimensions': [([ivu22.readback.name], 'primary')]}}
+    _md.update(md or {})
+
+    def fly():
+        yield from bps.mv(ivu22, edges[0])
+        yield from bps.abs_set(det.acquire, 0, wait=True)
+        yield from bps.mv(det.acquire_mode, 0, det.averaging_time, averaging_time)
+        subs = [(sig, _record(sig, samples)), (ivu22.readback, _record(ivu22.readback, readback))]
+        try:
+            yield from bps.abs_set(det.acquire, 1)
+            yield from bps.mv(ivu22, edges[-1])
+            yield from bps.abs_set(det.acquire, 0, wait=True)
+        finally:
+            for s, sid in subs:
+                s.unsubscribe(sid)
+
+    def emit():
+        gaps, flux, counts = bin_samples(samples, readback, edges, averaging_time)
+        ok = counts > 0
+        if not ok.any():
+            raise RuntimeError("ugap_flyscan: no tm1 samples during the gap sweep")
+        if (~ok).any():
+            print(f"Warning: no samples in {(~ok).sum()} of {points} gap bins, "
+                  f"decrease points or averaging_time")
+        result['curve'] = gaps[ok], flux[ok]
+        yield from _emit_events(np.column_stack(result['curve']), [ivu22.readback.name, sig.name])
+
+    def restore():
+        for s, val in old:
+            yield from bps.mv(s, val)
+
+    @bpp.finalize_decorator(restore)
+    @bpp.run_decorator(md=_md)
+    def inner():
+        yield from fly()
+        yield from emit()
+
+    yield from inner()
+    return result['curve']
+
+
+#*******************************************************************************************************
+def _decimate(values, decimation):
+# means of consecutive blocks of decimation values; an incomplete last block is dropped
+    n = len(values)//decimation*decimation
+    return np.asarray(values[:n], dtype=float).reshape(-1, decimation).mean(axis=1)
+
+
+class EMStream:
+    """
+    Flyer streaming the time-series buffers of quadEM electrometers.
+
+    At kickoff every electrometer acquires continuously and its time-series
+    plugin records num_points samples of the four currents and their sum,
+    one every period seconds. complete stops the recording; collect_pages
+    reads the buffers, averages blocks of decimation samples and yields one
+    event page per electrometer (stream '<det>_ts', fields like
+    tm1_ts_current1). The decimated arrays, with '<det>_ts_time', are also
+    kept in the arrays attribute. The settings are restored after the buffers
+    are read (writing TSNumPoints clears them), or by stop.
+
+    Use em_stream for a timed acquisition, or to record next to a step scan::
+
+        RE(bpp.fly_during_wrapper(dscan(...), [EMStream([tm1], 0.01, 10000, 10)]))
+    """
+
+    def __init__(self, dets, period=0.01, num_points=2048, decimation=1, name='em_stream'):
+        self.dets = list(dets)
+        self.period = period
+        self.num_points = int(num_points)
+        self.decimation = max(1, int(decimation))
+        self.name = name
+        self.parent = None
+        self.arrays = {}
+        self._old = []
+        self._t0 = None
+
+    def _channels(self, det):
+        return [getattr(det.ts, ch) for ch in det.ts.channels]
+
+    def _configure(self, sig, value):
+        self._old.append((sig, sig.get()))
+        sig.put(value, wait=True)
+
+    def kickoff(self):
+        self._old = []
+        for det in self.dets:
+            self._configure(det.acquire, 0)
+            self._configure(det.acquire_mode, 0)
+            self._configure(det.ts.acquire_mode, 0)
+            self._configure(det.ts.num_points, self.num_points)
+            self._configure(det.ts.averaging_time, self.period)
+        for det in self.dets:
+            det.acquire.put(1)
+        self._t0 = time.time()
+        return functools.reduce(operator.and_, [det.ts.acquire.set(1) for det in self.dets])
+
+    def complete(self):
+        return functools.reduce(operator.and_, [det.ts.acquire.set(0) for det in self.dets])
+
+    def stop(self, *, success=False):
+        for det in self.dets:
+            det.ts.acquire.put(0)
+        self._restore()
+
+    def _restore(self):
+        # the electrometers stop before their settings are restored
+        for det in self.dets:
+            det.acquire.put(0, wait=True)
+        for sig, value in reversed(self._old):
+            sig.put(value)
+        self._old = []
+
+    def describe_collect(self):
+        return {f'{det.name}_ts': {sig.name: {'source': sig.pvname, 'dtype': 'number', 'shape': []}
+                                   for sig in self._channels(det)}
+                for det in self.dets}
+
+    def collect_pages(self):
+        self.arrays = {}
+        pages = []
+        try:
+            for det in self.dets:
+                det.ts.read_buffers.put(1, wait=True)
+                n = int(det.ts.current_point.get())
+                data = {sig.name: _decimate(np.asarray(sig.get())[:n], self.decimation) for sig in self._channels(det)}
+                npts = len(data[det.ts.sum_all.name])
+                times = self._t0 + (np.arange(npts) + 0.5)*self.decimation*det.ts.time_per_point.get()
+                self.arrays.update(data)
+                self.arrays[f'{det.name}_ts_time'] = times
+                if npts:
+                    pages.append({'time': times.tolist(),
+                                  'data': {key: arr.tolist() for key, arr in data.items()},
+                                  'timestamps': {key: times.tolist() for key in data},
+                                  'filled': {}})
+        finally:
+            # all buffers are read before the settings change
+            self._restore()
+        yield from pages
+
+    def collect(self):
+        # event by event, for consumers without event page support
+        for page in self.collect_pages():
+            for i, t in enumerate(page['time']):
+                yield {'time': t,
+                       'data': {key: values[i] for key, values in page['data'].items()},
+                       'timestamps': {key: values[i] for key, values in page['timestamps'].items()}}
+
+
+def em_stream(dets, duration, period=0.01, decimation=1, md=None):
+    """
+    Record the quadEM time-series buffers of dets for duration seconds
+
+    Paramameters
+    ------------
+    dets : list
+        Electrometers, e.g. [tm1, det2]
+
+    duration : float
+        The recording time in seconds
+
+    period : float
+        The time per sample in seconds
+
+    decimation : int
+        The number of samples averaged into one event
+
+    Returns
+    -------
+    dict
+        The decimated arrays by field name, with '<det>_ts_time'
+    """
+
+    num_points = math.ceil(duration/period)
+    flyer = EMStream(dets, period, num_points, decimation)
+    _md = {'plan_name': 'em_stream',
+           'detectors': [det.name for det in dets],
+           'num_points': num_points//flyer.decimation,
+           'plan_args': {'dets': [det.name for det in dets], 'duration': duration,
+                         'period': period, 'decimation': decimation}}
+    _md.update(md or {})
+
+    def cleanup():
+        # settings of an interrupted recording; after collect there is nothing left to restore
+        if flyer._old:
+            flyer.stop()
+        yield from bps.null()
+
+    @bpp.finalize_decorator(cleanup)
+    @bpp.run_decorator(md=_md)
+    def inner():
+        yield from bps.kickoff(flyer, wait=True)
+        yield from bps.sleep(duration)
+        yield from bps.complete(flyer, wait=True)
+        yield from bps.collect(flyer)
+
+    yield from inner()
+    return flyer.arrays
@@ -1,7 +1,10 @@
+import math
+
 import bluesky.plans as bp
 import bluesky.preprocessors as bpp
 import bluesky.plan_stubs as bps
 from bluesky.callbacks.fitting import PeakStats
+from ophyd import Signal
 
 
 #*******************************************************************************************************
@@ -9,7 +12,7 @@ def dcm_setup():
     det = tm1
     yname = tm1.sum_all.mean_value.name
     ps = PeakStats(dcm.p1.user_readback.name, yname)
-    yield from bpp.subs_wrapper(bp.rel_scan([det], dcm.p1, -80, 80, 40), ps)
+    yield from bpp.subs_wrapper(bp.rel_scan([det], dcm.p1, -80, 80, 40), threaded([ps]))
 
     cen = ps.cen
     com = ps.com
@@ -54,7 +57,88 @@ def th2qq(Th,En=9.1317):
 
 
 #*******************************************************************************************************
-def hrmE_dscan(start, stop, steps, exp_time, md=None):
+class AdaptiveExposure:
+    """
+    Counts every scan point until the relative statistical error of one
+    Lambda statistics total reaches rel_error, with min_time <= exposure <= max_time.
+
+    The first exposure of a point is the time which gives 1/rel_error**2
+    counts at the count rate of the point before (min_time at the first
+    point); if the counts fall short, the rest is predicted from the rate of
+    the point and counted in further exposures. Exposures are rounded up to
+    multiples of min_time, so points with similar rates reuse the Lambda
+    exposure, which is only set when it changes. The counts of all
+    exposures are summed; the event holds the summed stats totals under
+    their usual names and the exposure time as <det>_exposure_time. Use
+    per_step as the per_step of a bluesky scan.
+    """
+
+    def __init__(self, rel_error, min_time, max_time, det=None, field=None):
+        if not 0 < rel_error < 1:
+            raise ValueError(f"rel_error must be between 0 and 1, not {rel_error}")
+        if not 0 < min_time <= max_time:
+            raise ValueError(f"need 0 < min_time <= max_time, not {min_time}, {max_time}")
+        self.det = det or lambda_det
+        self.stats = [getattr(self.det, f'stats{n}').total for n in range(1, 8)]
+        field = field or self.stats[-1].name
+        self.index = [sig.name for sig in self.stats].index(field)
+        self.target = rel_error**-2
+        self.min_time, self.max_time = min_time, max_time
+        self.signals = [Signal(name=sig.name, value=0., kind=sig.kind) for sig in self.stats]
+        self.exposure = Signal(name=f'{self.det.name}_exposure_time', value=0.)
+        self._set_time = None
+        self._rate = None
+
+    def _exposure(self, counts, rate, counted=0.):
+        # exposure for the missing counts at rate, a multiple of min_time within the limits
+        t = counts/rate if rate > 0 else self.max_time
+        t = self.min_time*math.ceil(max(t, self.min_time)/self.min_time*(1 - 1e-9))
+        return min(t, self.max_time - counted)
+
+    def count(self):
+        # summed stats totals and the total exposure of one point
+        totals, exposure = np.zeros(len(self.stats)), 0.
+        t = self.min_time if self._rate is None else self._exposure(self.target, self._rate)
+        while True:
+            if t != self._set_time:
+                yield from set_lambda_exposure(t)
+                self._set_time = t
+            yield from bps.trigger(self.det, wait=True)
+            reading = yield from bps.read(self.det)
+            totals += [reading[sig.name]['value'] for sig in self.stats]
+            exposure += t
+            n = totals[self.index]
+            self._rate = n/exposure
+            if n >= self.target or exposure >= self.max_time*(1 - 1e-9):
+                return totals, exposure
+            t = self._exposure(self.target - n, self._rate, exposure)
+
+    def per_step(self, detectors, step, pos_cache):
+        yield from bps.move_per_step(step, pos_cache)
+        totals, exposure = yield from self.count()
+        for sig, value in zip(self.signals, totals):
+            sig.put(float(value))
+        self.exposure.put(exposure)
+        yield from bps.create('primary')
+        for obj in list(step) + self.signals + [self.exposure]:
+            yield from bps.read(obj)
+        yield from bps.save()
+
+
+def _hrmE_scan(scan, start, stop, steps, exp_time, md, rel_error, max_time):
+    # hrmE_dscan and hrmE_ascan; with rel_error exp_time is the minimum exposure
+    md = md or {}
+    md['count_time'] = exp_time
+    if rel_error is None:
+        yield from set_lambda_exposure(exp_time)
+        return (yield from scan([lambda_det], hrmE, start, stop, steps, md=md))
+    counter = AdaptiveExposure(rel_error, exp_time, max_time or 10*exp_time)
+    md.update({'rel_error': rel_error, 'max_time': counter.max_time})
+    return (yield from scan([lambda_det], hrmE, start, stop, steps, per_step=counter.per_step, md=md))
+
+
+#*******************************************************************************************************
+def hrmE_dscan(start, stop, steps, exp_time, md=None, rel_error=None, max_time=None):
     """
     Run a relative (delta) hmre scan with lambda and scalar
 
@@ -68,20 +152,23 @@ def hrmE_dscan(start, stop, steps, exp_time, md=None):
 
     t : float
         The exposure time in seconds
-    """
 
-    md = md or {}
-    md['count_time'] = exp_time
+    rel_error : float, optional
+        Count every point until the relative error of lambda_det_stats7_total
+        is rel_error (see AdaptiveExposure); exp_time is then the minimum exposure
+
+    max_time : float, optional
+        The maximum exposure per point with rel_error, default 10*exp_time
+    """
 
-    yield from set_lambda_exposure(exp_time)
     return (
 #        yield from dscan(hrmE, start, stop, steps, [lambda_det], det_channel=[6])
-        yield from bp.rel_scan([lambda_det], hrmE, start, stop, steps, md=md)
+        yield from _hrmE_scan(bp.rel_scan, start, stop, steps, exp_time, md, rel_error, max_time)
     )
 
 
 #*******************************************************************************************************
-def hrmE_ascan(start, stop, steps, exp_time, md=None):
+def hrmE_ascan(start, stop, steps, exp_time, md=None, rel_error=None, max_time=None):
     """
     Run a absolute hmre scan with lambda and scalar
 
@@ -95,13 +182,62 @@ def hrmE_ascan(start, stop, steps, exp_time, md=None):
 
     t : float
         The exposure time in seconds
-    """
 
-    md = md or {}
-    md['count_time'] = exp_time
+    rel_error, max_time : float, optional
+        Adaptive counting time, as for hrmE_dscan
+    """
 
-    yield from set_lambda_exposure(exp_time)
     return (
-        yield from bp.scan([lambda_det], hrmE, start, stop, steps, md=md)
+        yield from _hrmE_scan(bp.scan, start, stop, steps, exp_time, md, rel_error, max_time)
     )
 
+
+#*******************************************************************************************************
+def blE_scan(dets, energies, gap_tolerance=None, md=None):
+    """
+    Scan the beamline energy over a list of energies
+
+    The theta/z2/gap trajectory is computed and checked against the motor
+    limits before the scan (energy_trajectory). At every point theta, z2 and
+    the undulator gap move together; a gap move smaller than gap_tolerance
+    from the last gap moved to is skipped. Every event also records the
+    energy (blE_energy), which is the plotted dimension.
+
+    Paramameters
+    ------------
+    dets : list
+        The detectors
+
+    energies : list or array
+        The energies in eV
+
+    gap_tolerance : float, optional
+        The smallest gap change which moves the undulator, default blE_scan.gap_tolerance
+    """
+
+    tol = blE_scan.gap_tolerance if gap_tolerance is None else gap_tolerance
+    traj = energy_trajectory(energies)
+    skipped = []
+
+    def per_step(detectors, step, pos_cache):
+        last = pos_cache[blE.ugap]
+        if last is None:
+            last = blE.ugap.position
+        if abs(step[blE.ugap] - last) < tol:
+            skipped.append(step[blE.ugap])
+            moves = {motor: pos for motor, pos in step.items() if motor is not blE.ugap}
+        else:
+            moves = step
+        yield from bps.move_per_step(moves, pos_cache)
+        yield from bps.trigger_and_read(list(detectors) + list(step) + [blE.energy])
+
+    _md = {'plan_name': 'blE_scan', 'energies': list(traj['energy']), 'gap_tolerance': tol,
+           'hints': {'dimensions': [([blE.energy.readback.name], 'primary')]}}
+    _md.update(md or {})
+    uid = yield from bp.list_scan(dets, blE.theta, list(traj['theta']), blE.z2, list(traj['z2']),
+                                  blE.ugap, list(traj['ugap']), per_step=per_step, md=_md)
+    print(f"blE_scan: {len(skipped)} of {len(traj['energy'])} gap moves skipped (tolerance {tol})")
+    return uid
+
+
+blE_scan.gap_tolerance = 5.   # ivu22 gap units (um), well below the width of the harmonic
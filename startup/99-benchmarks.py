@@ -0,0 +1,312 @@
+import json
+import time
+from pathlib import Path
+
+import numpy as np
+
+# Benchmarks of the alignment and scan plans. In simulation mode (IXS_SIM=1,
+# see 00-simulation.py) run
+#
+#   results = benchmark_plans()
+#   compare_benchmarks('benchmark_<old>.json', results)
+#
+# Each plan is timed with the number of motor moves, detector triggers, events
+# and the time spent in RunEngine callbacks; the results are written as JSON
+# into the 'benchmarks' directory of the profile.
+
+
+# name: (plan factory, preparation plan factory or None); preparations are not timed
+BENCHMARK_PLANS = {
+    'dscan': (lambda: dscan(hrm2.uth, -0.05, 0.05, 20, det4), None),
+    'ascan': (lambda: ascan(hrm2.uth, -0.05, 0.05, 20, det4), None),
+    'adaptive_dscan': (lambda: adaptive_dscan(hrm2.uth, -0.05, 0.05, 20, det4), None),
+    'align_with_fit': (lambda: align_with_fit([det4], hrm2.uth, -0.05, 0.05, 20), None),
+    'align_adaptive': (lambda: align_with_fit([det4], hrm2.uth, -0.05, 0.05, 20, precision=0.005), None),
+    'hrmE_dscan': (lambda: hrmE_dscan(-5, 5, 10, 1), None),
+    'hrmE_dscan_adaptive': (lambda: hrmE_dscan(-5, 5, 10, 0.2, rel_error=0.05, max_time=2), None),
+    'blE_scan': (lambda: blE_scan([tm1], np.linspace(9100., 9130., 31)), None),
+    'count_group': (lambda: count_group(0.5, [lambda_det, sclr, det2], num=5), None),
+    'check_zero': (lambda: check_zero(gaps=100, exp_time=0.1), None),
+    'ugap_setup': (lambda: ugap_setup(), None),
+    'ugap_setup_fly': (lambda: ugap_setup(fly=True), None),
+    'em_stream': (lambda: em_stream([tm1, det2], 1., period=0.01, decimation=10), None),
+    'san_setup': (lambda: san_setup(), hrm_out),
+    'ccr_setup': (lambda: ccr_setup(1, 1, 1), hrm_out),
+    'mcm_setup': (lambda: mcm_setup(1, 0), hrm_out),
+    'wcr_setup': (lambda: wcr_setup(), None),
+    'DxtalMesh': (lambda: DxtalMesh(cnum=1, ctime=0.01, pause=0), None),
+    'hrm_setup': (lambda: hrm_setup(), None),
+}
+
+
+class PlanCounter:
+    """
+    Counts motor moves, detector triggers and events of the RunEngine and the
+    time spent in its document callbacks while used as a context manager.
+    """
+
+    def __init__(self, RE):
+        self.RE = RE
+        self.moves = self.triggers = self.events = 0
+        self.callbacks_s = 0.
+
+    def _msg_hook(self, msg):
+        if msg.command == 'set':
+            self.moves += 1
+        elif msg.command == 'trigger':
+            self.triggers += 1
+        if self._prev_hook is not None:
+            self._prev_hook(msg)
+
+    def _process(self, name, doc):
+        t0 = time.perf_counter()
+        try:
+            return self._dispatch(name, doc)
+        finally:
+            self.callbacks_s += time.perf_counter() - t0
+            if name == 'event':
+                self.events += 1
+
+    def __enter__(self):
+        self._prev_hook = self.RE.msg_hook
+        self._dispatch = self.RE.dispatcher.process
+        self.RE.msg_hook = self._msg_hook
+        self.RE.dispatcher.process = self._process
+        return self
+
+    def __exit__(self, *exc):
+        self.RE.msg_hook = self._prev_hook
+        del self.RE.dispatcher.process
+        return False
+
+
+#*******************************************************************************************************
+def benchmark_plans(plans=None, repeat=1, baseline=None, path=None, allow_hardware=False):
+    """
+    Runs the alignment and scan plans and records their cost.
+
+    Parameters
+    ----------
+    plans : list of str, optional
+        names from BENCHMARK_PLANS. The default is all of them, in order.
+    repeat : int, optional
+        number of runs of every plan. The default is 1.
+    baseline : str, optional
+        JSON file of an earlier benchmark to compare with.
+    path : str, optional
+        output JSON file. The default is benchmarks/benchmark_<date>.json in the profile.
+    allow_hardware : bool, optional
+        run the plans although simulation mode is off, i.e. on the beamline.
+
+    Returns
+    -------
+    dict
+        the benchmark report which is written to ``path``.
+    """
+
+    if not IXS_SIMULATION and not allow_hardware:
+        raise RuntimeError("The benchmarks move beamline motors; start the profile with IXS_SIM=1 "
+                           "or pass allow_hardware=True.")
+    if path is None:
+        path = Path(get_ipython().profile_dir.location) / 'benchmarks' / time.strftime('benchmark_%Y%m%d-%H%M%S.json')
+    path = Path(path)
+
+    results = {}
+    for name in plans or BENCHMARK_PLANS:
+        plan, prepare = BENCHMARK_PLANS[name]
+        runs = []
+        for _ in range(repeat):
+            if prepare is not None:
+                RE(prepare())
+            with PlanCounter(RE) as counter:
+                t0 = time.perf_counter()
+                try:
+                    RE(plan())
+                    error = None
+                except Exception as ex:
+                    error = f'{type(ex).__name__}: {ex}'
+                wall_s = time.perf_counter() - t0
+            runs.append({'wall_s': wall_s, 'callbacks_s': counter.callbacks_s, 'moves': counter.moves,
+                         'triggers': counter.triggers, 'events': counter.events, 'error': error})
+        best = min(runs, key=lambda r: r['wall_s'])
+        results[name] = dict(best, runs=runs)
+
+    report = {
+        'profile_version': _profile_version(get_ipython().profile_dir.startup_dir),
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'simulation': IXS_SIMULATION,
+        'repeat': repeat,
+        'plans': results,
+    }
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(report, indent=1))
+
+    print(f"\n{'plan':16s} {'wall (s)':>9s} {'callbacks (s)':>13s} {'moves':>6s} {'triggers':>8s} {'events':>6s}")
+    for name, res in results.items():
+        print(f"{name:16s} {res['wall_s']:9.2f} {res['callbacks_s']:13.3f} {res['moves']:6d} "
+              f"{res['triggers']:8d} {res['events']:6d}" + (f"  {res['error']}" if res['error'] else ''))
+    print(f"Benchmark written to {path}")
+    if baseline is not None:
+        compare_benchmarks(baseline, report)
+    return report
+
+
+#*******************************************************************************************************
+def compare_benchmarks(baseline, results, tolerance=0.05):
+# prints the change of every plan between two benchmark reports (dicts or JSON files);
+# changes of the wall time within the relative tolerance are reported as unchanged
+    old, new = (r if isinstance(r, dict) else json.loads(Path(r).read_text()) for r in (baseline, results))
+    print(f"\n{'plan':16s} {'old (s)':>9s} {'new (s)':>9s} {'change':>8s} {'moves':>11s} {'triggers':>11s}")
+    for name, res in new['plans'].items():
+        if name not in old['plans']:
+            print(f"{name:16s} {'-':>9s} {res['wall_s']:9.2f}")
+            continue
+        ref = old['plans'][name]
+        change = res['wall_s']/ref['wall_s'] - 1 if ref['wall_s'] else 0.
+        verdict = 'faster' if change < -tolerance else 'slower' if change > tolerance else ''
+        print(f"{name:16s} {ref['wall_s']:9.2f} {res['wall_s']:9.2f} {change:+8.1%} "
+              f"{ref['moves']:5d}->{res['moves']:<5d} {ref['triggers']:5d}->{res['triggers']:<5d} {verdict}")
+    print(f"baseline {old['profile_version'] or 'unknown'} ({old['created']}), "
+          f"new {new['profile_version'] or 'unknown'} ({new['created']})")
+
+
+#*******************************************************************************************************
+def _synthetic_run(fields, npts):
+# documents of a scan of motor 'mtr' with gaussian peaks in every field
+    x = np.linspace(-1, 1, npts)
+    centers = np.linspace(-0.5, 0.5, len(fields))
+    docs = [('start', {'uid': 'bench', 'time': 0.}),
+            ('descriptor', {'uid': 'bench-d', 'run_start': 'bench', 'name': 'primary', 'time': 0.,
+                            'data_keys': {k: {'dtype': 'number', 'shape': [], 'source': k} for k in ['mtr'] + fields}})]
+    for i, xi in enumerate(x):
+        data = dict({f: 1e3*np.exp(-((xi - c)/0.2)**2) + 10. for f, c in zip(fields, centers)}, mtr=xi)
+        docs.append(('event', {'uid': f'bench-e{i}', 'descriptor': 'bench-d', 'seq_num': i + 1, 'time': float(i),
+                               'data': data, 'timestamps': {k: float(i) for k in data}}))
+    docs.append(('stop', {'uid': 'bench-s', 'run_start': 'bench', 'time': float(npts), 'exit_status': 'success'}))
+    return docs
+
+
+def bench_peak_stats(channels=(1, 6, 24), npts=101, repeat=20):
+    """
+    Compares one PeakStats per channel with one MultiPeakStats for all channels.
+
+    The documents of a synthetic scan are fed to the callbacks; the time per
+    run and per channel is printed.
+
+    Returns
+    -------
+    dict
+        {number of channels: {'PeakStats': s per run, 'MultiPeakStats': s per run}}
+    """
+
+    results = {}
+    print(f"{'channels':>8s} {'PeakStats (ms)':>15s} {'per ch (ms)':>11s} {'Multi (ms)':>11s} {'per ch (ms)':>11s}")
+    for nch in channels:
+        fields = [f'ch{n}' for n in range(nch)]
+        docs = _synthetic_run(fields, npts)
+        times = {}
+        for label, make in (('PeakStats', lambda: [PeakStats('mtr', f) for f in fields]),
+                            ('MultiPeakStats', lambda: [MultiPeakStats('mtr', fields)])):
+            best = float('inf')
+            for _ in range(repeat):
+                cbs = make()
+                t0 = time.perf_counter()
+                for name, doc in docs:
+                    for cb in cbs:
+                        cb(name, doc)
+                best = min(best, time.perf_counter() - t0)
+            times[label] = best
+        results[nch] = times
+        print(f"{nch:8d} {1e3*times['PeakStats']:15.2f} {1e3*times['PeakStats']/nch:11.3f} "
+              f"{1e3*times['MultiPeakStats']:11.2f} {1e3*times['MultiPeakStats']/nch:11.3f}")
+    return results
+
+
+#*******************************************************************************************************
+def bench_soft_roi(nrois=(7, 64, 512), shape=(516, 1556), repeat=20):
+    """
+    Compares SoftROIEngine with one NumPy slice per region on a random frame.
+
+    The regions are squares tiling the frame; both methods compute the
+    sum, masked sum and centroid of every region.
+
+    Returns
+    -------
+    dict
+        {number of regions: {'loop': s per frame, 'engine': s per frame}}
+    """
+
+    rng = np.random.default_rng(0)
+    frame = rng.poisson(5., shape).astype(float)
+    bad = rng.random(shape) < 1e-3
+    yy, xx = np.mgrid[:shape[0], :shape[1]]
+    results = {}
+    print(f"{'regions':>8s} {'loop (ms)':>10s} {'engine (ms)':>12s}")
+    for n in nrois:
+        side = max(1, int(np.sqrt(shape[0]*shape[1]/n/2)))
+        cols = shape[1]//side
+        rects = [((i % cols)*side, (i//cols*side) % (shape[0] - side + 1)) for i in range(n)]
+        engine = SoftROIEngine(shape, bad)
+        for i, (x, y) in enumerate(rects):
+            engine.add_roi(f'r{i}', x, y, side, side)
+
+        def loop():
+            for x, y in rects:
+                sl = (slice(y, y + side), slice(x, x + side))
+                v, good = frame[sl], ~bad[sl]
+                masked = (v*good).sum()
+                v.sum(), (v*good*xx[sl]).sum()/masked, (v*good*yy[sl]).sum()/masked
+
+        times = {}
+        for label, func in (('loop', loop), ('engine', lambda: engine.compute(frame))):
+            best = float('inf')
+            for _ in range(repeat):
+                t0 = time.perf_counter()
+                func()
+                best = min(best, time.perf_counter() - t0)
+            times[label] = best
+        results[n] = times
+        print(f"{n:8d} {1e3*times['loop']:10.2f} {1e3*times['engine']:12.2f}")
+    return results
+
+
+#*******************************************************************************************************
+def bench_kinematics(npts=(10, 100, 1000), repeat=20):
+    """
+    Compares the pseudo positioners of anc_xtal and sam_prime, called once per
+    point, with one call of their array kinematics for the whole trajectory.
+
+    Returns
+    -------
+    dict
+        {number of points: {'anc_xtal': (per point s, array s), 'sp': (per point s, array s)}}
+    """
+
+    check_kinematics()
+    results = {}
+    print(f"{'points':>8s} {'anc_xtal (ms)':>14s} {'array (ms)':>11s} {'sp (ms)':>9s} {'array (ms)':>11s}")
+    for n in npts:
+        the, y = np.linspace(-1., 1., n), np.linspace(-2., 2., n)
+        xp, zp = np.linspace(-5., 5., n), np.linspace(5., -5., n)
+        th, phi = sam_prime.th.position, sam_prime.phi.position
+        cases = {
+            'anc_xtal': (lambda: [anc_xtal.inverse(anc_xtal.forward((t, yy))) for t, yy in zip(the, y)],
+                         lambda: analyzer_cxtal_inverse(*analyzer_cxtal_forward(the, y))),
+            'sp': (lambda: [sam_prime.inverse(sam_prime.forward((x, z))) for x, z in zip(xp, zp)],
+                   lambda: sample_prime_inverse(*sample_prime_forward(xp, zp, th, phi), th, phi)),
+        }
+        times = {}
+        for label, funcs in cases.items():
+            best = []
+            for func in funcs:
+                t = float('inf')
+                for _ in range(repeat):
+                    t0 = time.perf_counter()
+                    func()
+                    t = min(t, time.perf_counter() - t0)
+                best.append(t)
+            times[label] = tuple(best)
+        results[n] = times
+        print(f"{n:8d} {1e3*times['anc_xtal'][0]:14.3f} {1e3*times['anc_xtal'][1]:11.3f} "
+              f"{1e3*times['sp'][0]:9.3f} {1e3*times['sp'][1]:11.3f}")
+    return results
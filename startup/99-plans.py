@@ -3,12 +3,13 @@ import bluesky.plan_stubs as bps
 import bluesky.preprocessors as bpp
 import bluesky.callbacks.fitting
 import numpy as np
-import pandas as pd
-import lmfit
 from bluesky.callbacks import LiveFit
 from bluesky.suspenders import SuspendFloor
 from ophyd import EpicsSignal
-from tabulate import tabulate
+
+pd = lazy_import('pandas')
+lmfit = lazy_import('lmfit')
+tabulate = lazy_function('tabulate', 'tabulate')
 
 # tm1sum = EpicsSignal('XF:10ID-BI:TM176:SumAll:MeanValue_RBV')
 # susp = SuspendFloor(tm1sum, 1.e-5, resume_thresh = 1.e-5, sleep = 1*60)
@@ -17,12 +18,24 @@ from tabulate import tabulate
 # id_bump_pv = EpicsSignal("SR:UOFB{C10-ID}Enabled-I", name="id_bump_pv")
 # nudge_pv = EpicsSignal("SR:UOFB{C10-ID}Nudge-Enabled", name="nudge_pv")
 
-def align_with_fit(dets, mtr, start, stop, gaps, mode='rel', md=None):
+def align_with_fit(dets, mtr, start, stop, gaps, mode='rel', md=None, precision=None):
     # Performs relative scan of motor and retuns data staistics
+    # With precision, the scan is adaptive (see adaptive_scan) and stops when the peak of
+    # the first detector field is located within precision
 
     md = md or {}
     plt.cla()
 
+    if precision is not None:
+        fields = [hint for det in dets for hint in det.hints['fields']]
+        multi_stats = MultiPeakStats(mtr.hints['fields'][0], fields)
+        x0 = axis_position(mtr) if mode == 'rel' else 0
+        plan = adaptive_scan(dets, mtr, x0 + start, x0 + stop, gaps+1, fields[0], precision, md=md)
+        if mode == 'rel':
+            plan = bpp.reset_positions_wrapper(plan, [mtr])
+        yield from bpp.subs_wrapper(plan, threaded([multi_stats]))
+        return multi_stats.views
+
     local_peaks = []
     for det in dets:
         for hint in det.hints['fields']:
@@ -34,12 +47,12 @@ def align_with_fit(dets, mtr, start, stop, gaps, mode='rel', md=None):
     if mode == 'rel':
         plan = bpp.subs_wrapper(
             bp.rel_scan(dets, mtr, start, stop, gaps+1, md=md), 
-            local_peaks
+            threaded(local_peaks)
             )
     else:
         plan = bpp.subs_wrapper(
             bp.scan(dets, mtr, start, stop, gaps+1, md=md), 
-            local_peaks
+            threaded(local_peaks)
             )
     yield from plan
     return local_peaks
@@ -96,15 +109,19 @@ def double_ct(exp_time):
     # yield from bps.mv(sample_stage.sx, 0)
     yield from ct(exp_time)
 
-def Lipid_Qscan(Qq=None, Ncycles=1, md=None):
+def Lipid_Qscan(Qq=None, Ncycles=1, md=None, fly=False, rel_error=None, max_time=None):
     # Test plan for the energy scan at several Q values
     # Usage: 
+    #       fly=True runs the energy scans as hrmE_flyscan
+    #       rel_error, max_time count the energy scans adaptively (see hrmE_dscan)
+    if fly and rel_error is not None:
+        raise ValueError("The fly scans count a fixed time per point, rel_error needs fly=False")
     md = md or {}
     tth001 = 16.8
 #    Qq = [1, 2, 3]
     c22 = sclr.channels.chan22
-    yield from bps.mv(analyzer_slits.top, 1, analyzer_slits.bottom, -1, analyzer_slits.outboard, 1.5, analyzer_slits.inboard, -1.5)
-    yield from bps.mv(mcm_slits.inboard, -1, mcm_slits.outboard, 1)
+    yield from slit_preset(analyzer_slits, 'measure')
+    yield from slit_preset(mcm_slits, 'measure')
 
     for kk in range(Ncycles):
         yield from bps.mv(anapd, 25)
@@ -121,7 +138,10 @@ def Lipid_Qscan(Qq=None, Ncycles=1, md=None):
                 plt.cla()
                 th = qq2th(q)
                 yield from bps.mv(spec.tth, th)
-                yield from hrmE_dscan(-5, 5, 10, 2, md=md)
+                if fly:
+                    yield from hrmE_flyscan(-5, 5, 10, 2, md=md)
+                else:
+                    yield from hrmE_dscan(-5, 5, 10, 2, md=md, rel_error=rel_error, max_time=max_time)
 
 #                yield from bps.mvr(sample_stage.sx, 0.03)
                 print(f"Moving the TTH to the Tth = {tth001} angle\n")
@@ -184,7 +204,8 @@ def Peak_Test(det, mot, det_channel_picks=[]):
 #        plan = bp.rel_scan([det], ixs4c.omega, -5, 5, 5)
 #        subs_list = [plotselect(det.hints['fields'], mot.name)]
 #        stats_list = [PeakStats(mot.name, det.hints['fields'])]
-        subs_list = [LivePlot(det.hints['fields'][0], x=mot.name, marker='*', markersize=10, ax=myaxs)]
+        subs_list = [ThrottledLivePlot(det.hints['fields'][0], x=mot.name, marker='*', markersize=10, ax=myaxs,
+                                       max_fps=plotselect.max_fps)]
         stats_list = [PeakStats(mot.name, det.hints['fields'][0])]
     else:
 #        local_peaks = []
@@ -193,7 +214,7 @@ def Peak_Test(det, mot, det_channel_picks=[]):
         subs_list = [plotselect(det.hints['fields'][det_channel], mot.name) for det_channel in  det_channel_picks]
         stats_list = [PeakStats(mot.name, det.hints['fields'][det_channel]) for det_channel in det_channel_picks]
 
-    subs_list.extend(stats_list)
+    subs_list = threaded(subs_list, policy='drop') + threaded(stats_list)
     plan = bpp.subs_wrapper(
              bp.rel_scan([det], ixs4c.omega, -5, 5, 5), subs_list)
         
@@ -1,23 +1,49 @@
-from hkl import E4CV, SimMixin, Lattice, DiffractometerConfiguration, Constraint
 from ophyd import SoftPositioner
 from ophyd import Component as Cpt
-from hkl.user import *
-import pathlib, pyRestTable
-
-class FourCircle(SimMixin, E4CV):
-    """
-    Our 4-circle.  Eulerian, vertical scattering orientation.
-    """
-    # the reciprocal axes are defined by SimMixin
-
-#    the = Cpt(SoftPositioner, kind="hinted", init_pos=0)
-#    chi = Cpt(SoftPositioner, kind="hinted", init_pos=0)
-#    phi = Cpt(SoftPositioner, kind="hinted", init_pos=0)
-#    tth = Cpt(SoftPositioner, kind="hinted", init_pos=0)
-    th = Cpt(EpicsMotor, 'XF:10IDD-OP{Spec:1-Ax:Th}Mtr', labels=('ixs4c',))
-    chi = Cpt(EpicsMotor, 'XF:10IDD-OP{Spec:1-Ax:ChiA}Mtr', labels=('ixs4c',))
-    phi = Cpt(EpicsMotor, 'XF:10IDD-OP{Spec:1-Ax:PhiA}Mtr', labels=('ixs4c',))
-    tth = Cpt(EpicsMotor, 'XF:10IDD-OP{Spec:1-Ax:2Th}Mtr', labels=('ixs4c',))
+import pathlib
+
+# hkl (libhkl through gobject-introspection) is slow to import, so the
+# diffractometer is built the first time ixs4c or ixs4c_config is used.
+hkl = lazy_import('hkl')
+pyRestTable = lazy_import('pyRestTable')
+
+Lattice = lazy_function('hkl', 'Lattice')
+Constraint = lazy_function('hkl', 'Constraint')
+# hkl.user.__all__ of hklpy 1.1.2, i.e. what 'from hkl.user import *' provided
+for _name in ['cahkl', 'cahkl_table', 'calc_UB', 'change_sample', 'current_diffractometer',
+              'list_samples', 'new_sample', 'or_swap', 'pa', 'select_diffractometer', 'set_energy',
+              'setor', 'show_sample', 'show_selected_diffractometer', 'update_sample', 'wh']:
+    globals()[_name] = lazy_function('hkl.user', _name)
+
+
+def _make_ixs4c():
+    class FourCircle(hkl.SimMixin, hkl.E4CV):
+        """
+        Our 4-circle.  Eulerian, vertical scattering orientation.
+        """
+        # the reciprocal axes are defined by SimMixin
+
+#        the = Cpt(SoftPositioner, kind="hinted", init_pos=0)
+#        chi = Cpt(SoftPositioner, kind="hinted", init_pos=0)
+#        phi = Cpt(SoftPositioner, kind="hinted", init_pos=0)
+#        tth = Cpt(SoftPositioner, kind="hinted", init_pos=0)
+        th = Cpt(EpicsMotor, 'XF:10IDD-OP{Spec:1-Ax:Th}Mtr', labels=('ixs4c',))
+        chi = Cpt(EpicsMotor, 'XF:10IDD-OP{Spec:1-Ax:ChiA}Mtr', labels=('ixs4c',))
+        phi = Cpt(EpicsMotor, 'XF:10IDD-OP{Spec:1-Ax:PhiA}Mtr', labels=('ixs4c',))
+        tth = Cpt(EpicsMotor, 'XF:10IDD-OP{Spec:1-Ax:2Th}Mtr', labels=('ixs4c',))
+
+    ixs4c = FourCircle("", name="ixs4c")
+    ixs4c.calc.energy=9.1317
+    ixs4c.calc.physical_axis_names = {'omega': 'th', 'chi': 'chi', 'phi': 'phi', 'tth': 'tth'}
+
+    ixs4c.engine.mode = "constant_phi"
+    ixs4c.energy.put(9.1317)
+
+    ixs4c.calc['th'].limits = (-20, 90)
+    ixs4c.calc['chi'].limits = (-10, 10)
+    ixs4c.calc['tth'].limits=(-10, 135)
+    return ixs4c
+
 
 def save_config(file_name:str):
 # saves the ixs4c_config to a file
@@ -62,18 +88,8 @@ def p_sol(sol):
     print(tabulate(data, headers=Head, floatfmt='.6f'))
 
 
-ixs4c = FourCircle("", name="ixs4c")
-ixs4c.calc.energy=9.1317
-ixs4c.calc.physical_axis_names = {'omega': 'th', 'chi': 'chi', 'phi': 'phi', 'tth': 'tth'}
-
-ixs4c.engine.mode = "constant_phi"
-ixs4c.energy.put(9.1317)
-
-ixs4c.calc['th'].limits = (-20, 90)
-ixs4c.calc['chi'].limits = (-10, 10)
-ixs4c.calc['tth'].limits=(-10, 135)
-
-ixs4c_config = DiffractometerConfiguration(ixs4c)
+ixs4c = LazyObject(_make_ixs4c)
+ixs4c_config = LazyObject(lambda: hkl.DiffractometerConfiguration(ixs4c._resolve()))
 
 config_path = pathlib.Path("/IXS2/data/Ixs4c_config")
 